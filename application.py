@@ -1,25 +1,211 @@
-from dash import Dash, html, Output, Input, dcc
-import json
+from dash import Dash, html, Output, Input, State, dcc, dash_table, no_update, ctx
+import os
+import flask
+import numpy as np
+import time
+import threading
 import dash_leaflet as dl
 # import dash_leaflet.express as dlx
+from dash_extensions import EventSource
 from dash_extensions.javascript import assign, arrow_function
 import datetime as dt
 
 from gtfs_tools import (
-    check_static_updates,
+    # check_static_updates,
     # transitview_to_df,
-    get_bus_positions_from_transitview,
+    # get_bus_positions_from_transitview,
     # feed_to_dict,
-    get_lines_json,
+    # get_lines_json,
     # get_bus_lines,
     #  get_bus_positions,
     colors)
+from vehicle_cache import VehicleSnapshotCache, VehicleStore
+from vehicle_history import VehicleHistory
+from vehicle_push import VehicleBroadcaster
+from vehicle_clusters import ClusterCache
+from line_artifact import load_line_artifact, lod_tier
+from spatial_index import load_route_index
+from eta_engine import ETAEngine
+from headway import HeadwayAnalytics
+from vector_tiles import LineTiles
+from gtfs_storage import get_storage
+from build_static import refresh_static_data, start_background_refresh
+from metrics import span, counter, gauge, histogram, render, SamplingProfiler, SIZE_BUCKETS
 
-check_static_updates()
+## STATIC_REFRESH=job (default): static data is refreshed by running `python build_static.py` separately
+## STATIC_REFRESH=background: one worker refreshes in a background thread while all workers serve
+## STATIC_REFRESH=import: every worker refreshes before serving (the old behaviour)
+STATIC_REFRESH = os.environ.get('STATIC_REFRESH', 'job')
+if STATIC_REFRESH == 'import':
+    refresh_static_data()
+elif STATIC_REFRESH == 'background':
+    start_background_refresh()
 
-lines_df = get_lines_json('./data/all_bus_routes.json')
+line_artifact = load_line_artifact()
+## Spatial index over the same lines and the stops stored with them
+route_index = load_route_index(line_artifact, get_storage())
+line_tiles = None
 
+## ETA_ENGINE=1: schedule adherence and arrival predictions for every snapshot, served at /eta.json.
+## The engine is built from the database on the artifact watcher thread, and rebuilt there
+## whenever the static data is; snapshots are predicted with the last engine built meanwhile
+ETA_ENGINE = os.environ.get('ETA_ENGINE') == '1'
+eta_engine = None
+eta_predictions = None
+
+def watch_line_artifact(interval = 30):
+    ## A rebuilt artifact (from build_static.py or a worker's background refresh) is loaded,
+    ## with its spatial index and vector tile index, in a thread of every worker rather than
+    ## in whichever request first notices it. The ETA engine for it is built here too, off
+    ## the vehicle snapshot listeners
+    def run():
+        global line_artifact, route_index, line_tiles, eta_engine
+        while True:
+            try:
+                if not line_artifact.is_current():
+                    artifact = load_line_artifact()
+                    index = load_route_index(artifact, get_storage())
+                    tiles = None if line_tiles is None else LineTiles(artifact)
+                    line_artifact, route_index, line_tiles = artifact, index, tiles
+                    print(f"Line artifact reloaded: {artifact.version}")
+            except Exception as e:
+                print(f"Line artifact reload failed: {e}")
+            version = line_artifact.version
+            if ETA_ENGINE and (eta_engine is None or eta_engine.version != version):
+                try:
+                    with span('eta_engine_build'):
+                        engine = ETAEngine.from_storage(get_storage())
+                    engine.version = version
+                    eta_engine = engine
+                    print(f"ETA engine built for {version}")
+                except Exception as e:
+                    print(f"ETA engine build failed: {e}")
+            time.sleep(interval)
+
+    return start_native_thread(run, name = 'line-artifact-watcher')
+
+def start_native_thread(target, name):
+    ## Under gunicorn's gevent workers threading.Thread is a greenlet, and CPU-bound work in
+    ## it (seconds, for the ETA engine) holds the worker's event loop and every open stream.
+    ## An OS thread is preempted by the interpreter instead. The unpatched Thread class would
+    ## still start a greenlet, so the thread is started with the original start_new_thread
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return monkey.get_original('_thread', 'start_new_thread')(target, ())
+    thread = threading.Thread(target = target, name = name, daemon = True)
+    thread.start()
+    return thread
+
+watch_line_artifact()
+
+def current_line_artifact():
+    return line_artifact
+
+def current_route_index():
+    return route_index
+
+## One worker polls TransitView (every VEHICLE_POLL_INTERVAL seconds); every worker and
+## session reads the shared snapshot
+vehicle_cache = VehicleSnapshotCache(interval = float(os.environ.get('VEHICLE_POLL_INTERVAL', 30)))
+vehicle_store = VehicleStore()
+
+## Every worker keeps the last hour of positions; only the polling worker spills them to
+## VEHICLE_HISTORY_DIR (when set), so each report is written once
+vehicle_history = VehicleHistory(spill_dir = os.environ.get('VEHICLE_HISTORY_DIR'))
+vehicle_cache.add_listener(lambda snapshot: vehicle_history.append_snapshot(snapshot, spill = vehicle_cache.is_leader))
+
+def predict_snapshot(snapshot):
+    global eta_predictions
+    ## Nothing to predict with until the watcher has built the first engine
+    engine = eta_engine
+    if engine is None:
+        return
+    vehicles, arrivals = engine.predict_features(snapshot['data'], snapshot['fetched_at'])
+    eta_predictions = {'generation' : snapshot['generation'], 'vehicles' : vehicles, 'arrivals' : arrivals}
+
+if ETA_ENGINE:
+    vehicle_cache.add_listener(predict_snapshot)
+
+## Bunching, gaps and lateness per route and direction for every snapshot, served at
+## /headways.json and in the panel under the route dropdown. Time headways use each route's
+## median speed over the last 15 minutes of vehicle history
+headway_analytics = None
+headway_results = None
+
+@span('headway_analyze')
+def analyze_headways(snapshot):
+    global headway_analytics, headway_results
+    artifact = current_line_artifact()
+    if headway_analytics is None or headway_analytics.version != artifact.version:
+        headway_analytics = HeadwayAnalytics.from_artifact(artifact)
+    trails = vehicle_history.trails(start = snapshot['fetched_at'] - 15 * 60, end = snapshot['fetched_at'])
+    route_speeds = trails.groupby('route_id')['speed'].median().dropna().to_dict()
+    vehicles, routes = headway_analytics.analyze_features(snapshot['data'], route_speeds = route_speeds)
+    headway_results = {'generation' : snapshot['generation'], 'fetched_at' : snapshot['fetched_at'], 'vehicles' : vehicles, 'routes' : routes}
+
+vehicle_cache.add_listener(analyze_headways)
+
+def headway_table(route_ids = None, limit = 15):
+    ## Panel rows: the selected routes, or the most bunched routes when none are selected
+    results = headway_results
+    if results is None:
+        return []
+    routes = results['routes']
+    if route_ids:
+        routes = routes.loc[routes['route_id'].isin([str(r) for r in route_ids])]
+    routes = routes.loc[routes['on_route'] > 1].sort_values(['bunched', 'spacing_cv'], ascending = False).head(limit)
+    return [{
+        'route' : f"{r.route_id} {r.direction}".strip(),
+        'vehicles' : int(r.on_route),
+        'bunched' : int(r.bunched),
+        'gaps' : int(r.gaps),
+        'headway' : None if np.isnan(r.mean_headway) else round(r.mean_headway / 60, 1),
+        'late' : None if np.isnan(r.late_median) else round(r.late_median, 1),
+    } for r in routes.itertuples()]
+
+## VEHICLE_TRANSPORT=sse (default): each new snapshot is pushed to browsers over /vehicles/stream
+## VEHICLE_TRANSPORT=poll: browsers ask for changes every 30 seconds through a Dash callback
+VEHICLE_TRANSPORT = os.environ.get('VEHICLE_TRANSPORT', 'sse')
+vehicle_broadcaster = VehicleBroadcaster(vehicle_store)
+
+## VEHICLE_CLUSTERS=server (default): vehicles are clustered for every zoom level once per snapshot,
+## and each browser gets only the clusters and vehicles in its view (over SSE, only a notice
+## that there is a new snapshot is pushed). VEHICLE_CLUSTERS=client: every vehicle is sent and
+## the browser clusters them
+VEHICLE_CLUSTERS = os.environ.get('VEHICLE_CLUSTERS', 'server')
+vehicle_clusters = ClusterCache()
+
+def cluster_snapshot(snapshot):
+    version = vehicle_store.update(snapshot)
+    vehicle_clusters.update(version, vehicle_store.vehicles.values())
+
+if VEHICLE_CLUSTERS == 'server':
+    vehicle_cache.add_listener(cluster_snapshot)
+## After the clusters, so browsers told of a new snapshot find its clusters ready
+if VEHICLE_TRANSPORT == 'sse':
+    vehicle_cache.add_listener(vehicle_broadcaster.publish)
+vehicle_cache.start()
+
+## SAMPLING_PROFILER=1: sample every thread's stack (every SAMPLING_PROFILER_INTERVAL seconds)
+## and serve the counts as collapsed stacks at /debug/profile, for flame graphs
+profiler = SamplingProfiler(interval = float(os.environ.get('SAMPLING_PROFILER_INTERVAL', 0.01)))
+if os.environ.get('SAMPLING_PROFILER') == '1':
+    profiler.start()
+
+## Server-side clusters are drawn as a count in a circle of their most common route's color
 use_icon = assign("""function (feature, latlng) {
+        if (feature.properties.cluster) {
+            const count = feature.properties.point_count;
+            const size = count < 10 ? 26 : count < 100 ? 32 : 40;
+            return L.marker(latlng, {icon: L.divIcon({
+                html: `<div style="background:${feature.properties.color || '#555'};width:${size}px;height:${size}px;line-height:${size}px;border-radius:50%;text-align:center;color:white;font-weight:bold;opacity:0.85">${count}</div>`,
+                className: 'vehicle-cluster',
+                iconSize: L.point(size, size)
+            })});
+        }
         return L.circleMarker(latlng, {
             radius: 8,
             weight: 1,
@@ -50,6 +236,20 @@ app.layout = html.Div(children = [
                     options = list(colors.keys()),
                     value = [],
                     placeholder = "Select a bus route", multi = True
+                    ),
+            html.H4('Bunching'),
+            dash_table.DataTable(id = 'headway-table',
+                    columns = [
+                        {'name' : 'Route', 'id' : 'route'},
+                        {'name' : 'Buses', 'id' : 'vehicles'},
+                        {'name' : 'Bunched', 'id' : 'bunched'},
+                        {'name' : 'Gaps', 'id' : 'gaps'},
+                        {'name' : 'Headway (min)', 'id' : 'headway'},
+                        {'name' : 'Median late (min)', 'id' : 'late'}
+                    ],
+                    data = headway_table(),
+                    style_cell = {'fontSize' : 12, 'padding' : '2px 4px'},
+                    style_as_list_view = True
                     )
             ])],
             style = {'flex':1, 'height':'50vh'}
@@ -67,7 +267,7 @@ app.layout = html.Div(children = [
                     dl.TileLayer(url='https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png', minZoom=0, maxZoom=20),
                 ], name = 'Carto Light', checked = True),  
                 dl.Overlay(dl.LayerGroup(dl.GeoJSON(
-                    data = json.loads(lines_df.to_json(drop_id = True)),
+                    url = f"/lines.geojson?z=13&v={os.path.basename(line_artifact.version)}",
                     id = 'lines-geojson',
                     zoomToBounds = True,
                     options = {'style': lines_style},
@@ -75,20 +275,22 @@ app.layout = html.Div(children = [
                     hoverStyle = arrow_function(dict(weight=5, color='#00ffcf', opacity = 0.8, dashArray='')))),
                     id = 'lines', name = 'bus-lines', checked = True),
                 dl.Overlay(dl.LayerGroup(dl.GeoJSON(
-                    data = get_bus_positions_from_transitview(),
                     options=dict(pointToLayer=use_icon),
-                    cluster = True,
-                    superClusterOptions={"radius": 100, "minPoints":7}, zoomToBoundsOnClick=True,
-                    children = [dl.Tooltip(id = 'tooltip', opacity = 0.9)], id = 'geojson')),
+                    children = [dl.Tooltip(id = 'tooltip', opacity = 0.9)], id = 'geojson',
+                    **({} if VEHICLE_CLUSTERS == 'server' else dict(cluster = True, superClusterOptions={"radius": 100, "minPoints":7}, zoomToBoundsOnClick=True)))),
                     id = 'points', name = 'bus-points', checked = True)
             ])
         ],
         center=(39.92, -75.15),
-        zoom = 13
+        zoom = 13,
+        id = 'map'
         )],
         style={'flex': 4, 'height':'100vh'}
     ),
-    dcc.Interval(id='interval1', interval= 30 * 1000, n_intervals=0)
+    EventSource(id = 'vehicle-events', url = '/vehicles/stream?notify=1' if VEHICLE_CLUSTERS == 'server' else '/vehicles/stream') if VEHICLE_TRANSPORT == 'sse' else
+    dcc.Interval(id='interval1', interval= 30 * 1000, n_intervals=0),
+    dcc.Store(id='vehicle-delta'),
+    dcc.Store(id='vehicle-version')
     ],
      style={'display': 'flex'}
 )])
@@ -111,6 +313,14 @@ def update_line_popup(feature):
 def update_vehicle_tooltip(feature):
     if feature is None:
         return None
+    elif feature['properties'].get('cluster'):
+        routes = ', '.join(f"{route_id} ({count})" for route_id, count in feature['properties']['routes'])
+        if feature['properties']['other_routes']:
+            routes += f", {feature['properties']['other_routes']} more"
+        return [
+            html.P(html.B(f"{feature['properties']['point_count']} buses")),
+            html.P(f"Routes: {routes}")
+        ]
     elif "route_id" in feature['properties']:
         return [
             html.P(html.B(f"Bus: {feature['properties']['route_id']}")),
@@ -126,38 +336,351 @@ def update_vehicle_tooltip(feature):
     else:
         return None
 
+## Refreshed with every vehicle update the browser receives, by SSE or polling
 @app.callback(
-    Output(component_id='lines-geojson', component_property= 'data'),
-    Input('route_dropdown', "value"),
+    Output('headway-table', 'data'),
+    Input('vehicle-version', 'data'),
+    Input('route_dropdown', 'value')
 )
-def update_bus_lines(
-    value
-    ):
-    print("Updating route lines.")
-    if len(value) > 0:
-        return json.loads(lines_df.loc[lines_df['route_id'].isin(value), :].to_json(drop_id = True))
+def update_headway_table(delta, value):
+    return headway_table(value)
+
+REQUEST_SECONDS = histogram('http_request_duration_seconds', "Time to build each response, by endpoint (Dash callbacks by output).", labels = ('endpoint',))
+RESPONSE_BYTES = histogram('http_response_bytes', "Response body sizes, by endpoint.", labels = ('endpoint',), buckets = SIZE_BUCKETS)
+gauge('vehicle_snapshot_age_seconds', "Age of the shared vehicle snapshot.",
+      function = lambda: {} if vehicle_cache.age() is None else {() : vehicle_cache.age()})
+gauge('vehicle_push_subscribers', "Open /vehicles/stream connections.", function = lambda: {() : vehicle_broadcaster.subscribers()})
+counter('vehicle_push_encodes_total', "Vehicle events encoded for push, one per filter group and generation.",
+        function = lambda: {() : vehicle_broadcaster.encodes})
+counter('line_selection_cache_total', "Route line selections served from the LRU cache (hit) or concatenated (miss).", labels = ('result',),
+        function = lambda: {('hit',) : line_artifact.selection_bytes.cache_info().hits, ('miss',) : line_artifact.selection_bytes.cache_info().misses})
+
+def request_endpoint():
+    ## Url rule, not path, so tile coordinates and query strings do not multiply the series
+    if flask.request.url_rule is None:
+        return 'unmatched'
+    endpoint = flask.request.url_rule.rule
+    if endpoint.endswith('_dash-update-component'):
+        body = flask.request.get_json(silent = True) or {}
+        endpoint = f"{endpoint} {body.get('output', '')}"
+    return endpoint
+
+@server.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+
+## Time from request to response object: for Dash callbacks this is the callback (see its
+## span) plus Dash's own validation and JSON serialization. Streamed responses only count
+## until the stream starts
+@server.after_request
+def record_request(response):
+    if 'request_start' in flask.g:
+        endpoint = request_endpoint()
+        REQUEST_SECONDS.observe(time.perf_counter() - flask.g.request_start, endpoint)
+        if not response.is_streamed and response.content_length is not None:
+            RESPONSE_BYTES.observe(response.content_length, endpoint)
+    return response
+
+## Prometheus metrics of this worker
+@server.route('/metrics')
+def metrics_endpoint():
+    response = flask.Response(render(), mimetype = 'text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+## Stack samples since the last reset, in the collapsed format of flamegraph.pl and speedscope.
+## ?reset=1 clears them after the response, ?enable=0 / ?enable=1 pause and resume sampling
+if os.environ.get('SAMPLING_PROFILER') == '1':
+    @server.route('/debug/profile')
+    def profile_stacks():
+        text = f"# {profiler.samples} samples every {profiler.interval}s, {'running' if profiler.running else 'paused'}\n" + profiler.collapsed()
+        if flask.request.args.get('reset') == '1':
+            profiler.reset()
+        if flask.request.args.get('enable') == '0':
+            profiler.stop()
+        elif flask.request.args.get('enable') == '1':
+            profiler.start()
+        response = flask.Response(text, mimetype = 'text/plain')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+## Route lines are served as pre-encoded bytes; the callback below only swaps the url.
+## bbox (min_lon,min_lat,max_lon,max_lat) keeps only routes in view, and z picks the
+## simplification tier for the map zoom
+@server.route('/lines.geojson')
+def lines_geojson():
+    artifact = current_line_artifact()
+    route_ids = tuple(sorted(r for r in flask.request.args.get('routes', '').split(',') if r)) or 'all'
+    bbox = flask.request.args.get('bbox')
+    if bbox:
+        try:
+            in_view = current_route_index().routes_in_bbox(*[float(b) for b in bbox.split(',')])
+        except (TypeError, ValueError):
+            flask.abort(400)
+        route_ids = tuple(sorted(set(in_view) if route_ids == 'all' else set(in_view) & set(route_ids)))
+    tier = lod_tier(flask.request.args.get('z', type = int)) if 'z' in flask.request.args else None
+    response = flask.Response(artifact.selection_bytes(route_ids, tier), mimetype = 'application/json')
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    response.set_etag(f"{os.path.basename(artifact.version)}-{tier}-{'all' if route_ids == 'all' else ','.join(route_ids)}")
+    return response.make_conditional(flask.request)
+
+def current_line_tiles():
+    ## Built on the first tile request; after that the artifact watcher rebuilds it
+    global line_tiles
+    artifact = current_line_artifact()
+    if line_tiles is None or line_tiles.artifact is not artifact:
+        line_tiles = LineTiles(artifact)
+    return line_tiles
+
+## Route lines as Mapbox Vector Tiles, for clients and CDNs that fetch the static layer per tile.
+## Add ?v=<artifact version> to the url template so caches drop tiles from an older release
+@server.route('/tiles/<int:z>/<int:x>/<int:y>.pbf')
+def line_tile(z, x, y):
+    if z > 22 or x >= 2 ** z or y >= 2 ** z:
+        flask.abort(404)
+    tiles = current_line_tiles()
+    response = flask.Response(tiles.tile(z, x, y), mimetype = 'application/vnd.mapbox-vector-tile')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    response.set_etag(f"{os.path.basename(tiles.artifact.version)}-{z}-{x}-{y}")
+    return response.make_conditional(flask.request)
+
+## Recent positions as one LineString per vehicle, e.g. /vehicle_trails.geojson?routes=23,47&minutes=15
+@server.route('/vehicle_trails.geojson')
+def vehicle_trails_geojson():
+    route_ids = [r for r in flask.request.args.get('routes', '').split(',') if r] or None
+    minutes = min(flask.request.args.get('minutes', 15, type = float), 60)
+    trails = vehicle_history.trails(route_ids = route_ids, start = dt.datetime.now().timestamp() - minutes * 60)
+    features = []
+    for vehicle, trail in trails.groupby('vehicle', sort = False):
+        if len(trail) < 2:
+            continue
+        features.append({
+            'type' : 'Feature',
+            'id' : vehicle,
+            'properties' : {
+                'route_id' : trail['route_id'].iloc[-1],
+                'color' : colors.get(trail['route_id'].iloc[-1]),
+                'speed' : None if np.isnan(trail['speed'].iloc[-1]) else round(float(trail['speed'].iloc[-1]), 1)
+            },
+            'geometry' : {'type' : 'LineString', 'coordinates' : trail[['lon', 'lat']].round(5).to_numpy().tolist()}
+        })
+    response = flask.jsonify({'type' : 'FeatureCollection', 'features' : features})
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+## Predicted arrivals at a stop (/eta.json?stop_id=...) or of a vehicle (/eta.json?vehicle=...),
+## with the vehicle's current delay in seconds
+@server.route('/eta.json')
+def eta_json():
+    predictions = eta_predictions
+    if predictions is None:
+        flask.abort(404)
+    arrivals = predictions['arrivals']
+    if 'stop_id' in flask.request.args:
+        arrivals = arrivals.loc[arrivals['stop_id'] == flask.request.args['stop_id']].nsmallest(10, 'predicted')
+    elif 'vehicle' in flask.request.args:
+        arrivals = arrivals.loc[arrivals['vehicle'] == flask.request.args['vehicle']]
     else:
-        return json.loads(lines_df.to_json(drop_id = True))
+        flask.abort(400)
+    delays = predictions['vehicles'].set_index('vehicle')['delay']
+    arrivals = arrivals.assign(delay = delays.reindex(arrivals['vehicle']).to_numpy())
+    response = flask.jsonify({
+        'generation' : predictions['generation'],
+        'arrivals' : arrivals[['vehicle', 'trip_id', 'route_id', 'stop_id', 'stop_sequence', 'scheduled', 'predicted', 'delay']].to_dict('records')
+    })
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+## Spacing and lateness per route and direction in the latest snapshot, e.g. /headways.json?routes=23,47.
+## ?vehicles=1 adds each vehicle's distance along the route, spacing to the next and flags
+@server.route('/headways.json')
+def headways_json():
+    results = headway_results
+    if results is None:
+        flask.abort(404)
+    route_ids = [r for r in flask.request.args.get('routes', '').split(',') if r]
+    routes, vehicles = results['routes'], results['vehicles']
+    if route_ids:
+        routes = routes.loc[routes['route_id'].isin(route_ids)]
+        vehicles = vehicles.loc[vehicles['route_id'].isin(route_ids)]
+    document = {
+        'generation' : results['generation'],
+        'fetched_at' : results['fetched_at'],
+        'routes' : routes.round(3).astype(object).where(routes.notna(), None).to_dict('records')
+    }
+    if flask.request.args.get('vehicles') == '1':
+        document['vehicles'] = vehicles.round(1).astype(object).where(vehicles.notna(), None).to_dict('records')
+    response = flask.jsonify(document)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+## Vehicle updates as Server-Sent Events, e.g. /vehicles/stream?routes=23,47: the group's full
+## snapshot on connect, then one delta per snapshot generation. With ?notify=1 every event only
+## carries the new version, for clients that fetch their view of the vehicles themselves
+@server.route('/vehicles/stream')
+def vehicle_stream():
+    route_ids = [r for r in flask.request.args.get('routes', '').split(',') if r] or 'all'
+    stream = vehicle_broadcaster.notifications() if flask.request.args.get('notify') == '1' else vehicle_broadcaster.stream(route_ids)
+    response = flask.Response(stream, mimetype = 'text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    ## Keep proxies like nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def viewport_bbox(bounds, pad = 0.5, grid = 0.01):
+    ## Map bounds ([[south, west], [north, east]]) padded by half the view on each side and
+    ## snapped outwards to a grid, so small pans reuse the same url (and the browser's cache)
+    (south, west), (north, east) = bounds
+    dx, dy = (east - west) * pad, (north - south) * pad
+    return (np.floor((west - dx) / grid) * grid, np.floor((south - dy) / grid) * grid,
+            np.ceil((east + dx) / grid) * grid, np.ceil((north + dy) / grid) * grid)
 
 @app.callback(
-    Output(component_id='geojson', component_property= 'data'),
-    Input(component_id='interval1', component_property= 'n_intervals'),
+    Output(component_id='lines-geojson', component_property= 'url'),
+    Output(component_id='lines-geojson', component_property= 'zoomToBounds'),
     Input('route_dropdown', "value"),
-    # Input(component_id='btn', component_property='n_clicks'),
+    Input('map', 'bounds'),
+    Input('map', 'zoom'),
 )
-def update_bus_interval(
-    n_intervals,
-    value
-    # n_clicks
+@span('update_bus_lines')
+def update_bus_lines(
+    value,
+    bounds,
+    zoom
     ):
-    print(f"Updating vehicle locations. ({dt.datetime.now().strftime('%I:%M:%S %p')})")
+    print("Updating route lines.")
+    ## The artifact version in the url keeps browser caches from serving lines from an older release
+    version = os.path.basename(current_line_artifact().version)
+    args = []
     if len(value) > 0:
+        args.append(f"routes={','.join(sorted(str(v) for v in value))}")
+    ## A new selection is sent whole and zoomed to; map moves only fetch what is in view
+    zoom_to_bounds = ctx.triggered_id == 'route_dropdown'
+    if bounds is not None and not zoom_to_bounds:
+        args.append(f"bbox={','.join(f'{b:.2f}' for b in viewport_bbox(bounds))}")
+    if zoom is not None:
+        args.append(f"z={int(zoom)}")
+    args.append(f"v={version}")
+    return f"/lines.geojson?{'&'.join(args)}", zoom_to_bounds
+
+if VEHICLE_CLUSTERS == 'server':
+    ## The clusters and vehicles in view, sent again only when the snapshot, the (snapped) view,
+    ## the zoom or the route selection changed
+    @app.callback(
+        Output('geojson', 'data'),
+        Output('vehicle-version', 'data'),
+        Input('vehicle-events', 'message') if VEHICLE_TRANSPORT == 'sse' else Input('interval1', 'n_intervals'),
+        Input('map', 'bounds'),
+        Input('map', 'zoom'),
+        Input('route_dropdown', 'value'),
+        State('vehicle-version', 'data'),
+        prevent_initial_call = False
+    )
+    @span('update_vehicle_clusters')
+    def update_vehicle_clusters(trigger, bounds, zoom, value, client_state):
+        if vehicle_clusters.generation is None:
+            cluster_snapshot(vehicle_cache.snapshot())
+        routes = sorted(str(v) for v in value)
+        bbox = None if bounds is None else [round(float(b), 2) for b in viewport_bbox(bounds)]
+        zoom = None if zoom is None else int(zoom)
+        query = {'generation' : vehicle_clusters.generation, 'zoom' : zoom, 'bbox' : bbox, 'routes' : routes}
+        if client_state == query:
+            return no_update, no_update
+        return vehicle_clusters.query(zoom, bbox, routes if len(routes) > 0 else 'all'), query
+
+    ## Clicking a cluster zooms to where it splits
+    @app.callback(
+        Output('map', 'center'),
+        Output('map', 'zoom'),
+        Input('geojson', 'click_feature')
+    )
+    def zoom_to_cluster(feature):
+        if feature is None or not feature['properties'].get('cluster'):
+            return no_update, no_update
+        lon, lat = feature['geometry']['coordinates']
+        return [lat, lon], feature['properties']['expansion_zoom']
+
+elif VEHICLE_TRANSPORT == 'sse':
+    ## A new route selection reconnects with that filter, and the first event is a full snapshot
+    @app.callback(
+        Output('vehicle-events', 'url'),
+        Input('route_dropdown', 'value')
+    )
+    def update_vehicle_stream(value):
+        routes = sorted(str(v) for v in value)
+        return f"/vehicles/stream?routes={','.join(routes)}" if routes else '/vehicles/stream'
+
+    app.clientside_callback(
+        """function (message) {
+            return message ? JSON.parse(message) : window.dash_clientside.no_update;
+        }""",
+        Output('vehicle-delta', 'data'),
+        Input('vehicle-events', 'message')
+    )
+else:
+    @app.callback(
+        Output(component_id='vehicle-delta', component_property= 'data'),
+        Input(component_id='interval1', component_property= 'n_intervals'),
+        Input('route_dropdown', "value"),
+        State('vehicle-version', 'data'),
+        # Input(component_id='btn', component_property='n_clicks'),
+        prevent_initial_call = False
+    )
+    @span('update_bus_interval')
+    def update_bus_interval(
+        n_intervals,
+        value,
+        client_state
+        # n_clicks
+        ):
+        print(f"Updating vehicle locations. ({dt.datetime.now().strftime('%I:%M:%S %p')})")
+        vehicle_store.update(vehicle_cache.snapshot())
+        routes = sorted(str(v) for v in value)
+
+        ## Clients only get what changed since the version they hold; a new route selection starts over
+        client_version = None
+        if client_state is not None and client_state['routes'] == routes:
+            client_version = client_state['version']
+            if client_version == vehicle_store.version:
+                return no_update
+
         # return get_bus_positions(route_ids = value)
-        return get_bus_positions_from_transitview(route_ids = value)
-    else:
-        # return get_bus_positions()
-        return get_bus_positions_from_transitview()
+        delta = vehicle_store.changes_since(client_version, route_ids = routes if len(routes) > 0 else 'all')
+        delta['routes'] = routes
+        return delta
 
+## Apply the delta to the vehicle layer in the browser
+if VEHICLE_CLUSTERS == 'client':
+    app.clientside_callback(
+        """function (delta, data) {
+            if (!delta) {
+                return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+            }
+            let features;
+            if (delta.full) {
+                features = delta.full.features;
+            } else {
+                const vehicles = new Map((data ? data.features : []).map(f => [f.id, f]));
+                delta.removed.forEach(id => vehicles.delete(id));
+                delta.changed.forEach(change => {
+                    const feature = vehicles.get(change.id);
+                    if (feature) {
+                        vehicles.set(change.id, Object.assign({}, feature, {
+                            geometry: {type: 'Point', coordinates: change.coordinates},
+                            properties: Object.assign({}, feature.properties, change.properties)
+                        }));
+                    }
+                });
+                delta.added.forEach(f => vehicles.set(f.id, f));
+                features = Array.from(vehicles.values());
+            }
+            return [{type: 'FeatureCollection', features: features}, {version: delta.version, routes: delta.routes}];
+        }""",
+        Output('geojson', 'data'),
+        Output('vehicle-version', 'data'),
+        Input('vehicle-delta', 'data'),
+        State('geojson', 'data')
+    )
 
 if __name__ == '__main__':
     app.run_server(host = "0.0.0.0", port = 8050)
\ No newline at end of file
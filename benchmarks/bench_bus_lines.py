@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import argparse
+
+import geopandas as gpd
+from shapely.geometry import Point, LineString, MultiLineString
+from shapely import ops
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from synthetic_gtfs import make_shapes
+
+def legacy_build_bus_lines(shapes):
+    ## The per-shape_id loop get_bus_lines used before build_bus_lines
+    shapes = gpd.GeoDataFrame(shapes)
+    shapes['geometry'] = shapes[["shape_pt_lon","shape_pt_lat"]].apply(Point, axis = 1)
+
+    line_list = []
+    for shape_id in shapes['shape_id'].unique():
+        line = shapes.loc[shapes['shape_id'] == shape_id,:].sort_values('shape_pt_sequence')
+        line_list.append({
+            'shape_id' : shape_id,
+            'route_id' : line['route_id'].unique()[0],
+            'route_name' : line['route_long_name'].unique()[0],
+            'geometry' : LineString(line['geometry'])
+        })
+    line_df = gpd.GeoDataFrame(line_list)
+
+    route_list = []
+    for routeid in line_df['route_id'].dropna().unique():
+        route_list.append({
+            "route_id" : routeid,
+            "route_name" :  line_df.loc[line_df['route_id'] == routeid, 'route_name'].iloc[0],
+            "geometry" : ops.linemerge(MultiLineString(line_df.loc[line_df['route_id'] == routeid,"geometry"].values))
+        })
+    return gpd.GeoDataFrame(route_list)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare legacy and vectorized shape-to-LineString builds.")
+    parser.add_argument('--shapes', type = int, default = 2000)
+    parser.add_argument('--points', type = int, default = 1000, help = "points per shape")
+    parser.add_argument('--routes', type = int, default = 150)
+    parser.add_argument('--skip-legacy', action = 'store_true')
+    args = parser.parse_args()
+
+    shapes = make_shapes(args.shapes, args.points, args.routes)
+    print(f"Synthetic shapes table: {len(shapes):,} points, {args.shapes} shapes, {args.routes} routes")
+
+    start = time.perf_counter()
+    lines = build_bus_lines(shapes)
+    new_time = time.perf_counter() - start
+    print(f"vectorized: {new_time:.2f}s ({len(lines)} routes)")
+
+    if not args.skip_legacy:
+        start = time.perf_counter()
+        legacy = legacy_build_bus_lines(shapes)
+        old_time = time.perf_counter() - start
+        print(f"legacy:     {old_time:.2f}s ({len(legacy)} routes)")
+        print(f"speedup:    {old_time / new_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_gtfs import make_transitview_payload
+from transitview import parse_transitview, columns_to_features
+from vehicle_cache import vehicle_key
+from vehicle_clusters import VehicleClusters
+
+## Server-side vehicle clustering by fleet size: build time per snapshot, query time, and
+## what a phone-sized view receives at each zoom, against sending every vehicle.
+
+def view_bbox(lon, lat, zoom, width, height, pad = 0.5, tile_size = 256):
+    ## (min_lon, min_lat, max_lon, max_lat) of a width x height pixel view centered on lon/lat,
+    ## padded by half the view on each side as application.viewport_bbox does
+    world = tile_size * 2.0 ** zoom
+    x = (lon + 180) / 360 * world
+    y = (0.5 - np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / (2 * np.pi)) * world
+    (x0, x1), (y0, y1) = [x - width * (0.5 + pad), x + width * (0.5 + pad)], [y - height * (0.5 + pad), y + height * (0.5 + pad)]
+    to_lon = lambda px: px / world * 360 - 180
+    to_lat = lambda py: np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * py / world))))
+    return to_lon(x0), to_lat(y1), to_lon(x1), to_lat(y0)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Server-side vehicle clusters by fleet size and zoom.")
+    parser.add_argument('--fleets', type = int, nargs = '+', default = [1500, 5000, 20000])
+    parser.add_argument('--zooms', type = int, nargs = '+', default = [11, 12, 13, 14, 15, 16])
+    parser.add_argument('--width', type = int, default = 400, help = "view width in pixels")
+    parser.add_argument('--height', type = int, default = 800, help = "view height in pixels")
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+
+    for fleet in args.fleets:
+        features = columns_to_features(parse_transitview(make_transitview_payload(fleet)))['features']
+        features = [{**f, 'id' : vehicle_key(f)} for f in features]
+        everything = len(json.dumps({'type' : 'FeatureCollection', 'features' : features}))
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            clusters = VehicleClusters(features)
+        build = (time.perf_counter() - start) / args.repeat
+        print(f"{len(features):,} vehicles: build {build * 1000:.1f} ms per snapshot, every vehicle is {everything / 1024:,.0f} KB")
+        for zoom in args.zooms:
+            bbox = view_bbox(-75.12, 40.0, zoom, args.width, args.height)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                collection = clusters.query(zoom, bbox)
+            query = (time.perf_counter() - start) / args.repeat
+            size = len(json.dumps(collection))
+            n_clusters = sum(1 for f in collection['features'] if f['properties'].get('cluster'))
+            print(f"  zoom {zoom:2d}: {len(collection['features']):5d} features ({n_clusters:4d} clusters), "
+                  f"{size / 1024:7.1f} KB ({size / everything:6.1%}), query {query * 1000:.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import create_gtfs_database, list_gtfs_files
+from gtfs_storage import PostgresStorage
+from synthetic_gtfs import make_feed, write_feed
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+## Needs a local Postgres; point --credentials at a scratch database, its GTFS tables are replaced
+
+def legacy_load(creds, gtfs_filepath):
+    ## The old create_gtfs_database: schema, then every file serially, no indexes
+    with psycopg2.connect(**creds) as connection:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            with open(os.path.join(REPO, 'create_gtfs_db.sql'), 'r') as f:
+                cursor.execute(f.read())
+            for file in list_gtfs_files(gtfs_filepath):
+                with open(f"{gtfs_filepath}{file}", 'r') as f:
+                    next(f)
+                    cursor.copy_from(f, file.replace(".txt",""), sep = ',')
+    connection.close()
+
+def time_query(creds, sql, repeat, params = None):
+    times = []
+    with psycopg2.connect(**creds) as connection:
+        with connection.cursor() as cursor:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+                times.append(time.perf_counter() - start)
+    connection.close()
+    return min(times), len(rows)
+
+def time_queries(creds, label, repeat):
+    ## All routes, then the three-route rebuild an incremental refresh does
+    for name in ('group_by', 'distinct_on'):
+        elapsed, rows = time_query(creds, PostgresStorage.shape_point_queries[name].format(route_filter = ""), repeat)
+        print(f"  {name:12s} all routes, {label:10s} {elapsed:6.3f}s ({rows:,} rows)")
+        elapsed, rows = time_query(creds, PostgresStorage.shape_point_queries[name].format(route_filter = "WHERE route_id = ANY(%(route_ids)s)"),
+                                   repeat, {'route_ids' : ['1', '2', '3']})
+        print(f"  {name:12s} 3 routes,   {label:10s} {elapsed:6.3f}s ({rows:,} rows)")
+
+def main():
+    parser = argparse.ArgumentParser(description = "GTFS load and get_bus_lines query times against a local Postgres.")
+    parser.add_argument('--credentials', default = os.path.join(REPO, 'credentials.json'))
+    parser.add_argument('--routes', type = int, default = 150)
+    parser.add_argument('--trips-per-shape', type = int, default = 40)
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    with open(args.credentials, 'r') as f:
+        creds = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gtfs_filepath = os.path.join(tmp, 'google_bus', '')
+        feed = make_feed(n_routes = args.routes, trips_per_shape = args.trips_per_shape)
+        write_feed(feed, gtfs_filepath)
+        print(", ".join(f"{file}: {len(df):,}" for file, df in feed.items() if file in ('shapes.txt', 'trips.txt', 'stop_times.txt')))
+
+        start = time.perf_counter()
+        legacy_load(creds, gtfs_filepath)
+        print(f"legacy serial load:                  {time.perf_counter() - start:6.2f}s")
+        time_queries(creds, 'no indexes', args.repeat)
+
+        start = time.perf_counter()
+        create_gtfs_database(os.path.join(REPO, 'create_gtfs_db.sql'), args.credentials, gtfs_filepath,
+                             os.path.join(REPO, 'create_gtfs_indexes.sql'), workers = args.workers)
+        print(f"parallel load + indexes + ANALYZE:  {time.perf_counter() - start:6.2f}s")
+        start = time.perf_counter()
+        create_gtfs_database(os.path.join(REPO, 'create_gtfs_db.sql'), args.credentials, gtfs_filepath,
+                             os.path.join(REPO, 'create_gtfs_indexes.sql'), workers = args.workers, unlogged = True)
+        print(f"  same, unlogged tables:            {time.perf_counter() - start:6.2f}s")
+        time_queries(creds, 'indexed', args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from eta_engine import ETAEngine, TIMEZONE
+from synthetic_gtfs import make_feed
+
+## ETA engine on a synthetic schedule: index build time, then the per-snapshot prediction
+## pass for a fleet of vehicles placed along their trips with known delays, and how well
+## those delays are recovered
+
+def place_stops(feed):
+    ## make_feed scatters stops at random; put each stop time's stop on its trip's shape
+    ## instead, evenly spaced, so distances along the shape follow the stop order
+    shapes = feed['shapes.txt'].sort_values(['shape_id', 'shape_pt_sequence'])
+    codes, names = pd.factorize(shapes['shape_id'])
+    lines = shapely.linestrings(shapes[['shape_pt_lon', 'shape_pt_lat']].to_numpy(), indices = codes)
+    stop_times = feed['stop_times.txt'].merge(feed['trips.txt'][['trip_id', 'shape_id']], on = 'trip_id')
+    n_stops = stop_times['stop_sequence'].max()
+    stop_times['stop_id'] = stop_times['shape_id'].astype(str) + '-' + stop_times['stop_sequence'].astype(str)
+    stops = stop_times.drop_duplicates('stop_id')
+    points = shapely.line_interpolate_point(lines[pd.Index(names).get_indexer(stops['shape_id'])],
+                                            (stops['stop_sequence'].to_numpy() - 1) / (n_stops - 1), normalized = True)
+    feed['stops.txt'] = pd.DataFrame({'stop_id' : stops['stop_id'], 'stop_lat' : shapely.get_y(points), 'stop_lon' : shapely.get_x(points)})
+    feed['stop_times.txt'] = stop_times.drop(columns = 'shape_id')
+    return feed
+
+def make_fleet(engine, day, n_vehicles, seed = 0):
+    ## Vehicles on trips running on `day`, part way between two stops, with delays of -2 to +10 minutes
+    rng = np.random.default_rng(seed)
+    trips = rng.choice(engine.active_trips(day), n_vehicles, replace = False)
+    start, end = engine.trip_offsets[trips], engine.trip_offsets[trips + 1]
+    stop_time = start + (rng.random(n_vehicles) * (end - start - 1)).astype(np.int64)
+    fraction = rng.random(n_vehicles)
+    along = engine.stop_distance[stop_time] + fraction * (engine.stop_distance[stop_time + 1] - engine.stop_distance[stop_time])
+    scheduled = engine.stop_arrival[stop_time] + fraction * (engine.stop_arrival[stop_time + 1] - engine.stop_arrival[stop_time])
+    delay = rng.integers(-120, 600, n_vehicles)
+    points = shapely.line_interpolate_point(engine.shape_lines[engine.trip_shape[trips]], along)
+    midnight = int(datetime.datetime.combine(day, datetime.time(), TIMEZONE).timestamp())
+    return (engine.trip_ids[trips].to_numpy(), shapely.get_x(points) / engine.kx, shapely.get_y(points) / engine.ky,
+            (midnight + scheduled + delay).astype(np.int64), delay)
+
+def main():
+    parser = argparse.ArgumentParser(description = "ETA engine index build and per-snapshot prediction time.")
+    parser.add_argument('--routes', type = int, default = 150)
+    parser.add_argument('--trips-per-shape', type = int, default = 40)
+    parser.add_argument('--stops-per-trip', type = int, default = 40)
+    parser.add_argument('--vehicles', type = int, default = 2000)
+    parser.add_argument('--repeat', type = int, default = 10)
+    args = parser.parse_args()
+
+    feed = place_stops(make_feed(args.routes, trips_per_shape = args.trips_per_shape, stops_per_trip = args.stops_per_trip))
+    print(f"{len(feed['trips.txt']):,} trips, {len(feed['stop_times.txt']):,} stop times, {len(feed['stops.txt']):,} stops")
+
+    start = time.perf_counter()
+    engine = ETAEngine(feed['trips.txt'], feed['stop_times.txt'], feed['shapes.txt'], feed['stops.txt'],
+                       feed['calendar.txt'], feed['calendar_dates.txt'])
+    print(f"index build:        {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    day = datetime.date(2023, 6, 14)
+    trip_ids, lons, lats, timestamps, delay = make_fleet(engine, day, args.vehicles)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        vehicles, arrivals = engine.predict(trip_ids, lons, lats, timestamps)
+    elapsed = (time.perf_counter() - start) / args.repeat * 1000
+    print(f"predict:            {elapsed:8.1f} ms per snapshot of {args.vehicles} vehicles ({len(arrivals):,} arrivals)")
+
+    error = np.abs(vehicles['delay'].to_numpy() - delay)
+    print(f"delay error:        median {np.median(error):.0f} s, 95th percentile {np.percentile(error, 95):.0f} s")
+
+    start = time.perf_counter()
+    stops = arrivals['stop_id'].unique()[:200]
+    for stop in stops:
+        arrivals.loc[arrivals['stop_id'] == stop].nsmallest(5, 'predicted')
+    print(f"next arrivals/stop: {(time.perf_counter() - start) / len(stops) * 1000:8.3f} ms/query")
+
+if __name__ == '__main__':
+    main()
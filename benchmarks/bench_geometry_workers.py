@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from route_geometry import write_lines_geojson
+from synthetic_gtfs import make_shapes
+
+## Route line build (shape merging) and geojson write of get_bus_lines by number of
+## geometry workers, checking that every worker count writes the same bytes.
+
+def main():
+    parser = argparse.ArgumentParser(description = "get_bus_lines geometry stage by worker count.")
+    parser.add_argument('--shapes', type = int, default = 2000)
+    parser.add_argument('--points', type = int, default = 1000, help = "points per shape")
+    parser.add_argument('--routes', type = int, default = 150)
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8])
+    args = parser.parse_args()
+
+    shapes = make_shapes(args.shapes, args.points, args.routes)
+    print(f"Synthetic shapes table: {len(shapes):,} points, {args.shapes} shapes, {args.routes} routes, {os.cpu_count()} CPUs")
+    directory = tempfile.mkdtemp(prefix = 'bus-geometry-')
+    baseline = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        lines = build_bus_lines(shapes, workers = workers)
+        build = time.perf_counter() - start
+        filename = os.path.join(directory, f"lines-{workers}.geojson")
+        start = time.perf_counter()
+        write_lines_geojson(lines, filename, workers = workers)
+        write = time.perf_counter() - start
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        os.remove(filename)
+        baseline = baseline or (build + write, digest)
+        print(f"{workers:3d} workers: build {build:6.2f}s, write {write:6.2f}s, total {build + write:6.2f}s "
+              f"({baseline[0] / (build + write):.1f}x), {'same bytes' if digest == baseline[1] else 'DIFFERENT bytes'}")
+    os.rmdir(directory)
+
+if __name__ == '__main__':
+    main()
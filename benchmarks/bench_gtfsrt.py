@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import argparse
+
+from google.transit import gtfs_realtime_pb2
+from google.protobuf.json_format import MessageToDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_realtime import parse_vehicle_positions, parse_trip_delays, StaticIndex, columns_to_features
+from synthetic_gtfs import make_feed, make_vehicle_positions_feed, make_trip_updates_feed
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def legacy_parse(content):
+    ## The parsing half of the old feed_to_dict: MessageToDict, then one dict per entity
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    feed_dict = MessageToDict(feed)
+    row_list = []
+    for entity in feed_dict['entity']:
+        row_list.append({
+            'id' : entity['id'],
+            'trip_id' : entity['vehicle'].get('trip',dict()).get("tripId",""),
+            'route_id' : entity['vehicle'].get('trip',dict()).get("routeId",""),
+            'latitude' : entity['vehicle']['position'].get("latitude",""),
+            'longitude' : entity['vehicle']['position'].get("longitude",""),
+            'speed' : entity['vehicle']['position'].get("speed",""),
+            'current_stop_seq' : entity['vehicle'].get('currentStopSequence',""),
+            'stop_id' : entity['vehicle'].get('stopId',"")
+        })
+    return row_list
+
+def load_fixture(name, synthesize):
+    path = os.path.join(FIXTURE_DIR, name)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read(), path
+    return synthesize(), 'synthetic'
+
+def best_of(fn, arg, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description = "GTFS-rt parse time: MessageToDict vs columnar decoding.")
+    parser.add_argument('--repeat', type = int, default = 20)
+    args = parser.parse_args()
+
+    vehicles, vehicles_source = load_fixture('bus_vehicle_position_updates.pb', make_vehicle_positions_feed)
+    trip_updates, trip_updates_source = load_fixture('bus_trip_updates.pb', make_trip_updates_feed)
+    print(f"vehicle positions: {len(vehicles):,} bytes ({vehicles_source})")
+    print(f"trip updates:      {len(trip_updates):,} bytes ({trip_updates_source})")
+
+    feed = make_feed(trips_per_shape = 40)
+    trips = feed['trips.txt'].merge(feed['routes.txt'][['route_id', 'route_long_name']], on = 'route_id', how = 'left')
+    start = time.perf_counter()
+    index = StaticIndex(trips, feed['stops.txt'])
+    print(f"static index build ({len(trips):,} trips, one time): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    columns = parse_vehicle_positions(vehicles)
+    print(f"{len(columns['trip_id'])} vehicles")
+    print(f"legacy MessageToDict parse:  {best_of(legacy_parse, vehicles, args.repeat):7.2f} ms")
+    print(f"columnar parse:              {best_of(parse_vehicle_positions, vehicles, args.repeat):7.2f} ms")
+    print(f"trip delay parse:            {best_of(parse_trip_delays, trip_updates, args.repeat):7.2f} ms")
+    print(f"static index join:           {best_of(index.join, columns, args.repeat):7.2f} ms")
+    joined = index.join(columns)
+    joined['late'] = [None] * len(joined['trip_id'])
+    print(f"features from columns:       {best_of(columns_to_features, joined, args.repeat):7.2f} ms")
+
+if __name__ == '__main__':
+    main()
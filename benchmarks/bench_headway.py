@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from line_artifact import write_line_artifact, LineArtifact
+from headway import HeadwayAnalytics
+from synthetic_gtfs import make_shapes
+
+def make_snapshot(analytics, n_vehicles, seed = 0):
+    ## Vehicles along their route's axis (with about 20m of GPS noise), half in each direction,
+    ## and minutes late as TransitView reports them
+    rng = np.random.default_rng(seed)
+    routes = np.flatnonzero(analytics.axes != None)
+    rows = rng.choice(routes, n_vehicles)
+    points = shapely.line_interpolate_point(analytics.axes[rows], rng.random(n_vehicles), normalized = True)
+    lons = shapely.get_x(points) / analytics.kx + rng.normal(0, 0.0002, n_vehicles)
+    lats = shapely.get_y(points) / analytics.ky + rng.normal(0, 0.0002, n_vehicles)
+    return {
+        'vehicles' : [str(v) for v in range(n_vehicles)],
+        'route_ids' : analytics.route_lookup[rows].to_numpy(),
+        'directions' : rng.choice(['NorthBound', 'SouthBound'], n_vehicles),
+        'lons' : lons,
+        'lats' : lats,
+        'late' : rng.integers(-2, 15, n_vehicles)
+    }
+
+def per_route(analytics, snapshot):
+    ## The same spacing and lateness stats, one route and direction at a time
+    df = pd.DataFrame({'route_id' : snapshot['route_ids'], 'direction' : snapshot['directions'],
+                       'lon' : snapshot['lons'], 'lat' : snapshot['lats'], 'late' : snapshot['late']})
+    rows = []
+    for (route_id, direction), group in df.groupby(['route_id', 'direction']):
+        axis = analytics.axes[analytics.route_lookup.get_loc(route_id)]
+        points = [shapely.Point(x * analytics.kx, y * analytics.ky) for x, y in zip(group['lon'], group['lat'])]
+        distances = sorted(axis.project(p) for p in points if axis.distance(p) <= analytics.max_offset)
+        spacing = np.diff(distances)
+        rows.append({'route_id' : route_id, 'direction' : direction, 'on_route' : len(distances),
+                     'min_spacing' : spacing.min() if len(spacing) else np.nan, 'late_median' : group['late'].median()})
+    return pd.DataFrame(rows)
+
+def timed(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser(description = "Headway and bunching analytics per vehicle snapshot.")
+    parser.add_argument('--shapes', type = int, default = 600)
+    parser.add_argument('--points', type = int, default = 300, help = "points per shape")
+    parser.add_argument('--vehicles', type = int, default = 1500)
+    parser.add_argument('--repeat', type = int, default = 20)
+    parser.add_argument('--refresh', type = float, default = 30, help = "seconds between snapshots")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix = 'bus-headway-')
+    try:
+        write_line_artifact(build_bus_lines(make_shapes(args.shapes, args.points)), os.path.join(directory, 'line_artifact'))
+        artifact = LineArtifact(os.path.join(directory, 'line_artifact'))
+        start = time.perf_counter()
+        analytics = HeadwayAnalytics.from_artifact(artifact)
+        print(f"{len(analytics.route_lookup)} routes, {len(artifact.coords):,} line points, {args.vehicles} vehicles")
+        print(f"build from artifact:       {(time.perf_counter() - start) * 1000:8.1f} ms")
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+    snapshot = make_snapshot(analytics, args.vehicles)
+    loop_ms, loop_df = timed(lambda: per_route(analytics, snapshot), max(1, args.repeat // 10))
+    vectorized_ms, (vehicle_df, route_df) = timed(lambda: analytics.analyze(**snapshot), args.repeat)
+    print(f"per route and direction:   {loop_ms:8.1f} ms")
+    print(f"vectorized:                {vectorized_ms:8.1f} ms ({loop_ms / vectorized_ms:.0f}x), "
+          f"{vectorized_ms / 1000 / args.refresh:.3%} of a core at one snapshot every {args.refresh:.0f}s")
+
+    merged = route_df.merge(loop_df, on = ['route_id', 'direction'], suffixes = ('', '_loop'))
+    print(f"{len(route_df)} route directions, {vehicle_df['on_route'].mean():.1%} of vehicles on their route, "
+          f"{int(route_df['bunched'].sum())} bunched, {int(route_df['gaps'].sum())} in front of a gap")
+    matches = [(merged[c] - merged[f"{c}_loop"]).abs().max() < 1e-6 for c in ('on_route', 'min_spacing', 'late_median')]
+    print(f"vehicles on route, min spacing and late medians match the loop: {all(matches)}")
+
+if __name__ == '__main__':
+    main()
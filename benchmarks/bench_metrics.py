@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import argparse
+import warnings
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics import span, counter, histogram, render, SamplingProfiler
+from transitview import parse_transitview, columns_to_features
+from synthetic_gtfs import make_transitview_payload
+
+## Cost of the instrumentation: a span, a counter and a histogram sample per call, alone
+## and from several threads at once, the /metrics render, and the sampling profiler's
+## slowdown of a real hot path (decoding a 2,000-vehicle TransitView snapshot).
+
+def per_call(function, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        function()
+    return (time.perf_counter() - start) / n
+
+def threaded(function, n, threads):
+    def run():
+        for _ in range(n):
+            function()
+    workers = [threading.Thread(target = run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (n * threads)
+
+def decode(payload):
+    return columns_to_features(parse_transitview(payload))
+
+def decode_uninstrumented(payload):
+    return columns_to_features.__wrapped__(parse_transitview.__wrapped__(payload))
+
+def best_of(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Overhead of metrics spans, counters and the sampling profiler.")
+    parser.add_argument('--calls', type = int, default = 200000)
+    parser.add_argument('--threads', type = int, default = 8)
+    parser.add_argument('--vehicles', type = int, default = 2000)
+    parser.add_argument('--repeat', type = int, default = 20)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore', FutureWarning)
+
+    def bare():
+        return None
+    timed = span('bench_noop')(bare)
+    requests = counter('bench_requests_total', "Benchmark counter.", labels = ('result',))
+    sizes = histogram('bench_sizes', "Benchmark histogram.", labels = ('endpoint',))
+
+    base = per_call(bare, args.calls)
+    print(f"bare call:              {base * 1e9:7.0f} ns")
+    print(f"@span call:             {per_call(timed, args.calls) * 1e9:7.0f} ns")
+    print(f"counter.inc:            {per_call(lambda: requests.inc('hit'), args.calls) * 1e9:7.0f} ns")
+    print(f"histogram.observe:      {per_call(lambda: sizes.observe(0.02, '/lines.geojson'), args.calls) * 1e9:7.0f} ns")
+    print(f"@span, {args.threads} threads:      {threaded(timed, args.calls // args.threads, args.threads) * 1e9:7.0f} ns per call")
+
+    ## A scrape with a few dozen series, like the app has
+    for i in range(40):
+        sizes.observe(i * 0.01, f"/endpoint{i}")
+    print(f"/metrics render:        {per_call(render, 200) * 1e3:7.2f} ms")
+
+    payload = make_transitview_payload(args.vehicles)
+    plain = best_of(lambda: decode_uninstrumented(payload), args.repeat)
+    spans = best_of(lambda: decode(payload), args.repeat)
+    print(f"decode {args.vehicles} vehicles:   {plain * 1e3:7.2f} ms plain, {spans * 1e3:.2f} ms with spans")
+
+    ## The profiler samples from its own thread; work on the main thread pays for the GIL
+    for interval in (0.01, 0.001):
+        profiler = SamplingProfiler(interval = interval).start()
+        profiled = best_of(lambda: decode(payload), args.repeat)
+        profiler.stop()
+        print(f"  with profiler @{1 / interval:5.0f} Hz: {profiled * 1e3:7.2f} ms ({(profiled / spans - 1) * 100:+.1f}%), {profiler.samples} samples")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import asyncio
+import argparse
+import tempfile
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stub_server import start_stub_server
+from bench_suite import make_workdir, app_environment
+from load_test import start_gunicorn
+from line_artifact import LineArtifact
+
+## Load test for /vehicles/stream: the app runs under gunicorn with the shipped
+## gunicorn.conf.py, as the Dockerfile starts it, polling the moving stub feed every
+## --interval seconds. Simulated EventSource subscribers (asyncio, one thread) spread over a
+## few route filters hold streams open while a prober times plain requests next to them, so
+## open streams that starve the worker show up as probe latency. Reports snapshot-to-receipt
+## latency, encodes per snapshot and bytes sent, next to what the same clients would cost
+## polling every 30 seconds.
+
+PROBES = ['/lines.geojson?z=13', '/metrics']
+
+async def subscriber(port, routes, connected, receipts, received, stop):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit = 2 ** 24)
+    query = f"?routes={routes}" if routes else ''
+    writer.write(f"GET /vehicles/stream{query} HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n".encode())
+    await writer.drain()
+    await reader.readuntil(b'\r\n\r\n')
+    connected[0] += 1
+    try:
+        while not stop.is_set():
+            event = await reader.readuntil(b'\n\n')
+            received[0] += len(event)
+            ## The response is chunked, so an event can follow a chunk-size line
+            start = event.find(b'id: ')
+            if start >= 0:
+                version = int(event[start + 4:event.index(b'\n', start)])
+                receipts.setdefault(version, []).append(time.time())
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def watch_snapshots(path, fetched, stop):
+    ## When each generation was fetched, from the shared snapshot file the polling worker writes
+    while not stop.is_set():
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            fetched.setdefault(snapshot['generation'], snapshot['fetched_at'])
+        except (FileNotFoundError, ValueError):
+            pass
+        await asyncio.sleep(0.05)
+
+def probe(url, seconds):
+    ## Sequential plain requests for a while: latency of everything that is not a stream
+    times = []
+    deadline = time.perf_counter() + seconds
+    with requests.Session() as session:
+        while time.perf_counter() < deadline:
+            for path in PROBES:
+                start = time.perf_counter()
+                session.get(f"{url}{path}", timeout = 30).raise_for_status()
+                times.append(time.perf_counter() - start)
+    return times
+
+def metric(url, name):
+    ## Sum of a metric over its label sets, from the worker that answers /metrics
+    text = requests.get(f"{url}/metrics", timeout = 30).text
+    return sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.split('{')[0].split(' ')[0] == name)
+
+def percentiles(times):
+    return f"p50 {np.percentile(times, 50) * 1000:.1f} ms, p95 {np.percentile(times, 95) * 1000:.1f} ms, max {np.max(times) * 1000:.1f} ms"
+
+async def run(args, url, route_ids, snapshot_path):
+    ## Filters: a share of clients on all routes, the rest on one of a few popular selections
+    random.seed(0)
+    filters = [''] + [','.join(random.sample(route_ids, 2)) for _ in range(args.groups - 1)]
+    connected, receipts, received, fetched = [0], {}, [0], {}
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_snapshots(snapshot_path, fetched, stop))
+
+    idle = await asyncio.to_thread(probe, url, 2)
+    tasks = []
+    for i in range(args.subscribers):
+        tasks.append(asyncio.create_task(subscriber(args.port, filters[i % len(filters)], connected, receipts, received, stop)))
+        if i % 100 == 99:
+            await asyncio.sleep(0.05)
+    ## Connected, and each holding the generation that was current when it connected
+    while connected[0] < args.subscribers or not receipts:
+        await asyncio.sleep(0.05)
+    print(f"{args.subscribers} subscribers connected in {len(filters)} filter groups")
+
+    first = max(receipts) + 1
+    encodes = metric(url, 'vehicle_push_encodes_total')
+    busy = await asyncio.to_thread(probe, url, args.interval * args.snapshots)
+    while max(receipts) < first + args.snapshots - 1:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1)
+    encodes = metric(url, 'vehicle_push_encodes_total') - encodes
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(watcher, *tasks, return_exceptions = True)
+
+    versions = [v for v in receipts if v >= first and v in fetched][:args.snapshots]
+    pushed = [t - fetched[v] for v in versions for t in receipts[v]]
+    print(f"snapshots pushed:      {len(versions)}, {len(pushed) / max(len(versions), 1):.0f} deliveries each")
+    if args.workers == 1:
+        print(f"encodes per snapshot:  {encodes / len(versions):.1f} (one per group, vs {args.subscribers} if encoded per client)")
+    print(f"snapshot to receipt:   {percentiles(pushed)}")
+    print(f"plain requests, idle:  {percentiles(idle)}")
+    print(f"plain requests, with {args.subscribers} streams open: {percentiles(busy)}")
+    print(f"bytes received:        {received[0] / 1e6:.1f} MB in total")
+    print(f"polling every 30s instead: {args.subscribers / 30:.0f} callback requests/s, and an average of 15 s from update to screen")
+
+def main():
+    parser = argparse.ArgumentParser(description = "SSE fan-out load test with simulated subscribers, against the app under gunicorn.")
+    parser.add_argument('--subscribers', type = int, default = 1000)
+    parser.add_argument('--groups', type = int, default = 10, help = "distinct route filters")
+    parser.add_argument('--snapshots', type = int, default = 5)
+    parser.add_argument('--interval', type = float, default = 2, help = "seconds between vehicle polls")
+    parser.add_argument('--workers', type = int, default = 1, help = "gunicorn workers (encodes are only reported for 1)")
+    parser.add_argument('--port', type = int, default = 8799)
+    args = parser.parse_args()
+
+    stub, base_url = start_stub_server(move = True)
+    workdir = tempfile.mkdtemp(prefix = 'bus-push-')
+    cwd = os.getcwd()
+    process = None
+    try:
+        os.chdir(workdir)
+        make_workdir(workdir)
+        os.chdir(cwd)
+        environment = dict(app_environment(workdir, base_url), VEHICLE_POLL_INTERVAL = str(args.interval))
+        process, url = start_gunicorn(workdir, environment, args.port, args.workers)
+        print(f"gunicorn: {args.workers} gevent workers at {url}, polling every {args.interval}s")
+        route_ids = [str(r) for r in LineArtifact(os.path.join(workdir, 'data', 'line_artifact')).routes['route_id']]
+        asyncio.run(run(args, url, route_ids, os.path.join(workdir, 'data', 'vehicle_snapshot.json')))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors = True)
+        stub.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from plotly.io.json import to_json_plotly
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from line_artifact import write_line_artifact, LineArtifact
+from synthetic_gtfs import make_shapes
+
+def per_event(fn, selections):
+    start = time.perf_counter()
+    for selection in selections:
+        fn(selection)
+    return (time.perf_counter() - start) / len(selections) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description = "CPU per route-dropdown event: GeoDataFrame.to_json vs cached fragments.")
+    parser.add_argument('--shapes', type = int, default = 1500)
+    parser.add_argument('--points', type = int, default = 500, help = "points per shape")
+    parser.add_argument('--events', type = int, default = 200)
+    args = parser.parse_args()
+
+    lines_df = build_bus_lines(make_shapes(args.shapes, args.points))
+    route_ids = lines_df['route_id'].tolist()
+    rng = np.random.default_rng(0)
+    ## Mostly small selections, with some popular combinations repeated
+    selections = [tuple(sorted(rng.choice(route_ids, rng.integers(1, 6), replace = False))) for _ in range(args.events // 4)]
+    selections = [selections[i] for i in rng.integers(0, len(selections), args.events)]
+
+    def legacy(selection):
+        ## update_bus_lines before: filter, to_json, json.loads, then Dash re-serializes the dict
+        data = json.loads(lines_df.loc[lines_df['route_id'].isin(selection), :].to_json(drop_id = True))
+        return to_json_plotly({'response' : {'lines-geojson' : {'data' : data}}})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        artifact = LineArtifact(write_line_artifact(lines_df, os.path.join(tmp, 'line_artifact')))
+
+        print(f"{args.events} dropdown events over {len(route_ids)} routes")
+        print(f"legacy to_json + loads + Dash encode: {per_event(legacy, selections):8.3f} ms/event")
+        print(f"fragments, cold LRU:                 {per_event(artifact.selection_bytes, selections):8.3f} ms/event")
+        print(f"fragments, warm LRU:                 {per_event(artifact.selection_bytes, selections):8.3f} ms/event")
+        print(f"all routes legacy:                   {per_event(legacy, [tuple(route_ids)]):8.3f} ms")
+        print(f"all routes fragments (uncached):     {per_event(artifact._selection_bytes, ['all']):8.3f} ms")
+        print(f"bytes, all routes: legacy {len(legacy(tuple(route_ids))):,} vs fragments {len(artifact.selection_bytes('all')):,}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from spatial_index import RouteSpatialIndex
+from synthetic_gtfs import make_shapes
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+def make_vehicles(lines_df, n_vehicles, seed = 0):
+    ## Vehicles somewhere along their own route, with GPS noise of about 20m
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(lines_df), n_vehicles)
+    points = shapely.line_interpolate_point(lines_df.geometry.to_numpy()[rows], rng.random(n_vehicles), normalized = True)
+    lons = shapely.get_x(points) + rng.normal(0, 0.0002, n_vehicles)
+    lats = shapely.get_y(points) + rng.normal(0, 0.0002, n_vehicles)
+    return gpd.GeoDataFrame({'route_id' : lines_df['route_id'].to_numpy()[rows]},
+                            geometry = shapely.points(lons, lats), crs = 'epsg:4326')
+
+def main():
+    parser = argparse.ArgumentParser(description = "Vehicle snapping and bbox queries: linear scan of lines_df vs RouteSpatialIndex.")
+    parser.add_argument('--shapes', type = int, default = 1500)
+    parser.add_argument('--points', type = int, default = 300, help = "points per shape")
+    parser.add_argument('--vehicles', type = int, default = 2000)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+
+    lines_df = build_bus_lines(make_shapes(args.shapes, args.points))
+    vehicles = make_vehicles(lines_df, args.vehicles)
+    print(f"{len(lines_df)} routes, {args.shapes * args.points:,} shape points, {args.vehicles} vehicles")
+
+    start = time.perf_counter()
+    index = RouteSpatialIndex.from_lines(lines_df)
+    print(f"index build:                     {(time.perf_counter() - start) * 1000:8.1f} ms ({len(index.pieces):,} pieces)")
+
+    def linear_snap():
+        ## Per vehicle: look up its route in lines_df, then the closest point on it
+        routes = lines_df.set_index('route_id').geometry
+        return [shapely.shortest_line(p, routes[r]) for r, p in zip(vehicles['route_id'], vehicles.geometry)]
+
+    linear_ms, _ = timed(linear_snap, 1)
+    indexed_ms, snapped = timed(lambda: index.snap_vehicles(vehicles), args.repeat)
+    print(f"snap, linear scan:               {linear_ms:8.1f} ms")
+    print(f"snap, spatial index (batched):   {indexed_ms:8.1f} ms ({snapped['on_route'].mean():.1%} within 50 m)")
+
+    rng = np.random.default_rng(1)
+    min_lon, min_lat, max_lon, max_lat = lines_df.total_bounds
+    boxes = []
+    for _ in range(200):
+        lon, lat = rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+        boxes.append((lon, lat, lon + 0.02, lat + 0.015))
+    linear_ms, _ = timed(lambda: [lines_df.loc[lines_df.intersects(shapely.box(*b)), 'route_id'].tolist() for b in boxes], 1)
+    indexed_ms, _ = timed(lambda: [index.routes_in_bbox(*b) for b in boxes], args.repeat)
+    print(f"bbox routes, linear scan:        {linear_ms / len(boxes):8.3f} ms/query")
+    print(f"bbox routes, spatial index:      {indexed_ms / len(boxes):8.3f} ms/query")
+
+    lons, lats = shapely.get_x(vehicles.geometry.to_numpy()), shapely.get_y(vehicles.geometry.to_numpy())
+    indexed_ms, _ = timed(lambda: index.nearest_routes(lons, lats), args.repeat)
+    print(f"nearest route, spatial index:    {indexed_ms:8.1f} ms for {args.vehicles} points")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from synthetic_gtfs import make_shapes
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+## Each snippet runs in a fresh interpreter, so import time is included
+LEGACY = """
+import json, geopandas as gpd
+lines_df = gpd.read_file({geojson!r})
+data = json.loads(lines_df.to_json(drop_id = True))
+"""
+COLD = """
+import geopandas as gpd
+from line_artifact import write_line_artifact, LineArtifact
+write_line_artifact(gpd.read_file({geojson!r}), {artifact!r})
+data = LineArtifact({artifact!r}).to_geojson()
+"""
+WARM = """
+from line_artifact import LineArtifact
+artifact = LineArtifact({artifact!r})
+"""
+WARM_GEOJSON = WARM + """
+data = artifact.to_geojson()
+"""
+
+def time_snippet(snippet, repeat, **paths):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', snippet.format(**paths)], cwd = REPO, check = True, stdout = subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Time worker startup from geojson vs the line artifact.")
+    parser.add_argument('--shapes', type = int, default = 1500)
+    parser.add_argument('--points', type = int, default = 500, help = "points per shape")
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        geojson = os.path.join(tmp, 'all_bus_lines.geojson')
+        artifact = os.path.join(tmp, 'line_artifact')
+        build_bus_lines(make_shapes(args.shapes, args.points)).to_file(geojson, driver = "GeoJSON")
+        print(f"geojson: {os.path.getsize(geojson) / 1e6:.1f} MB")
+
+        bare = time_snippet("import numpy, shapely", args.repeat)
+        print(f"interpreter + numpy/shapely import:  {bare:.3f}s")
+        print(f"legacy (read geojson, re-serialize):  {time_snippet(LEGACY, args.repeat, geojson = geojson):.3f}s")
+        print(f"cold (build artifact, then load):    {time_snippet(COLD, 1, geojson = geojson, artifact = artifact):.3f}s")
+        print(f"warm (mmap artifact):                {time_snippet(WARM, args.repeat, artifact = artifact):.3f}s")
+        print(f"warm (mmap artifact + geojson dict): {time_snippet(WARM_GEOJSON, args.repeat, artifact = artifact):.3f}s")
+
+if __name__ == '__main__':
+    main()
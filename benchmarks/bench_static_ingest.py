@@ -0,0 +1,101 @@
+import os
+import io
+import sys
+import time
+import argparse
+import tempfile
+from zipfile import ZipFile, ZIP_DEFLATED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import create_gtfs_database
+from gtfs_archive import GTFSArchive
+from gtfs_storage import PostgresStorage, SQLiteStorage
+from synthetic_gtfs import make_feed
+from metrics import DiskSampler
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+## Loading a static release (bus and rail) two ways: the old download, extract, extract
+## again and load from directories, against streaming the nested zips from memory into the
+## database. Reports wall time and the peak size of the scratch directory for each.
+## Stop names have quoted commas, which the old sep=',' copy_from could not load.
+
+def make_release(n_routes):
+    ## gtfs_public.zip bytes holding google_bus.zip and google_rail.zip
+    release = io.BytesIO()
+    with ZipFile(release, 'w', ZIP_DEFLATED) as outer:
+        for feed_name, routes, seed in (('google_bus.zip', n_routes, 0), ('google_rail.zip', 13, 1)):
+            feed = make_feed(n_routes = routes, seed = seed)
+            feed['stops.txt']['stop_name'] = 'Market St & ' + feed['stops.txt']['stop_id'].astype(str) + 'th St, Platform A'
+            inner = io.BytesIO()
+            with ZipFile(inner, 'w', ZIP_DEFLATED) as z:
+                for file, df in feed.items():
+                    z.writestr(file, df.to_csv(index = False))
+            outer.writestr(feed_name, inner.getvalue())
+    return release.getvalue()
+
+def load(archive, storage, workers):
+    create_gtfs_database(os.path.join(REPO, 'create_gtfs_db.sql'), gtfs_filepath = archive,
+                         index_file = os.path.join(REPO, 'create_gtfs_indexes.sql'), workers = workers, storage = storage)
+
+def extract_and_load(release, scratch, storages, workers):
+    ## What check_static_updates used to do, in a scratch directory
+    with open(os.path.join(scratch, 'gtfs_public.zip'), 'wb') as f:
+        f.write(release)
+    with ZipFile(os.path.join(scratch, 'gtfs_public.zip'), 'r') as zip_folder:
+        zip_folder.extractall(path = scratch)
+    for feed in ('bus', 'rail'):
+        directory = os.path.join(scratch, f"google_{feed}", '')
+        with ZipFile(os.path.join(scratch, f"google_{feed}.zip"), 'r') as feed_folder:
+            feed_folder.extractall(path = directory)
+    for feed in ('bus', 'rail'):
+        load(os.path.join(scratch, f"google_{feed}", ''), storages[feed], workers)
+    for name in os.listdir(scratch):
+        path = os.path.join(scratch, name)
+        if os.path.isdir(path):
+            for file in os.listdir(path):
+                os.remove(os.path.join(path, file))
+            os.rmdir(path)
+        else:
+            os.remove(path)
+
+def stream_and_load(release, storages, workers):
+    release = ZipFile(io.BytesIO(release))
+    for feed in ('bus', 'rail'):
+        load(GTFSArchive.from_release(release, feed), storages[feed], workers)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Static release ingest: extract to disk and load vs stream from memory.")
+    parser.add_argument('--backend', choices = ['sqlite', 'postgres'], default = 'sqlite')
+    parser.add_argument('--credentials', default = os.path.join(REPO, 'credentials.json'),
+                        help = "scratch Postgres database; its GTFS tables and rail schema are replaced")
+    parser.add_argument('--routes', type = int, default = 150)
+    parser.add_argument('--workers', type = int, default = 4)
+    args = parser.parse_args()
+
+    release = make_release(args.routes)
+    print(f"release zip: {len(release) / 1e6:.1f} MB")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scratch = os.path.join(tmp, 'scratch')
+        os.makedirs(scratch)
+        if args.backend == 'sqlite':
+            storages = dict(bus = SQLiteStorage(os.path.join(tmp, 'gtfs.sqlite')), rail = SQLiteStorage(os.path.join(tmp, 'gtfs_rail.sqlite')))
+        else:
+            storages = dict(bus = PostgresStorage(args.credentials), rail = PostgresStorage(args.credentials, schema = 'rail'))
+
+        for label, run in (('extract to disk, then load', lambda: extract_and_load(release, scratch, storages, args.workers)),
+                           ('stream from memory', lambda: stream_and_load(release, storages, args.workers))):
+            with DiskSampler(scratch) as disk:
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+            print(f"{label:28s} {elapsed:6.2f}s, peak scratch disk {disk.peak / 1e6:6.1f} MB")
+
+        stops = storages['bus'].read_sql("SELECT stop_name FROM stops LIMIT 1")['stop_name'].iloc[0]
+        rail_routes = storages['rail'].read_sql("SELECT COUNT(*) AS n FROM routes")['n'].iloc[0]
+        print(f"quoted commas kept: {stops!r}; rail routes loaded: {rail_routes}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_gtfs import make_feed, write_feed
+from stub_server import start_stub_server, stub_environment
+from results import summarize, save_results
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Microbenchmarks of the static and realtime paths and of the Dash callbacks, on a
+## synthetic feed in SQLite and the realtime feeds from stub_server.py, so runs are
+## repeatable offline. --scale multiplies shapes per route and trips per shape (and so
+## stop_times). The callbacks go through Dash's own dispatch (the Flask test client),
+## so the timings include request parsing and JSON serialization. --config picks the app
+## configuration: 'default' as shipped (SSE and server-side clusters), 'poll' for interval
+## polling with clustering in the browser. Results are saved as JSON; compare two runs
+## (of the same config) with results.py.
+
+## VEHICLE_TRANSPORT and VEHICLE_CLUSTERS of each configuration
+CONFIGS = {
+    'default' : ('sse', 'server'),
+    'poll' : ('poll', 'client'),
+}
+
+def make_workdir(directory, scale = 1.0, points_per_shape = 300, seed = 0):
+    ## A directory the app can run from: data/ holding the route colors, a SQLite database
+    ## of a synthetic feed, the route lines geojson and the line artifact. gtfs_tools reads
+    ## the colors from ./data at import, so run it from the directory
+    data = os.path.join(directory, 'data')
+    os.makedirs(data, exist_ok = True)
+    shutil.copy(os.path.join(REPO, 'data', 'route_colors.json'), data)
+
+    from gtfs_tools import create_gtfs_database, get_bus_lines
+    from gtfs_storage import SQLiteStorage
+    from line_artifact import write_line_artifact
+    feed = make_feed(shapes_per_route = max(1, round(4 * scale)), trips_per_shape = max(1, round(40 * scale)),
+                     points_per_shape = points_per_shape, seed = seed)
+    feed_dir = os.path.join(directory, 'google_bus', '')
+    write_feed(feed, feed_dir)
+    storage = SQLiteStorage(os.path.join(data, 'gtfs.sqlite'))
+    create_gtfs_database(os.path.join(REPO, 'create_gtfs_db.sql'), gtfs_filepath = feed_dir,
+                         index_file = os.path.join(REPO, 'create_gtfs_indexes.sql'), storage = storage)
+    lines = get_bus_lines(filename = os.path.join(data, 'all_bus_lines.geojson'), storage = storage)
+    write_line_artifact(lines, os.path.join(data, 'line_artifact'))
+    sizes = {file.replace('.txt', '') : len(df) for file, df in feed.items() if file in ('shapes.txt', 'trips.txt', 'stop_times.txt')}
+    return storage, sizes
+
+def app_environment(workdir, base_url, config = 'default'):
+    ## Environment for running application.py from workdir against the stub server, in one of CONFIGS
+    transport, clusters = CONFIGS[config]
+    return dict(stub_environment(base_url), GTFS_STORAGE = 'sqlite', GTFS_SQLITE_PATH = os.path.join(workdir, 'data', 'gtfs.sqlite'),
+                VEHICLE_TRANSPORT = transport, VEHICLE_CLUSTERS = clusters, STATIC_REFRESH = 'job')
+
+def callback_body(outputs, inputs, state = (), changed = None):
+    ## Body of a _dash-update-component request. outputs are (id, property) pairs, inputs and
+    ## state (id, property, value); the first input is the one that changed, unless given
+    specs = [{'id' : i, 'property' : p} for i, p in outputs]
+    return {
+        'output' : f"{outputs[0][0]}.{outputs[0][1]}" if len(outputs) == 1 else '..' + '...'.join(f"{i}.{p}" for i, p in outputs) + '..',
+        'outputs' : specs[0] if len(specs) == 1 else specs,
+        'inputs' : [{'id' : i, 'property' : p, 'value' : v} for i, p, v in inputs],
+        'state' : [{'id' : i, 'property' : p, 'value' : v} for i, p, v in state],
+        'changedPropIds' : [changed or f"{inputs[0][0]}.{inputs[0][1]}"]
+    }
+
+def random_bounds(rng, span = 0.05):
+    ## Map bounds ([[south, west], [north, east]]) of a view somewhere over Philadelphia
+    south, west = rng.uniform(39.9, 40.05), rng.uniform(-75.25, -75.05)
+    return [[south, west], [south + span * 0.6, west + span]]
+
+def route_selection(rng, route_ids, most = 3):
+    return sorted(str(r) for r in rng.choice(route_ids, int(rng.integers(1, most + 1)), replace = False))
+
+def cluster_body(rng, routes, state, changed, message = None, bounds = None, zoom = 13, selection = ()):
+    ## update_vehicle_clusters (server-side clusters over SSE) with what the client holds
+    return callback_body(
+        [('geojson', 'data'), ('vehicle-version', 'data')],
+        [('vehicle-events', 'message', message), ('map', 'bounds', bounds), ('map', 'zoom', zoom), ('route_dropdown', 'value', list(selection))],
+        state = [('vehicle-version', 'data', state.get('clusters'))], changed = changed)
+
+## Callback requests a browser sends, by name: function (rng, route ids, client state) -> body.
+## One set per configuration; the line, tooltip and popup callbacks are in both
+SHARED_CALLBACKS = {
+    'update_bus_lines (route selection)' : lambda rng, routes, state: callback_body(
+        [('lines-geojson', 'url'), ('lines-geojson', 'zoomToBounds')],
+        [('route_dropdown', 'value', route_selection(rng, routes)), ('map', 'bounds', None), ('map', 'zoom', 13)]),
+    'update_bus_lines (pan)' : lambda rng, routes, state: callback_body(
+        [('lines-geojson', 'url'), ('lines-geojson', 'zoomToBounds')],
+        [('route_dropdown', 'value', []), ('map', 'bounds', random_bounds(rng)), ('map', 'zoom', int(rng.integers(11, 16)))],
+        changed = 'map.bounds'),
+    'update_vehicle_tooltip' : lambda rng, routes, state: callback_body(
+        [('tooltip', 'children')],
+        [('geojson', 'hover_feature', {'type' : 'Feature', 'properties' : {
+            'route_id' : str(rng.choice(routes)), 'destination' : 'Somewhere', 'Direction' : 'NorthBound', 'next_stop_name' : 'Broad St',
+            'late' : 3, 'estimated_seat_availability' : 'MANY_SEATS_AVAILABLE', 'Offset' : '1', 'Offset_sec' : '20', 'timestamp' : time.time()}})]),
+    'update_line_popup' : lambda rng, routes, state: callback_body(
+        [('lines-popup', 'children')],
+        [('lines-geojson', 'click_feature', {'type' : 'Feature', 'properties' : {'route_id' : str(rng.choice(routes)), 'route_name' : 'Route'}})]),
+}
+CALLBACKS = {'default' : dict(SHARED_CALLBACKS), 'poll' : dict(SHARED_CALLBACKS)}
+CALLBACKS['poll'].update({
+    'update_bus_interval' : lambda rng, routes, state: callback_body(
+        [('vehicle-delta', 'data')],
+        [('interval1', 'n_intervals', int(rng.integers(0, 100))), ('route_dropdown', 'value', state.get('routes', []))],
+        state = [('vehicle-version', 'data', state or None)]),
+})
+CALLBACKS['default'].update({
+    'update_vehicle_clusters (pan)' : lambda rng, routes, state: cluster_body(
+        rng, routes, state, 'map.bounds', bounds = random_bounds(rng), zoom = int(rng.integers(11, 17))),
+    'update_vehicle_clusters (route selection)' : lambda rng, routes, state: cluster_body(
+        rng, routes, state, 'route_dropdown.value', selection = route_selection(rng, routes)),
+    ## What every subscriber sends when the stream announces a snapshot
+    'update_vehicle_clusters (new snapshot)' : lambda rng, routes, state: cluster_body(
+        rng, routes, state, 'vehicle-events.message', message = '{"version": 0}', bounds = state.get('bounds'), zoom = state.get('zoom', 13)),
+    'update_headway_table' : lambda rng, routes, state: callback_body(
+        [('headway-table', 'data')],
+        [('vehicle-version', 'data', state.get('clusters')), ('route_dropdown', 'value', [])]),
+    'update_vehicle_tooltip (cluster)' : lambda rng, routes, state: callback_body(
+        [('tooltip', 'children')],
+        [('geojson', 'hover_feature', {'type' : 'Feature', 'properties' : {
+            'cluster' : True, 'point_count' : 12, 'routes' : [[str(r), 4] for r in rng.choice(routes, 3)], 'other_routes' : 0}})]),
+})
+## Requests sent on every vehicle update rather than drawn from the mix
+SNAPSHOT_CALLBACKS = {'default' : ('update_vehicle_clusters (new snapshot)', 'update_headway_table'), 'poll' : ()}
+
+def vehicle_state(response_json, state):
+    ## What the browser keeps after an update_bus_interval or update_vehicle_clusters response:
+    ## the version (or cluster query) it now has
+    try:
+        response = response_json['response']
+    except (KeyError, TypeError):
+        return state
+    if 'vehicle-delta' in response:
+        delta = response['vehicle-delta']['data']
+        return {'version' : delta['version'], 'routes' : delta['routes']}
+    if 'vehicle-version' in response:
+        query = response['vehicle-version']['data']
+        return dict(state, clusters = query, zoom = query['zoom'])
+    return state
+
+def check_response(response):
+    ## A callback that fails must not be timed as a fast success: Dash answers 200 with a
+    ## body, or 204 when every output is no_update
+    if response.status_code not in (200, 204) or (response.status_code == 200 and not response.data):
+        raise RuntimeError(f"request failed: {response.status_code} {response.data[:200]!r}")
+    return response
+
+def time_runs(function, repeat, warmup = 1):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description = "Microbenchmark suite on a synthetic feed and stubbed realtime feeds.")
+    parser.add_argument('--scale', type = float, default = 1.0, help = "multiplies shapes per route and trips per shape")
+    parser.add_argument('--points', type = int, default = 300, help = "points per shape")
+    parser.add_argument('--repeat', type = int, default = 20)
+    parser.add_argument('--config', choices = list(CONFIGS), default = 'default', help = "app configuration of the callbacks")
+    parser.add_argument('--no-save', action = 'store_true')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore', FutureWarning)
+
+    stub, base_url = start_stub_server()
+    print(f"stub server {base_url}: " + ', '.join(f"{path.rsplit('/', 1)[-1]} {source}" for path, source in stub.sources.items()))
+
+    workdir = tempfile.mkdtemp(prefix = 'bus-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        os.environ.update(app_environment(workdir, base_url, args.config))
+        start = time.perf_counter()
+        storage, sizes = make_workdir(workdir, args.scale, args.points)
+        print(f"synthetic feed: {', '.join(f'{n:,} {t}' for t, n in sizes.items())}, loaded in {time.perf_counter() - start:.1f}s")
+
+        from gtfs_tools import get_bus_lines, transitview_to_df
+        from transitview import get_bus_positions_from_transitview
+        from gtfs_realtime import get_bus_positions_from_gtfsrt
+        env = stub_environment(base_url)
+
+        results = {}
+        def record(name, times):
+            results[name] = summarize(times)
+            r = results[name]
+            print(f"  {name:45s} p50 {r['p50_ms']:9.2f} ms, p99 {r['p99_ms']:9.2f} ms")
+
+        print("functions")
+        record('get_bus_lines', time_runs(lambda: get_bus_lines(filename = None, storage = storage), max(3, args.repeat // 5)))
+        record('transitview_to_df', time_runs(lambda: transitview_to_df(env['TRANSITVIEW_URL']), args.repeat))
+        record('get_bus_positions_from_transitview', time_runs(lambda: get_bus_positions_from_transitview(url = env['TRANSITVIEW_URL']), args.repeat))
+        record('get_bus_positions_from_gtfsrt', time_runs(lambda: get_bus_positions_from_gtfsrt(url = env['GTFSRT_VEHICLE_URL'], trip_updates_url = env['GTFSRT_TRIP_UPDATES_URL']), args.repeat))
+
+        print(f"callbacks (through Dash, {args.config} config: VEHICLE_TRANSPORT={CONFIGS[args.config][0]}, VEHICLE_CLUSTERS={CONFIGS[args.config][1]})")
+        import application
+        client = application.server.test_client()
+        post = lambda body: check_response(client.post('/_dash-update-component', json = body))
+        while application.vehicle_cache.snapshot() is None:
+            time.sleep(0.1)
+        route_ids = [str(r) for r in application.line_artifact.routes['route_id']]
+        rng = np.random.default_rng(0)
+        callbacks = CALLBACKS[args.config]
+        for name, make_body in callbacks.items():
+            bodies = [make_body(rng, route_ids, {}) for _ in range(args.repeat + 1)]
+            record(name, time_runs(lambda: post(bodies.pop()), args.repeat))
+        if args.config == 'poll':
+            current = {'version' : application.vehicle_store.update(application.vehicle_cache.snapshot()), 'routes' : []}
+            name = 'update_bus_interval'
+        else:
+            current = vehicle_state(post(callbacks['update_vehicle_clusters (new snapshot)'](rng, route_ids, {})).get_json(), {})
+            name = 'update_vehicle_clusters (new snapshot)'
+        record(f"{name} (no change)", time_runs(lambda: post(callbacks[name](rng, route_ids, current)), args.repeat))
+        selections = [','.join(route_selection(rng, route_ids)) for _ in range(args.repeat + 1)]
+        record('GET /lines.geojson (new selection)', time_runs(lambda: check_response(client.get(f"/lines.geojson?routes={selections.pop()}")), args.repeat))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors = True)
+        stub.shutdown()
+
+    if not args.no_save:
+        save_results('suite', dict(results, feed = sizes), args)
+
+if __name__ == '__main__':
+    main()
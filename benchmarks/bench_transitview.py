@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+
+import geopandas as gpd
+from shapely.geometry import Point
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import colors
+from transitview import parse_transitview, columns_to_features
+from synthetic_gtfs import make_transitview_payload
+
+## TransitView payload to FeatureCollection: the GeoDataFrame path (Point per row, to_json
+## then json.loads) against the column path, for all routes and for a few routes
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'transitview.json')
+
+def legacy_features(content, route_ids = 'all'):
+    ## transitview_to_df + the old get_bus_positions_from_transitview, on bytes instead of a url
+    res_dict = json.loads(content)
+    row_list = []
+    for route in res_dict['routes'][0]:
+        for vehicle in res_dict['routes'][0][route]:
+            vehicle['route_id'] = route
+            row_list.append(vehicle)
+    df = gpd.GeoDataFrame(row_list)
+    df['geometry'] = df[['lng', 'lat']].astype(float).apply(Point, axis = 1)
+    df.drop(columns = ['lat','lng','label'], inplace = True)
+    df['color'] = df['route_id'].map(colors)
+    df = df.loc[df['route_id']!='']
+    if route_ids != 'all':
+        df = df.loc[df['route_id'].isin([str(id) for id in route_ids])]
+    return json.loads(df.to_json(drop_id = True))
+
+def column_features(content, route_ids = 'all'):
+    return columns_to_features(parse_transitview(content), route_ids)
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser(description = "TransitView to GeoJSON: GeoDataFrame path vs column path.")
+    parser.add_argument('--vehicles', type = int, default = 2000, help = "synthetic payload size, when no fixture is recorded")
+    parser.add_argument('--repeat', type = int, default = 20)
+    args = parser.parse_args()
+    ## The GeoDataFrame path warns about setting geometry on every call
+    warnings.simplefilter('ignore', FutureWarning)
+
+    if os.path.exists(FIXTURE):
+        with open(FIXTURE, 'rb') as f:
+            content = f.read()
+        print(f"recorded payload {FIXTURE}")
+    else:
+        content = make_transitview_payload(args.vehicles)
+        print("synthetic payload (run record_fixtures.py to use a recorded one)")
+
+    for label, route_ids in [('all routes', 'all'), ('3 routes', ['17', '23', '47'])]:
+        legacy_ms, legacy = timed(lambda: legacy_features(content, route_ids), args.repeat)
+        column_ms, columns = timed(lambda: column_features(content, route_ids), args.repeat)
+        print(f"{label}: {len(columns['features'])} vehicles, {len(content) / 1e3:.0f} kB payload")
+        print(f"  GeoDataFrame path: {legacy_ms:7.2f} ms")
+        print(f"  column path:       {column_ms:7.2f} ms ({legacy_ms / column_ms:.1f}x)")
+        print(f"  same FeatureCollection: {legacy == columns}")
+
+if __name__ == '__main__':
+    main()
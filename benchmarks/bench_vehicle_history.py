@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from vehicle_history import VehicleHistory, read_spill
+
+## A simulated day of 30 second snapshots: ingest rate into the ring buffers (with and
+## without spilling to disk), then trail, route and replay query times
+
+def simulate_day(n_vehicles, n_routes, interval = 30, hours = 24, start = 1700000000, seed = 0):
+    rng = np.random.default_rng(seed)
+    keys = np.array([str(3000 + i) for i in range(n_vehicles)], dtype = object)
+    routes = rng.integers(1, n_routes + 1, n_vehicles).astype(str).astype(object)
+    lon = rng.uniform(-75.28, -74.96, n_vehicles)
+    lat = rng.uniform(39.87, 40.13, n_vehicles)
+    for tick in range(hours * 3600 // interval):
+        lon = lon + rng.normal(0, 0.0005, n_vehicles)
+        lat = lat + rng.normal(0, 0.0005, n_vehicles)
+        ## About 5% of vehicles did not report since the last snapshot
+        stale = rng.random(n_vehicles) < 0.05
+        timestamps = np.full(n_vehicles, start + tick * interval) - np.where(stale, interval, 0)
+        yield keys, routes, lon, lat, timestamps
+
+def ingest(history, snapshots):
+    start = time.perf_counter()
+    n = 0
+    for snapshot in snapshots:
+        history.append(*snapshot)
+        n += 1
+    return time.perf_counter() - start, n
+
+def main():
+    parser = argparse.ArgumentParser(description = "VehicleHistory ingest and query rates over a simulated day.")
+    parser.add_argument('--vehicles', type = int, default = 2000)
+    parser.add_argument('--routes', type = int, default = 150)
+    parser.add_argument('--hours', type = int, default = 24)
+    parser.add_argument('--queries', type = int, default = 200)
+    args = parser.parse_args()
+
+    snapshots = list(simulate_day(args.vehicles, args.routes, hours = args.hours))
+    end = int(snapshots[-1][4].max())
+    print(f"{len(snapshots)} snapshots of {args.vehicles} vehicles")
+
+    history = VehicleHistory()
+    elapsed, n = ingest(history, snapshots)
+    print(f"ingest, memory only:      {elapsed / n * 1000:7.2f} ms/snapshot ({n * args.vehicles / elapsed:,.0f} reports/s), "
+          f"{history.nbytes / 1e6:.1f} MB of buffers")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        spilled = VehicleHistory(spill_dir = tmp)
+        elapsed, n = ingest(spilled, snapshots)
+        size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+        print(f"ingest, with disk spill:  {elapsed / n * 1000:7.2f} ms/snapshot, {size / 1e6:.0f} MB spilled")
+        start = time.perf_counter()
+        hour = read_spill(tmp, end - 3600, end)
+        print(f"read last hour from spill: {(time.perf_counter() - start) * 1000:6.1f} ms ({len(hour):,} reports)")
+
+    ## The same day as a DataFrame per tick, the approach the ring buffers replace
+    start = time.perf_counter()
+    frames = [pd.DataFrame({'vehicle' : k, 'route_id' : r, 'lon' : x, 'lat' : y, 'timestamp' : t}) for k, r, x, y, t in snapshots[-120:]]
+    legacy = pd.concat(frames, ignore_index = True)
+    legacy_build = (time.perf_counter() - start) / len(frames) * 1000
+    print(f"legacy DataFrame per tick: {legacy_build:6.2f} ms/snapshot, {legacy.memory_usage(deep = True).sum() / 1e6:.1f} MB for the last hour")
+
+    rng = np.random.default_rng(1)
+    vehicles = rng.choice(snapshots[0][0], args.queries)
+    routes = rng.integers(1, args.routes + 1, args.queries).astype(str)
+    timed = [
+        ('vehicle trail, last 15 min', lambda i: history.trail(vehicles[i], end - 900, end)),
+        ('route trails, last 15 min', lambda i: history.trails(route_ids = [routes[i]], start = end - 900, end = end)),
+        ('replay snapshot at T', lambda i: history.snapshot_at(end - int(rng.integers(0, 3600)))),
+        ('legacy trail (DataFrame scan)', lambda i: legacy.loc[(legacy['vehicle'] == vehicles[i]) & (legacy['timestamp'] >= end - 900)]),
+    ]
+    for label, query in timed:
+        start = time.perf_counter()
+        for i in range(args.queries):
+            query(i)
+        print(f"{label:30s} {(time.perf_counter() - start) / args.queries * 1000:7.3f} ms/query")
+
+if __name__ == '__main__':
+    main()
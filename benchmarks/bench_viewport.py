@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import build_bus_lines
+from line_artifact import write_line_artifact, LineArtifact, LOD_TIERS, lod_tier
+from spatial_index import RouteSpatialIndex
+from synthetic_gtfs import make_shapes
+
+## Bytes sent for the lines layer at different map views: full geometry for every route
+## (what the app sent before) vs routes in the padded viewport at the zoom's LOD tier
+
+views = [
+    ('whole city, z11', 11, (-75.30, 39.85, -74.94, 40.15)),
+    ('city center, z13', 13, (-75.20, 39.93, -75.12, 39.98)),
+    ('neighbourhood, z15', 15, (-75.17, 39.945, -75.15, 39.955)),
+    ('street, z17', 17, (-75.165, 39.948, -75.16, 39.951)),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Lines payload per map view: full geometry vs viewport + LOD tiers.")
+    parser.add_argument('--shapes', type = int, default = 1500)
+    parser.add_argument('--points', type = int, default = 500, help = "points per shape")
+    parser.add_argument('--straight-run', type = int, default = 20, help = "points per straight street segment")
+    args = parser.parse_args()
+
+    lines_df = build_bus_lines(make_shapes(args.shapes, args.points, straight_run = args.straight_run))
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        artifact = LineArtifact(write_line_artifact(lines_df, os.path.join(tmp, 'line_artifact')))
+        print(f"artifact with {len(LOD_TIERS)} LOD tiers written in {time.perf_counter() - start:.1f}s")
+        index = RouteSpatialIndex.from_artifact(artifact)
+        full = len(artifact._selection_bytes('all'))
+
+        for label, zoom, (min_lon, min_lat, max_lon, max_lat) in views:
+            dx, dy = (max_lon - min_lon) / 2, (max_lat - min_lat) / 2
+            start = time.perf_counter()
+            in_view = tuple(sorted(index.routes_in_bbox(min_lon - dx, min_lat - dy, max_lon + dx, max_lat + dy)))
+            size = len(artifact._selection_bytes(in_view, lod_tier(zoom)))
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"{label:20s} full {full / 1e6:7.2f} MB -> {len(in_view):3d} routes, tier {lod_tier(zoom)}: "
+                  f"{size / 1e6:7.2f} MB ({full / max(size, 1):5.1f}x smaller, {elapsed:6.1f} ms uncached)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stub_server import start_stub_server
+from bench_suite import REPO, CONFIGS, CALLBACKS, SNAPSHOT_CALLBACKS, make_workdir, app_environment, vehicle_state
+from results import summarize, save_results
+from line_artifact import LineArtifact
+
+## Load test of the Dash callback endpoint: the app runs under gunicorn with the shipped
+## gunicorn.conf.py (gevent workers), as the Dockerfile starts it, on a synthetic feed with the realtime feeds from
+## stub_server.py. --clients threads each act like a browser. With --config default (as
+## shipped: SSE and server-side clusters) each client holds /vehicles/stream?notify=1 open
+## and fetches the clusters in its view and the headway table on every notice, while it
+## pans, picks routes and hovers. With --config poll it polls for vehicles with the version
+## it holds instead. Reports throughput and p50/p99 latency per callback, and saves them
+## as JSON.
+
+## Share of each request type in the mix, per configuration
+MIX = {
+    'default' : {
+        'update_vehicle_clusters (pan)' : 0.35,
+        'update_bus_lines (pan)' : 0.2,
+        'update_vehicle_clusters (route selection)' : 0.05,
+        'update_bus_lines (route selection)' : 0.05,
+        'update_vehicle_tooltip' : 0.1,
+        'update_vehicle_tooltip (cluster)' : 0.1,
+        'update_line_popup' : 0.05,
+    },
+    'poll' : {
+        'update_bus_interval' : 0.5,
+        'update_bus_lines (pan)' : 0.2,
+        'update_bus_lines (route selection)' : 0.1,
+        'update_vehicle_tooltip' : 0.15,
+        'update_line_popup' : 0.05,
+    },
+}
+
+def start_gunicorn(workdir, environment, port, workers):
+    ## The shipped gunicorn.conf.py (gevent workers), bound locally with the given worker count
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'), '--pythonpath', REPO, '--chdir', workdir,
+               '-b', f"127.0.0.1:{port}", '-w', str(workers), '--log-level', 'warning', 'application:server']
+    process = subprocess.Popen(command, env = dict(os.environ, **environment), stdout = subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode}")
+        ## gunicorn accepts connections before the workers have imported the app
+        try:
+            if requests.get(f"{url}/metrics", timeout = 5).ok:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start in time")
+
+def send(session, url, config, name, rng, route_ids, state, latencies, errors):
+    ## One timed callback request; failures are counted rather than timed. Updates the
+    ## version (or cluster query and view) the client holds
+    body = CALLBACKS[config][name](rng, route_ids, state)
+    start = time.perf_counter()
+    try:
+        response = session.post(f"{url}/_dash-update-component", json = body, timeout = 30)
+    except requests.RequestException:
+        errors[name] = errors.get(name, 0) + 1
+        return
+    elapsed = time.perf_counter() - start
+    if response.status_code not in (200, 204):
+        errors[name] = errors.get(name, 0) + 1
+        return
+    latencies.setdefault(name, []).append(elapsed)
+    if name.startswith('update_vehicle_clusters'):
+        state.update(bounds = body['inputs'][1]['value'], zoom = body['inputs'][2]['value'])
+    if name.startswith(('update_bus_interval', 'update_vehicle_clusters')) and response.status_code == 200:
+        state.update(vehicle_state(response.json(), state))
+
+def listen(url, config, route_ids, seed, state, stop, latencies, errors):
+    ## The page's EventSource: the requests of SNAPSHOT_CALLBACKS on every snapshot notice
+    rng = np.random.default_rng(seed)
+    session = requests.Session()
+    try:
+        with session.get(f"{url}/vehicles/stream?notify=1", stream = True, timeout = (5, 60)) as stream:
+            for line in stream.iter_lines():
+                if stop.is_set():
+                    break
+                if line.startswith(b'data:'):
+                    for name in SNAPSHOT_CALLBACKS[config]:
+                        send(session, url, config, name, rng, route_ids, state, latencies, errors)
+    except requests.RequestException:
+        if not stop.is_set():
+            errors['/vehicles/stream'] = errors.get('/vehicles/stream', 0) + 1
+
+def client(url, config, route_ids, seed, stop, latencies, errors):
+    ## One simulated browser, with its own connections and vehicle version
+    rng = np.random.default_rng(seed)
+    session = requests.Session()
+    names = list(MIX[config])
+    weights = np.array(list(MIX[config].values())) / sum(MIX[config].values())
+    state = {}
+    if CONFIGS[config][0] == 'sse':
+        threading.Thread(target = listen, args = (url, config, route_ids, seed + 100000, state, stop, latencies, errors), daemon = True).start()
+    while not stop.is_set():
+        send(session, url, config, names[rng.choice(len(names), p = weights)], rng, route_ids, state, latencies, errors)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load test the Dash callback endpoint under gunicorn.")
+    parser.add_argument('--clients', type = int, default = 32)
+    parser.add_argument('--duration', type = float, default = 30, help = "seconds of load after warmup")
+    parser.add_argument('--warmup', type = float, default = 5)
+    parser.add_argument('--workers', type = int, default = 4, help = "gunicorn workers")
+    parser.add_argument('--config', choices = list(CONFIGS), default = 'default', help = "app configuration, as in bench_suite.py")
+    parser.add_argument('--scale', type = float, default = 1.0, help = "synthetic feed scale, as in bench_suite.py")
+    parser.add_argument('--port', type = int, default = 8797)
+    parser.add_argument('--url', help = "load an already running app instead of starting one")
+    parser.add_argument('--no-save', action = 'store_true')
+    args = parser.parse_args()
+
+    stub, base_url = start_stub_server(move = True)
+    workdir = tempfile.mkdtemp(prefix = 'bus-load-')
+    cwd = os.getcwd()
+    process = None
+    try:
+        os.chdir(workdir)
+        _, sizes = make_workdir(workdir, args.scale)
+        os.chdir(cwd)
+        if args.url:
+            url = args.url
+        else:
+            process, url = start_gunicorn(workdir, app_environment(workdir, base_url, args.config), args.port, args.workers)
+            print(f"gunicorn: {args.workers} gevent workers at {url}, {args.config} config "
+                  f"(VEHICLE_TRANSPORT={CONFIGS[args.config][0]}, VEHICLE_CLUSTERS={CONFIGS[args.config][1]})")
+        route_ids = [str(r) for r in LineArtifact(os.path.join(workdir, 'data', 'line_artifact')).routes['route_id']]
+
+        stop = threading.Event()
+        latencies, errors = {}, {}
+        threads = [threading.Thread(target = client, args = (url, args.config, route_ids, seed, stop, latencies, errors), daemon = True)
+                   for seed in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        ## Only count what completes after warmup
+        latencies.clear()
+        errors.clear()
+        start = time.perf_counter()
+        time.sleep(args.duration)
+        elapsed = time.perf_counter() - start
+        measured = {name : list(times) for name, times in latencies.items()}
+        failed = dict(errors)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors = True)
+        stub.shutdown()
+
+    every = [t for times in measured.values() for t in times]
+    results = {'all' : dict(summarize(every), requests_per_second = round(len(every) / elapsed, 1), errors = sum(failed.values()))}
+    print(f"{len(every):,} requests in {elapsed:.0f}s from {args.clients} clients: {len(every) / elapsed:.1f} requests/s, {sum(failed.values())} errors")
+    for name, times in sorted(measured.items()):
+        results[name] = dict(summarize(times), requests_per_second = round(len(times) / elapsed, 1), errors = failed.get(name, 0))
+    for name, result in results.items():
+        print(f"  {name:40s} {result['requests_per_second']:8.1f}/s  p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms")
+    print(f"transitview polls served by the stub: {stub.requests.get('/api/TransitViewAll/index.php', 0)}")
+    if not args.no_save:
+        save_results('load', dict(results, feed = sizes), args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gtfs_tools import url_dict
+
+## Save the live SEPTA feeds to benchmarks/fixtures/ so benchmarks can replay them offline
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TRANSITVIEW_URL = "https://www3.septa.org/api/TransitViewAll/index.php"
+
+def main():
+    os.makedirs(FIXTURE_DIR, exist_ok = True)
+    feeds = dict(url_dict, transitview = TRANSITVIEW_URL)
+    for name, url in feeds.items():
+        response = requests.get(url, timeout = 30)
+        response.raise_for_status()
+        extension = 'json' if name == 'transitview' else 'pb'
+        path = os.path.join(FIXTURE_DIR, f"{name}.{extension}")
+        with open(path, 'wb') as f:
+            f.write(response.content)
+        print(f"{path}: {len(response.content):,} bytes")
+    with open(os.path.join(FIXTURE_DIR, 'RECORDED_AT'), 'w') as f:
+        f.write(time.strftime('%Y-%m-%dT%H:%M:%S%z\n'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+## Benchmark results as JSON, for comparing runs: every file records the git commit, the
+## machine and the arguments next to the timings. Compare two runs with
+##   python benchmarks/results.py benchmarks/results/suite-<before>.json benchmarks/results/suite-<after>.json
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def summarize(times):
+    ## Seconds per run -> milliseconds summary
+    times = np.asarray(times, dtype = float) * 1000
+    return {
+        'runs' : int(len(times)),
+        'mean_ms' : round(float(times.mean()), 3),
+        'min_ms' : round(float(times.min()), 3),
+        'p50_ms' : round(float(np.percentile(times, 50)), 3),
+        'p99_ms' : round(float(np.percentile(times, 99)), 3),
+    }
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = REPO, capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = REPO, capture_output = True, text = True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(name, results, args = None, directory = RESULTS_DIR):
+    os.makedirs(directory, exist_ok = True)
+    document = {
+        'name' : name,
+        'created' : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit' : git_commit(),
+        'python' : platform.python_version(),
+        'machine' : f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+        'args' : vars(args) if isinstance(args, argparse.Namespace) else args,
+        'results' : results
+    }
+    path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(document, f, indent = 2)
+    print(f"Results saved to {path}")
+    return path
+
+def compare(before_path, after_path, metric = 'p50_ms'):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['commit']} -> {after['commit']} ({metric})")
+    for key, result in after['results'].items():
+        previous = before['results'].get(key)
+        if not isinstance(result, dict) or metric not in result:
+            continue
+        if not isinstance(previous, dict) or metric not in previous:
+            print(f"  {key:45s} {'':>10s} {result[metric]:10.3f}  new")
+            continue
+        change = (result[metric] / previous[metric] - 1) * 100 if previous[metric] else float('nan')
+        print(f"  {key:45s} {previous[metric]:10.3f} {result[metric]:10.3f}  {change:+6.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare two benchmark result files.")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--metric', default = 'p50_ms')
+    args = parser.parse_args()
+    compare(args.before, args.after, args.metric)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_gtfs import make_transitview_payload, make_vehicle_positions_feed, make_trip_updates_feed
+
+## Local stand-in for SEPTA's realtime endpoints, serving the feeds recorded by
+## record_fixtures.py (or seeded synthetic ones when none are recorded) on the same paths.
+## Point the app at it with the environment variables from stub_environment(). With move,
+## every TransitView request returns the vehicles a little further along, so each poll
+## is a new snapshot with changes, as in production.
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+## path -> (fixture file, synthetic generator, content type, environment variable)
+FEEDS = {
+    '/api/TransitViewAll/index.php' : ('transitview.json', make_transitview_payload, 'application/json', 'TRANSITVIEW_URL'),
+    '/gtfsrt/septa-pa-us/Vehicle/rtVehiclePosition.pb' : ('bus_vehicle_position_updates.pb', make_vehicle_positions_feed, 'application/octet-stream', 'GTFSRT_VEHICLE_URL'),
+    '/gtfsrt/septa-pa-us/Trip/rtTripUpdates.pb' : ('bus_trip_updates.pb', make_trip_updates_feed, 'application/octet-stream', 'GTFSRT_TRIP_UPDATES_URL'),
+}
+
+def load_feeds(fixture_dir = FIXTURE_DIR):
+    ## path -> bytes, and the source of each ('recorded' or 'synthetic')
+    feeds, sources = {}, {}
+    for path, (name, synthesize, _, _) in FEEDS.items():
+        fixture = os.path.join(fixture_dir, name)
+        if os.path.exists(fixture):
+            with open(fixture, 'rb') as f:
+                feeds[path] = f.read()
+            sources[path] = 'recorded'
+        else:
+            content = synthesize()
+            feeds[path] = content.encode() if isinstance(content, str) else content
+            sources[path] = 'synthetic'
+    return feeds, sources
+
+class TransitViewMover:
+    ## Re-encodes the TransitView payload with every vehicle moved a random step
+    def __init__(self, content, seed = 0):
+        self.payload = json.loads(content)
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            for vehicles in self.payload['routes'][0].values():
+                for vehicle in vehicles:
+                    try:
+                        vehicle['lat'] = f"{float(vehicle['lat']) + self.rng.normal(0, 0.0005):.6f}"
+                        vehicle['lng'] = f"{float(vehicle['lng']) + self.rng.normal(0, 0.0005):.6f}"
+                    except (KeyError, TypeError, ValueError):
+                        pass
+            return json.dumps(self.payload).encode()
+
+class StubHandler(BaseHTTPRequestHandler):
+    ## Set on the server: feeds, content types, mover and a request counter
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        server = self.server
+        if path not in server.feeds:
+            self.send_error(404)
+            return
+        content = server.mover.next() if server.mover is not None and path == '/api/TransitViewAll/index.php' else server.feeds[path]
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        with server.lock:
+            server.requests[path] = server.requests.get(path, 0) + 1
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', FEEDS[path][2])
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+def start_stub_server(port = 0, fixture_dir = FIXTURE_DIR, move = False):
+    ## Serve in a daemon thread; returns the server and its base url
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.feeds, server.sources = load_feeds(fixture_dir)
+    server.mover = TransitViewMover(server.feeds['/api/TransitViewAll/index.php']) if move else None
+    server.requests = {}
+    server.lock = threading.Lock()
+    threading.Thread(target = server.serve_forever, name = 'stub-server', daemon = True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def stub_environment(base_url):
+    ## Environment variables that point the app's feeds at the stub server
+    return {variable : f"{base_url}{path}" for path, (_, _, _, variable) in FEEDS.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve recorded (or synthetic) SEPTA realtime feeds locally.")
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--fixtures', default = FIXTURE_DIR)
+    parser.add_argument('--move', action = 'store_true', help = "move the TransitView vehicles on every request")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.port, args.fixtures, args.move)
+    for path, source in server.sources.items():
+        print(f"{base_url}{path}: {source}, {len(server.feeds[path]):,} bytes")
+    for variable, url in stub_environment(base_url).items():
+        print(f"export {variable}={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
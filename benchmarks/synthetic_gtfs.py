@@ -0,0 +1,206 @@
+import os
+import numpy as np
+import pandas as pd
+
+## Synthetic GTFS data for benchmarks, roughly shaped like SEPTA's feed around Philadelphia
+
+def make_shapes(n_shapes = 2000, points_per_shape = 1000, n_routes = 150, seed = 0, straight_run = 1):
+    ## Returns one row per shape point, like the shapes/trips/routes join in get_bus_lines.
+    ## straight_run > 1 keeps the heading for that many points, with about 1m of GPS
+    ## jitter, which is closer to real street geometry than a pure random walk
+    rng = np.random.default_rng(seed)
+    shape_idx = np.repeat(np.arange(n_shapes), points_per_shape)
+    sequence = np.tile(np.arange(1, points_per_shape + 1), n_shapes)
+
+    ## Each shape is a random walk starting somewhere in the city
+    start_lat = rng.uniform(39.87, 40.13, n_shapes)
+    start_lon = rng.uniform(-75.28, -74.96, n_shapes)
+    steps = rng.normal(0, 0.0004, (n_shapes, points_per_shape, 2))
+    if straight_run > 1:
+        headings = rng.normal(0, 0.0004, (n_shapes, -(-points_per_shape // straight_run), 2))
+        steps = np.repeat(headings, straight_run, axis = 1)[:, :points_per_shape] + steps * 0.025
+    steps = steps.cumsum(axis = 1)
+    lat = (start_lat[:, None] + steps[:, :, 0]).ravel()
+    lon = (start_lon[:, None] + steps[:, :, 1]).ravel()
+
+    route_of_shape = rng.integers(1, n_routes + 1, n_shapes).astype(str)
+    shapes = pd.DataFrame({
+        'shape_id' : shape_idx.astype(str),
+        'shape_pt_lat' : lat,
+        'shape_pt_lon' : lon,
+        'shape_pt_sequence' : sequence,
+        'route_id' : route_of_shape[shape_idx],
+    })
+    shapes['route_long_name'] = 'Route ' + shapes['route_id']
+
+    ## Shuffle rows, the database gives no ordering guarantee
+    return shapes.sample(frac = 1, random_state = seed).reset_index(drop = True)
+
+def make_feed(n_routes = 150, shapes_per_route = 4, points_per_shape = 300, trips_per_shape = 40, stops_per_trip = 40, n_stops = 8000, seed = 0):
+    ## A complete static feed as {file name: DataFrame}, with columns in create_gtfs_db.sql order
+    rng = np.random.default_rng(seed)
+    route_ids = np.arange(1, n_routes + 1).astype(str)
+
+    feed = {}
+    feed['agency.txt'] = pd.DataFrame({
+        'agency_name' : ['SEPTA'],
+        'agency_url' : ['http://www.septa.org'],
+        'agency_timezone' : ['America/New_York'],
+        'agency_lang' : ['EN'],
+        'agency_fare_url' : ['']
+    })
+    feed['calendar.txt'] = pd.DataFrame({
+        'service_id' : ['WKDY', 'SAT', 'SUN'],
+        'monday' : [1, 0, 0], 'tuesday' : [1, 0, 0], 'wednesday' : [1, 0, 0],
+        'thursday' : [1, 0, 0], 'friday' : [1, 0, 0], 'saturday' : [0, 1, 0], 'sunday' : [0, 0, 1],
+        'start_date' : [20230101] * 3,
+        'end_date' : [20231231] * 3
+    })
+    feed['calendar_dates.txt'] = pd.DataFrame({
+        'service_id' : ['SUN', 'WKDY'],
+        'date' : [20230704, 20230704],
+        'exception_type' : [1, 2]
+    })
+    feed['routes.txt'] = pd.DataFrame({
+        'route_id' : route_ids,
+        'route_short_name' : route_ids,
+        'route_long_name' : ['Route ' + r + ' Center City to Somewhere' for r in route_ids],
+        'route_type' : 3,
+        'route_color' : 'FFFFFF',
+        'route_text_color' : '000000',
+        'route_url' : ''
+    })
+
+    shapes = make_shapes(n_routes * shapes_per_route, points_per_shape, n_routes, seed)
+    shape_route = shapes.drop_duplicates('shape_id').set_index('shape_id')['route_id']
+    feed['shapes.txt'] = shapes[['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']]
+
+    stop_ids = np.arange(1, n_stops + 1)
+    feed['stops.txt'] = pd.DataFrame({
+        'stop_id' : stop_ids,
+        'stop_name' : ['Stop ' + str(s) for s in stop_ids],
+        'stop_lat' : rng.uniform(39.87, 40.13, n_stops).round(6),
+        'stop_lon' : rng.uniform(-75.28, -74.96, n_stops).round(6),
+        'location_type' : '',
+        'parent_station' : '',
+        'zone_id' : 1,
+        'wheelchair_boarding' : 1
+    })
+
+    trip_shape = np.repeat(shape_route.index.to_numpy(), trips_per_shape)
+    n_trips = len(trip_shape)
+    trip_ids = np.arange(1, n_trips + 1).astype(str)
+    feed['trips.txt'] = pd.DataFrame({
+        'route_id' : shape_route.loc[trip_shape].to_numpy(),
+        'service_id' : rng.choice(['WKDY', 'SAT', 'SUN'], n_trips),
+        'trip_id' : trip_ids,
+        'trip_headsign' : 'Somewhere',
+        'block_id' : rng.integers(1, 5000, n_trips).astype(str),
+        'direction_id' : rng.integers(0, 2, n_trips),
+        'shape_id' : trip_shape
+    })
+
+    ## Trips start between 05:00 and 23:00, stops 1-3 minutes apart
+    start = rng.integers(5 * 3600, 23 * 3600, n_trips)
+    offsets = rng.integers(60, 180, (n_trips, stops_per_trip)).cumsum(axis = 1) - 60
+    seconds = (start[:, None] + offsets).ravel()
+    times = pd.Series([f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds])
+    feed['stop_times.txt'] = pd.DataFrame({
+        'trip_id' : np.repeat(trip_ids, stops_per_trip),
+        'arrival_time' : times,
+        'departure_time' : times,
+        'stop_id' : rng.choice(stop_ids, n_trips * stops_per_trip),
+        'stop_sequence' : np.tile(np.arange(1, stops_per_trip + 1), n_trips)
+    })
+    feed['transfers.txt'] = pd.DataFrame({
+        'from_stop_id' : stop_ids[:100],
+        'to_stop_id' : stop_ids[100:200],
+        'transfer_type' : 2,
+        'min_transfer_time' : 120
+    })
+    ## Present in SEPTA's feed, but not loaded into the database
+    feed['fare_attributes.txt'] = pd.DataFrame({'fare_id' : [1], 'price' : [2.5], 'currency_type' : ['USD']})
+    feed['fare_rules.txt'] = pd.DataFrame({'fare_id' : [1], 'origin_id' : [1], 'destination_id' : [1]})
+    return feed
+
+def write_feed(feed, path):
+    os.makedirs(path, exist_ok = True)
+    for file, df in feed.items():
+        df.to_csv(os.path.join(path, file), index = False)
+
+def make_vehicle_positions_feed(n_vehicles = 2000, n_trips = 24000, n_stops = 8000, timestamp = 1700000000, seed = 0):
+    ## Serialized GTFS-realtime VehiclePosition FeedMessage
+    from google.transit import gtfs_realtime_pb2
+
+    rng = np.random.default_rng(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+    for i in range(n_vehicles):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        vehicle = entity.vehicle
+        vehicle.vehicle.id = str(3000 + i)
+        vehicle.trip.trip_id = str(rng.integers(1, n_trips + 1))
+        vehicle.position.latitude = rng.uniform(39.87, 40.13)
+        vehicle.position.longitude = rng.uniform(-75.28, -74.96)
+        vehicle.position.bearing = rng.uniform(0, 360)
+        vehicle.position.speed = rng.uniform(0, 15)
+        vehicle.stop_id = str(rng.integers(1, n_stops + 1))
+        vehicle.current_stop_sequence = int(rng.integers(1, 40))
+        vehicle.occupancy_status = int(rng.integers(0, 4))
+        vehicle.timestamp = timestamp - int(rng.integers(0, 120))
+    return feed.SerializeToString()
+
+def make_trip_updates_feed(n_trips = 2000, timestamp = 1700000000, seed = 0):
+    ## Serialized GTFS-realtime TripUpdate FeedMessage
+    from google.transit import gtfs_realtime_pb2
+
+    rng = np.random.default_rng(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+    for i in range(1, n_trips + 1):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        update = entity.trip_update
+        update.trip.trip_id = str(i)
+        stop_time = update.stop_time_update.add()
+        stop_time.stop_sequence = int(rng.integers(1, 40))
+        stop_time.arrival.delay = int(rng.integers(-120, 900))
+    return feed.SerializeToString()
+
+def make_transitview_payload(n_vehicles = 2000, n_routes = 150, timestamp = 1700000000, seed = 0):
+    ## TransitViewAll JSON: {'routes': [{route_id: [vehicle, ...]}]}, with the API's mix of
+    ## string and numeric fields, and a few vehicles on no route
+    import json
+
+    rng = np.random.default_rng(seed)
+    route_ids = np.r_[np.arange(1, n_routes).astype(str), ['']]
+    routes = {}
+    for i in range(n_vehicles):
+        vehicle_id = str(3000 + i)
+        late = int(rng.integers(-5, 20))
+        offset = int(rng.integers(0, 180))
+        route = route_ids[rng.integers(0, len(route_ids) - 1)] if rng.random() > 0.01 else ''
+        routes.setdefault(route, []).append({
+            'lat' : f"{rng.uniform(39.87, 40.13):.6f}",
+            'lng' : f"{rng.uniform(-75.28, -74.96):.6f}",
+            'label' : vehicle_id,
+            'VehicleID' : vehicle_id,
+            'BlockID' : str(rng.integers(1000, 9000)),
+            'Direction' : str(rng.choice(['NorthBound', 'SouthBound', 'EastBound', 'WestBound'])),
+            'destination' : 'Somewhere',
+            'Offset' : str(offset // 60),
+            'heading' : int(rng.integers(0, 360)),
+            'late' : late,
+            'original_late' : late,
+            'Offset_sec' : str(offset % 60),
+            'trip' : str(rng.integers(100000, 999999)),
+            'next_stop_id' : str(rng.integers(1, 8000)),
+            'next_stop_name' : 'Some St & Other Av',
+            'next_stop_sequence' : int(rng.integers(1, 40)),
+            'estimated_seat_availability' : str(rng.choice(['MANY_SEATS_AVAILABLE', 'FEW_SEATS_AVAILABLE', 'NOT_AVAILABLE'])),
+            'timestamp' : timestamp - offset
+        })
+    return json.dumps({'routes' : [routes]}).encode()
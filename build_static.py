@@ -0,0 +1,56 @@
+import os
+import time
+import fcntl
+import threading
+
+from gtfs_tools import check_static_updates, get_lines_json
+from line_artifact import write_line_artifact, LineArtifact
+from vector_tiles import LineTiles
+from route_geometry import geometry_workers
+from gtfs_storage import get_storage
+from spatial_index import read_stops
+
+## Static GTFS refresh, run outside the web workers' import path:
+##   python build_static.py          one-shot job (e.g. before starting gunicorn, or from cron)
+##   start_background_refresh()      from a worker; only the worker holding the lock refreshes
+
+def refresh_static_data(incremental = True, geojson_filename = './data/all_bus_lines.geojson', artifact_path = './data/line_artifact',
+                        tile_zooms = range(8, 14), workers = 1, release_filename = './data/latest_static_update.json'):
+    ## workers: geometry processes; more than 1 only from this script's __main__ (see route_geometry.py)
+    check_static_updates(incremental = incremental, geometry_workers = workers)
+
+    ## Rebuild the line artifact whenever the geojson, or the release it was loaded from (the
+    ## artifact also holds the stops), is newer than it, then the low-zoom vector tiles
+    ## (higher zooms are built on first request)
+    sources = [f for f in (geojson_filename, release_filename) if os.path.exists(f)]
+    if (not os.path.exists(artifact_path)) or (not os.path.exists(geojson_filename)) or \
+            any(os.path.getmtime(f) > os.path.getmtime(os.path.realpath(artifact_path)) for f in sources):
+        write_line_artifact(get_lines_json(geojson_filename), artifact_path, workers = workers, stops = read_stops(get_storage()))
+        tiles = LineTiles(LineArtifact(artifact_path))
+        tiles.pregenerate(tile_zooms)
+        tiles.remove_stale()
+
+def start_background_refresh(interval = 6 * 60 * 60, lock_path = './data/static_refresh.lock'):
+    def run():
+        lock_file = open(lock_path, 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                ## Another worker is the leader; try again later in case it exits
+                time.sleep(interval)
+                continue
+            try:
+                refresh_static_data()
+            except Exception as e:
+                print(f"Static refresh failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target = run, name = 'static-refresh', daemon = True)
+    thread.start()
+    return thread
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    refresh_static_data(workers = geometry_workers())
+    print(f"Static data refreshed in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,9 @@
+-- Built after the bulk load in create_gtfs_database, one statement per connection in parallel
+
+CREATE INDEX shapes_shape_id_idx ON shapes (shape_id, shape_pt_sequence);
+CREATE INDEX trips_shape_id_idx ON trips (shape_id, route_id);
+CREATE INDEX trips_route_id_idx ON trips (route_id);
+CREATE INDEX stop_times_trip_id_idx ON stop_times (trip_id, stop_sequence);
+CREATE INDEX stop_times_stop_id_idx ON stop_times (stop_id);
+CREATE INDEX stops_stop_id_idx ON stops (stop_id);
+CREATE INDEX calendar_dates_service_id_idx ON calendar_dates (service_id, date);
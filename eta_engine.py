@@ -0,0 +1,250 @@
+import time
+import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from gtfs_storage import get_storage
+from spatial_index import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON
+
+## Schedule adherence and arrival predictions from stop_times, trips, shapes and calendars.
+## Everything is precomputed into flat arrays once per static release:
+##   trip_offsets      int64 (n_trips + 1) start of each trip's stop times in the arrays below
+##   stop_index        int32 stop of each stop time (into stop_ids)
+##   stop_arrival      int32 scheduled arrival, seconds after the service day's midnight
+##   stop_distance     float64 meters along the trip's shape, non-decreasing within a trip
+##   service_active    bool (n_days, n_services) whether a service runs on each date
+## so every live vehicle of a snapshot is predicted in one vectorized pass.
+
+TIMEZONE = ZoneInfo('America/New_York')
+## Stop times are also keyed as trip index * TRIP_SPAN + meters, one sorted array for all trips
+TRIP_SPAN = 1e7
+
+def gtfs_seconds(values):
+    ## HH:MM:SS strings (which may pass 24:00:00) or timedeltas (Postgres INTERVAL), as float
+    ## seconds; blank times (stops GTFS leaves untimed) are NaN
+    values = pd.Series(values)
+    present = values.dropna()
+    if pd.api.types.is_timedelta64_dtype(values) or (len(present) and isinstance(present.iloc[0], datetime.timedelta)):
+        return pd.to_timedelta(values).dt.total_seconds().to_numpy(dtype = float)
+    parts = values.astype(str).str.extract(r'^\s*(\d+):(\d\d):(\d\d)\s*$').astype(float).to_numpy()
+    return parts[:, 0] * 3600 + parts[:, 1] * 60 + parts[:, 2]
+
+def fill_untimed(seconds, trips, distance):
+    ## Times of untimed stops interpolated between the timed stops either side of them in
+    ## their trip, by distance along the shape (by stop count where distances don't differ);
+    ## stops before a trip's first or after its last timed stop take that stop's time.
+    ## Every trip must have a timed stop
+    n = len(seconds)
+    index = np.arange(n)
+    timed = ~np.isnan(seconds)
+    before = np.maximum.accumulate(np.where(timed, index, -1))
+    after = np.minimum.accumulate(np.where(timed, index, n)[::-1])[::-1]
+    has_before = (before >= 0) & (trips[np.maximum(before, 0)] == trips)
+    has_after = (after < n) & (trips[np.minimum(after, n - 1)] == trips)
+    before, after = np.where(has_before, before, after), np.where(has_after, after, before)
+
+    d0, d1 = distance[before], distance[after]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        fraction = np.where(d1 > d0, (distance - d0) / (d1 - d0), (index - before) / (after - before))
+    fraction = np.nan_to_num(np.clip(fraction, 0, 1))
+    filled = seconds[before] + fraction * (seconds[after] - seconds[before])
+    return np.round(np.where(timed, seconds, filled)).astype(np.int32)
+
+def gtfs_date(value):
+    value = int(value)
+    return datetime.date(value // 10000, value // 100 % 100, value % 100)
+
+class ETAEngine:
+    def __init__(self, trips, stop_times, shapes, stops, calendar, calendar_dates, origin_lat = 39.95):
+        self.kx = METERS_PER_DEGREE_LON * np.cos(np.radians(origin_lat))
+        self.ky = METERS_PER_DEGREE_LAT
+
+        ## Trips, and one meter-frame LineString per shape
+        trips = trips.reset_index(drop = True)
+        self.trip_ids = pd.Index(trips['trip_id'].astype(str))
+        self.trip_route = trips['route_id'].astype(str).to_numpy(dtype = object)
+        shapes = shapes.sort_values(['shape_id', 'shape_pt_sequence'])
+        shape_codes, shape_names = pd.factorize(shapes['shape_id'].astype(str))
+        self.shape_lines = shapely.linestrings(
+            np.column_stack([shapes['shape_pt_lon'].astype(float) * self.kx, shapes['shape_pt_lat'].astype(float) * self.ky]),
+            indices = shape_codes)
+        self.trip_shape = pd.Index(shape_names).get_indexer(trips['shape_id'].astype(str))
+
+        ## Services active on each date from the first to the last calendar date
+        self.service_ids = pd.Index(pd.concat([calendar['service_id'], calendar_dates['service_id']]).astype(str).unique())
+        self.trip_service = self.service_ids.get_indexer(trips['service_id'].astype(str))
+        self._build_service_days(calendar, calendar_dates)
+
+        ## Stop times of every trip, in trip order then stop_sequence
+        stop_times = stop_times.assign(trip = self.trip_ids.get_indexer(stop_times['trip_id'].astype(str)))
+        stop_times = stop_times.loc[stop_times['trip'] >= 0].sort_values(['trip', 'stop_sequence'])
+        ## Blank arrival times are filled in below; trips with no time at all are left without stops
+        arrival = gtfs_seconds(stop_times['arrival_time'])
+        timed = ~np.isnan(arrival)
+        keep = (np.bincount(stop_times['trip'].to_numpy()[timed], minlength = len(self.trip_ids)) > 0)[stop_times['trip'].to_numpy()]
+        stop_times, arrival = stop_times.loc[keep], arrival[keep]
+        self.trip_of_stop = stop_times['trip'].to_numpy()
+        self.trip_offsets = np.r_[0, np.cumsum(np.bincount(self.trip_of_stop, minlength = len(self.trip_ids)))]
+        stop_codes, stop_names = pd.factorize(stop_times['stop_id'].astype(str))
+        self.stop_ids = pd.Index(stop_names)
+        self.stop_index = stop_codes.astype(np.int32)
+        self.stop_sequence = stop_times['stop_sequence'].to_numpy(dtype = np.int32)
+
+        self.stop_distance = self._stop_distances(stops)
+        self.stop_arrival = fill_untimed(arrival, self.trip_of_stop, self.stop_distance)
+        self.trip_key = self.trip_of_stop * TRIP_SPAN + self.stop_distance
+        self.built_at = time.time()
+        ## Static release the engine was built from, set by whoever builds it
+        self.version = None
+
+    @classmethod
+    def from_storage(cls, storage = None):
+        storage = storage or get_storage()
+        return cls(
+            storage.read_table('trips', ['trip_id', 'route_id', 'service_id', 'shape_id']),
+            storage.read_table('stop_times', ['trip_id', 'arrival_time', 'stop_id', 'stop_sequence']),
+            storage.read_table('shapes', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']),
+            storage.get_stops(),
+            storage.read_table('calendar'),
+            storage.read_table('calendar_dates')
+        )
+
+    def _build_service_days(self, calendar, calendar_dates):
+        dates = [gtfs_date(d) for d in pd.concat([calendar['start_date'], calendar['end_date'], calendar_dates['date']])]
+        self.first_day = min(dates)
+        n_days = (max(dates) - self.first_day).days + 1
+        self.service_active = np.zeros((n_days, len(self.service_ids)), dtype = bool)
+
+        weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+        day_weekday = (self.first_day.weekday() + np.arange(n_days)) % 7
+        for _, row in calendar.iterrows():
+            service = self.service_ids.get_loc(str(row['service_id']))
+            start = (gtfs_date(row['start_date']) - self.first_day).days
+            end = (gtfs_date(row['end_date']) - self.first_day).days
+            runs = np.array([int(row[w]) == 1 for w in weekdays])
+            self.service_active[start:end + 1, service] = runs[day_weekday[start:end + 1]]
+        ## exception_type 1 adds service on a date, 2 removes it
+        days = np.array([(gtfs_date(d) - self.first_day).days for d in calendar_dates['date']], dtype = np.int64)
+        services = self.service_ids.get_indexer(calendar_dates['service_id'].astype(str))
+        self.service_active[days, services] = calendar_dates['exception_type'].astype(int).to_numpy() == 1
+
+    def _stop_distances(self, stops):
+        ## Meters along the trip's shape of each stop time. Each distinct (shape, stop) pair is
+        ## projected once, and distances are made non-decreasing within a trip so loops and
+        ## stops set back from the street cannot send a trip backwards
+        positions = pd.Index(stops['stop_id'].astype(str)).get_indexer(self.stop_ids)
+        stop_x = np.where(positions >= 0, stops['stop_lon'].astype(float).to_numpy()[positions] * self.kx, np.nan)
+        stop_y = np.where(positions >= 0, stops['stop_lat'].astype(float).to_numpy()[positions] * self.ky, np.nan)
+
+        shape = self.trip_shape[self.trip_of_stop]
+        pairs, inverse = np.unique(shape.astype(np.int64) * len(self.stop_ids) + self.stop_index, return_inverse = True)
+        pair_shape, pair_stop = pairs // len(self.stop_ids), pairs % len(self.stop_ids)
+        located = (pair_shape >= 0) & ~np.isnan(stop_x[pair_stop])
+        distance = np.zeros(len(pairs))
+        distance[located] = shapely.line_locate_point(self.shape_lines[pair_shape[located]],
+                                                       shapely.points(stop_x[pair_stop[located]], stop_y[pair_stop[located]]))
+        distance = distance[inverse]
+        offset = self.trip_of_stop * TRIP_SPAN
+        return np.maximum.accumulate(offset + distance) - offset
+
+    def service_days(self, timestamps):
+        ## Local service date (as an index into service_active) and its midnight as an epoch
+        local = pd.to_datetime(np.asarray(timestamps, dtype = np.int64), unit = 's', utc = True).tz_convert(TIMEZONE)
+        midnight = local.normalize()
+        days = np.asarray((midnight.tz_localize(None) - pd.Timestamp(self.first_day)).days, dtype = np.int64)
+        return days, np.asarray((midnight - pd.Timestamp(0, tz = 'UTC')) // pd.Timedelta(seconds = 1), dtype = np.int64)
+
+    def trip_active(self, trips, days):
+        inside = (days >= 0) & (days < len(self.service_active)) & (trips >= 0)
+        active = np.zeros(len(trips), dtype = bool)
+        active[inside] = self.service_active[days[inside], self.trip_service[trips[inside]]]
+        return active
+
+    def active_trips(self, day):
+        ## Indexes of the trips running on a date
+        index = (day - self.first_day).days
+        if index < 0 or index >= len(self.service_active):
+            return np.empty(0, dtype = np.int64)
+        return np.flatnonzero(self.service_active[index, self.trip_service] & (self.trip_service >= 0))
+
+    def predict(self, trip_ids, lons, lats, timestamps, vehicles = None):
+        ## Schedule adherence of every vehicle, and predicted arrivals at every stop still
+        ## ahead of it on its trip. Returns (vehicles, arrivals) DataFrames; delay is in
+        ## seconds (positive is late) and the current delay is carried to every later stop
+        n = len(trip_ids)
+        vehicles = np.arange(n) if vehicles is None else np.asarray(vehicles, dtype = object)
+        trips = self.trip_ids.get_indexer(pd.Index([str(t) for t in trip_ids], dtype = object))
+        known = trips >= 0
+        known[known] = (self.trip_shape[trips[known]] >= 0) & (self.trip_offsets[trips[known] + 1] > self.trip_offsets[trips[known]])
+        v = np.flatnonzero(known)
+        trips = trips[v]
+        timestamps = np.asarray(timestamps, dtype = np.int64)[v]
+
+        ## Where each vehicle is along its trip, and the stops either side of it
+        points = shapely.points(np.asarray(lons, dtype = float)[v] * self.kx, np.asarray(lats, dtype = float)[v] * self.ky)
+        along = shapely.line_locate_point(self.shape_lines[self.trip_shape[trips]], points)
+        start, end = self.trip_offsets[trips], self.trip_offsets[trips + 1]
+        upcoming = np.clip(np.searchsorted(self.trip_key, trips * TRIP_SPAN + along, side = 'right'), start, end)
+        previous = np.maximum(upcoming - 1, start)
+        following = np.minimum(upcoming, end - 1)
+
+        ## Scheduled time at the vehicle's position, interpolated between those stops
+        d0, d1 = self.stop_distance[previous], self.stop_distance[following]
+        t0, t1 = self.stop_arrival[previous].astype(float), self.stop_arrival[following].astype(float)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fraction = np.where(d1 > d0, np.clip((along - d0) / (d1 - d0), 0, 1), 0)
+        scheduled = t0 + fraction * (t1 - t0)
+
+        ## Trips after midnight belong to the previous service day; pick the active service
+        ## day that gives the smaller delay
+        days, midnight = self.service_days(timestamps)
+        since_midnight = timestamps - midnight
+        delay_today = since_midnight - scheduled
+        delay_yesterday = since_midnight + 86400 - scheduled
+        active_today = self.trip_active(trips, days)
+        active_yesterday = self.trip_active(trips, days - 1)
+        yesterday = active_yesterday & (~active_today | (np.abs(delay_yesterday) < np.abs(delay_today)))
+        delay = np.where(yesterday, delay_yesterday, delay_today)
+        service_midnight = np.where(yesterday, midnight - 86400, midnight)
+
+        vehicle_df = pd.DataFrame({
+            'vehicle' : vehicles[v],
+            'trip_id' : self.trip_ids[trips],
+            'route_id' : self.trip_route[trips],
+            'delay' : np.round(delay).astype(np.int64),
+            'in_service' : active_today | active_yesterday,
+            'distance_along' : along,
+            'next_stop_id' : np.where(upcoming < end, self.stop_ids.to_numpy()[self.stop_index[following]], None)
+        })
+
+        ## Every remaining stop of every vehicle, laid out flat
+        counts = end - upcoming
+        owner = np.repeat(np.arange(len(v)), counts)
+        stop_time = np.repeat(upcoming - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(counts.sum())
+        scheduled_arrival = service_midnight[owner] + self.stop_arrival[stop_time]
+        arrivals = pd.DataFrame({
+            'vehicle' : vehicles[v][owner],
+            'trip_id' : self.trip_ids[trips[owner]],
+            'route_id' : self.trip_route[trips[owner]],
+            'stop_id' : self.stop_ids.to_numpy()[self.stop_index[stop_time]],
+            'stop_sequence' : self.stop_sequence[stop_time],
+            'scheduled' : scheduled_arrival,
+            'predicted' : scheduled_arrival + np.round(delay[owner]).astype(np.int64)
+        })
+        return vehicle_df, arrivals
+
+    def predict_features(self, collection, fetched_at = None):
+        ## Vehicle FeatureCollection (TransitView or GTFS-realtime) to predict()
+        from vehicle_cache import vehicle_key
+        features = collection['features']
+        fetched_at = int(fetched_at or time.time())
+        coordinates = np.array([f['geometry']['coordinates'] for f in features], dtype = float).reshape(-1, 2)
+        return self.predict(
+            [f['properties'].get('trip') for f in features],
+            coordinates[:, 0], coordinates[:, 1],
+            [f['properties'].get('timestamp') or fetched_at for f in features],
+            vehicles = [vehicle_key(f) for f in features]
+        )
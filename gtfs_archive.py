@@ -0,0 +1,55 @@
+import io
+import os
+from zipfile import ZipFile
+
+## Static GTFS files, from an extracted directory or straight from SEPTA's release zip.
+## The release (gtfs_public.zip) holds one zip per feed, google_bus.zip and google_rail.zip.
+## The release and the inner feed zip are kept in memory and every member is read as a
+## decompressing stream, so loading a release writes nothing to disk but the database.
+
+RELEASE_FEEDS = dict(bus = 'google_bus.zip', rail = 'google_rail.zip')
+
+class GTFSArchive:
+    def __init__(self, directory = None, zip_file = None, name = None):
+        self.directory = directory
+        self.zip_file = zip_file
+        self.name = name or directory
+
+    @classmethod
+    def from_release(cls, release, feed = 'bus'):
+        ## release: the release zip as bytes, or an open ZipFile
+        if isinstance(release, (bytes, bytearray)):
+            release = ZipFile(io.BytesIO(release))
+        inner = ZipFile(io.BytesIO(release.read(RELEASE_FEEDS[feed])))
+        return cls(zip_file = inner, name = RELEASE_FEEDS[feed])
+
+    def files(self):
+        ## .txt files at the top level of the feed, sorted
+        if self.zip_file is not None:
+            names = [info.filename for info in self.zip_file.infolist() if not info.is_dir()]
+        else:
+            names = os.listdir(self.directory)
+        return sorted(name for name in names if name.endswith('.txt') and '/' not in name)
+
+    def open(self, file):
+        ## Binary stream of one file; zip members are decompressed as they are read
+        if self.zip_file is not None:
+            return self.zip_file.open(file)
+        return open(os.path.join(self.directory, file), 'rb')
+
+    def open_text(self, file):
+        ## Text stream for the csv module, without any UTF-8 byte order mark
+        return io.TextIOWrapper(self.open(file), encoding = 'utf-8-sig', newline = '')
+
+    def path(self, file):
+        ## Filesystem path of a file, or None for zip members
+        return None if self.zip_file is not None else os.path.join(self.directory, file)
+
+    def size(self, file):
+        if self.zip_file is not None:
+            return self.zip_file.getinfo(file).file_size
+        return os.path.getsize(self.path(file))
+
+def gtfs_archive(gtfs_filepath):
+    ## gtfs_filepath arguments take an extracted directory or a GTFSArchive
+    return gtfs_filepath if isinstance(gtfs_filepath, GTFSArchive) else GTFSArchive(directory = gtfs_filepath)
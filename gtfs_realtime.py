@@ -0,0 +1,191 @@
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+from google.transit import gtfs_realtime_pb2
+
+from gtfs_tools import url_dict, colors
+from gtfs_storage import get_storage
+from http_client import fetch, fetch_all
+from metrics import span
+
+## GTFS-realtime ingestion straight from the FeedMessage into columns.
+## Entities are read field by field into preallocated arrays (no MessageToDict,
+## no per-entity dicts), and static trip/route/stop data is joined from an
+## in-memory index that is loaded once, not queried per request.
+
+occupancy_names = {v.number : v.name for v in gtfs_realtime_pb2.VehiclePosition.OccupancyStatus.DESCRIPTOR.values}
+
+def parse_vehicle_positions(content):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+
+    n = len(feed.entity)
+    columns = dict(
+        vehicle_id = np.empty(n, dtype = object),
+        trip_id = np.empty(n, dtype = object),
+        route_id = np.empty(n, dtype = object),
+        stop_id = np.empty(n, dtype = object),
+        latitude = np.full(n, np.nan),
+        longitude = np.full(n, np.nan),
+        bearing = np.full(n, np.nan),
+        speed = np.zeros(n),
+        current_stop_sequence = np.zeros(n, dtype = np.int64),
+        occupancy_status = np.full(n, -1, dtype = np.int64),
+        timestamp = np.zeros(n, dtype = np.int64)
+    )
+    keep = np.zeros(n, dtype = bool)
+    for i, entity in enumerate(feed.entity):
+        if not entity.HasField('vehicle'):
+            continue
+        vehicle = entity.vehicle
+        keep[i] = True
+        columns['vehicle_id'][i] = vehicle.vehicle.id or entity.id
+        columns['trip_id'][i] = vehicle.trip.trip_id
+        columns['route_id'][i] = vehicle.trip.route_id
+        columns['stop_id'][i] = vehicle.stop_id
+        position = vehicle.position
+        columns['latitude'][i] = position.latitude
+        columns['longitude'][i] = position.longitude
+        if position.HasField('bearing'):
+            columns['bearing'][i] = position.bearing
+        columns['speed'][i] = position.speed
+        columns['current_stop_sequence'][i] = vehicle.current_stop_sequence
+        if vehicle.HasField('occupancy_status'):
+            columns['occupancy_status'][i] = vehicle.occupancy_status
+        columns['timestamp'][i] = vehicle.timestamp or feed.header.timestamp
+
+    columns = {k : v[keep] for k, v in columns.items()}
+    columns['feed_timestamp'] = feed.header.timestamp
+    return columns
+
+def parse_trip_delays(content):
+    ## Delay (seconds) of the first stop time update of every trip
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+
+    trip_ids = []
+    delays = []
+    for entity in feed.entity:
+        if not entity.HasField('trip_update'):
+            continue
+        update = entity.trip_update
+        delay = update.delay if update.HasField('delay') else None
+        if delay is None and len(update.stop_time_update) > 0:
+            first = update.stop_time_update[0]
+            event = first.arrival if first.HasField('arrival') else first.departure
+            delay = event.delay
+        if delay is not None:
+            trip_ids.append(update.trip.trip_id)
+            delays.append(delay)
+    return dict(trip_id = np.array(trip_ids, dtype = object), delay = np.array(delays, dtype = np.int64))
+
+class StaticIndex:
+    """Trip, route and stop lookups for joining realtime data, built from one read of each table."""
+
+    def __init__(self, trips, stops):
+        ## trips: trip_id, route_id, direction_id, trip_headsign, route_long_name; stops: stop_id, stop_name
+        self.trip_index = pd.Index(trips['trip_id'].astype(str))
+        self.trip_route_id = trips['route_id'].astype(str).to_numpy(dtype = object)
+        self.trip_direction = np.array(trips['direction_id'].tolist(), dtype = object)
+        self.trip_headsign = trips['trip_headsign'].to_numpy(dtype = object)
+        self.trip_route_name = trips['route_long_name'].to_numpy(dtype = object)
+        self.stop_index = pd.Index(stops['stop_id'].astype(str))
+        self.stop_name = stops['stop_name'].to_numpy(dtype = object)
+        self.loaded_at = time.time()
+
+    @classmethod
+    def from_storage(cls, storage = None):
+        storage = storage or get_storage()
+        return cls(storage.get_trips(), storage.get_stops())
+
+    @staticmethod
+    def _take(values, positions):
+        out = np.full(len(positions), None, dtype = object)
+        found = positions >= 0
+        out[found] = values[positions[found]]
+        return out
+
+    def join(self, columns):
+        trips = self.trip_index.get_indexer(columns['trip_id'])
+        stops = self.stop_index.get_indexer(columns['stop_id'])
+        route_id = self._take(self.trip_route_id, trips)
+        ## Prefer the route in the trip descriptor, fall back to the schedule's
+        route_id = np.where(columns['route_id'] != '', columns['route_id'], route_id)
+        return dict(
+            columns,
+            route_id = route_id,
+            direction_id = self._take(self.trip_direction, trips),
+            trip_headsign = self._take(self.trip_headsign, trips),
+            route_name = self._take(self.trip_route_name, trips),
+            stop_name = self._take(self.stop_name, stops)
+        )
+
+_static_index = None
+_static_index_lock = threading.Lock()
+
+def get_static_index(max_age = 24 * 60 * 60):
+    global _static_index
+    with _static_index_lock:
+        if _static_index is None or time.time() - _static_index.loaded_at > max_age:
+            _static_index = StaticIndex.from_storage()
+        return _static_index
+
+def gtfsrt_to_columns(vehicle_url = url_dict['bus_vehicle_position_updates'], trip_updates_url = url_dict['bus_trip_updates'], static_index = None):
+    ## Both feeds are fetched concurrently over the shared connection pool
+    if trip_updates_url is not None:
+        vehicles, trip_updates = fetch_all([vehicle_url, trip_updates_url])
+    else:
+        vehicles, trip_updates = fetch(vehicle_url), None
+    columns = parse_vehicle_positions(vehicles.content)
+    columns = (static_index or get_static_index()).join(columns)
+
+    columns['late'] = np.full(len(columns['trip_id']), None, dtype = object)
+    if trip_updates is not None:
+        delays = parse_trip_delays(trip_updates.content)
+        delays = pd.Series(delays['delay'], index = delays['trip_id'])
+        delays = delays[~delays.index.duplicated()]
+        positions = delays.index.get_indexer(columns['trip_id'])
+        found = positions >= 0
+        columns['late'][found] = np.round(delays.to_numpy()[positions[found]] / 60).astype(int).tolist()
+    return columns
+
+def columns_to_features(columns, route_ids = 'all', now = None):
+    ## Same properties as the TransitView features the map tooltip reads
+    keep = columns['route_id'] != None
+    keep &= columns['route_id'] != ''
+    if route_ids != 'all':
+        if type(route_ids) in (str, int):
+            route_ids = [route_ids]
+        keep &= np.isin(columns['route_id'], [str(id) for id in route_ids])
+    now = time.time() if now is None else now
+    offset = np.maximum(now - columns['timestamp'], 0).astype(np.int64)
+
+    features = []
+    for i in np.flatnonzero(keep):
+        occupancy = columns['occupancy_status'][i]
+        features.append({
+            'type' : 'Feature',
+            'properties' : {
+                'route_id' : columns['route_id'][i],
+                'VehicleID' : columns['vehicle_id'][i],
+                'trip' : columns['trip_id'][i],
+                'destination' : columns['trip_headsign'][i],
+                'Direction' : columns['direction_id'][i],
+                'next_stop_name' : columns['stop_name'][i],
+                'late' : columns['late'][i],
+                'estimated_seat_availability' : occupancy_names.get(int(occupancy), None),
+                'Offset' : int(offset[i] // 60),
+                'Offset_sec' : int(offset[i] % 60),
+                'timestamp' : int(columns['timestamp'][i]),
+                'color' : colors.get(columns['route_id'][i])
+            },
+            'geometry' : {'type' : 'Point', 'coordinates' : [float(columns['longitude'][i]), float(columns['latitude'][i])]}
+        })
+    return {'type' : 'FeatureCollection', 'features' : features}
+
+@span('get_bus_positions_from_gtfsrt')
+def get_bus_positions_from_gtfsrt(route_ids = 'all', url = url_dict['bus_vehicle_position_updates'], trip_updates_url = url_dict['bus_trip_updates']):
+    print("Getting current bus locations from GTFS-realtime ...")
+    return columns_to_features(gtfsrt_to_columns(url, trip_updates_url), route_ids)
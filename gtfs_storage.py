@@ -0,0 +1,445 @@
+import os
+import io
+import csv
+import json
+import sqlite3
+import itertools
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import psycopg2
+
+from gtfs_archive import gtfs_archive
+
+## Where static GTFS data lives. Both backends have the same loading and query
+## methods, so gtfs_tools and the apps never write backend-specific SQL:
+##   GTFS_STORAGE=postgres (default)  server from credentials.json
+##   GTFS_STORAGE=sqlite              embedded file at GTFS_SQLITE_PATH, no server needed
+## The rail feed is kept apart from bus: the `rail` schema in Postgres, a *_rail.sqlite file in SQLite.
+
+def read_sql_statements(sql_file):
+    with open(sql_file, 'r') as f:
+        sql = ''.join(line for line in f if not line.lstrip().startswith('--'))
+    return [statement.strip() for statement in sql.split(';') if statement.strip()]
+
+class FileRange:
+    ## Read-only view of bytes [start, end) of an open file, for COPYing part of a file
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self.f = f
+        self.remaining = end - start
+
+    def read(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.readline(size)
+        self.remaining -= len(data)
+        return data
+
+def read_csv_header(f):
+    ## Column names from the first line of a binary CSV stream
+    return [column.strip() for column in next(csv.reader([f.readline().decode('utf-8-sig')]))]
+
+class CSVColumnStream:
+    ## Readable stream of the rows of a binary CSV stream with only the columns at `keep`,
+    ## for COPYing files that have columns the table does not
+    def __init__(self, f, keep):
+        self.rows = csv.reader(line.decode('utf-8') for line in iter(f.readline, b''))
+        self.keep = keep
+        self.buffer = b''
+
+    def read(self, size = -1):
+        while size < 0 or len(self.buffer) < size:
+            rows = list(itertools.islice(self.rows, 1000))
+            if not rows:
+                break
+            out = io.StringIO()
+            csv.writer(out, lineterminator = '\n').writerows([row[i] if i < len(row) else '' for i in self.keep] for row in rows)
+            self.buffer += out.getvalue().encode()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+def split_gtfs_file(path, chunk_bytes = 16 * 1024 * 1024):
+    ## Byte ranges of whole lines, after the header row, each about chunk_bytes long
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        boundaries = [f.tell()]
+        for target in range(boundaries[0] + chunk_bytes, size, chunk_bytes):
+            if target <= boundaries[-1]:
+                continue
+            f.seek(target)
+            f.readline()
+            if f.tell() < size:
+                boundaries.append(f.tell())
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+class PostgresStorage:
+    name = 'postgres'
+
+    ## One row per shape point with its route. 'group_by' is the original query, which
+    ## deduplicates the shapes x trips join; 'distinct_on' picks one route per shape from
+    ## trips first (an index scan on trips_shape_id_idx) and never groups the shapes table.
+    shape_point_queries = dict(
+        group_by = """
+            SELECT * FROM (
+                SELECT s.*, t.route_id, r.route_long_name
+                FROM shapes AS s
+                LEFT JOIN trips AS t ON t.shape_id = s.shape_id
+                LEFT JOIN routes AS r ON r.route_id = t.route_id
+                GROUP BY s.shape_id, shape_pt_lat, shape_pt_lon,
+                shape_pt_sequence, t.route_id, r.route_long_name
+            ) AS shape_points
+            {route_filter}
+        """,
+        distinct_on = """
+            SELECT s.shape_id, s.shape_pt_lat, s.shape_pt_lon, s.shape_pt_sequence, sr.route_id, r.route_long_name
+            FROM shapes AS s
+            JOIN (
+                SELECT DISTINCT ON (shape_id) shape_id, route_id
+                FROM trips
+                ORDER BY shape_id, route_id
+            ) AS sr ON sr.shape_id = s.shape_id
+            LEFT JOIN routes AS r USING (route_id)
+            {route_filter}
+        """
+    )
+
+    def __init__(self, credentials_path = 'credentials.json', schema = None):
+        self.credentials_path = credentials_path
+        self.schema = schema
+        self._creds = None
+
+    @property
+    def creds(self):
+        ## Read on first use, so importing the app does not need credentials.json
+        if self._creds is None:
+            with open(self.credentials_path, 'r') as f:
+                self._creds = json.load(f)
+        return self._creds
+
+    def connect(self):
+        if self.schema is None:
+            return psycopg2.connect(**self.creds)
+        ## Only the feed's own schema is searched, so the schema file's DROP TABLE IF EXISTS
+        ## statements never reach the tables in public
+        return psycopg2.connect(**self.creds, options = f"-c search_path={self.schema}")
+
+    def execute(self, statement, params = None):
+        with self.connect() as connection:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(statement, params)
+        connection.close()
+        return statement
+
+    def read_sql(self, sql, params = None):
+        with self.connect() as connection:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                column_names = [d[0] for d in cursor.description]
+                df = pd.DataFrame(cursor.fetchall(), columns = column_names)
+        connection.close()
+        return df
+
+    ## Loading
+
+    def create_tables(self, schema_file, tables, unlogged = False):
+        with self.connect() as connection:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                if self.schema is not None:
+                    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {self.schema}")
+                with open(schema_file, 'r') as f:
+                    cursor.execute(f.read())
+                ## Unlogged tables skip the WAL, but Postgres empties them after a crash
+                if unlogged:
+                    for table in tables:
+                        cursor.execute(f"ALTER TABLE {table} SET UNLOGGED")
+        connection.close()
+
+    @staticmethod
+    def _copy_csv(cursor, table, f, header = None):
+        ## COPY in CSV format, so quoted fields with commas or quotes load intact. Columns are
+        ## matched by the file's header (read from f unless given) and unknown ones are dropped
+        header = read_csv_header(f) if header is None else header
+        cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped", (table,))
+        table_columns = {row[0] for row in cursor.fetchall()}
+        keep = [i for i, column in enumerate(header) if column in table_columns]
+        if len(keep) < len(header):
+            f = CSVColumnStream(f, keep)
+        columns = ', '.join(f'"{header[i]}"' for i in keep)
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", f, size = 1024 * 1024)
+
+    def copy_file_range(self, table, path, start, end, header):
+        ## One connection per chunk, so large files and several files can be COPYed at once
+        with self.connect() as connection:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                with open(path, 'rb') as f:
+                    self._copy_csv(cursor, table, FileRange(f, start, end), header)
+        connection.close()
+        return table
+
+    def copy_stream(self, table, archive, file):
+        ## A whole file as one COPY, decompressing zip members as they are sent
+        with self.connect() as connection:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                with archive.open(file) as f:
+                    self._copy_csv(cursor, table, f)
+        connection.close()
+        return table
+
+    def load_files(self, gtfs_filepath, file_list, workers = 4):
+        ## Files on disk are split into chunks; zip members are streamed whole, several at once.
+        ## The biggest pieces go first so they start earliest
+        archive = gtfs_archive(gtfs_filepath)
+        jobs = []
+        for file in file_list:
+            table = file.replace(".txt","")
+            path = archive.path(file)
+            if path is None:
+                jobs.append((archive.size(file), partial(self.copy_stream, table, archive, file)))
+                continue
+            with open(path, 'rb') as f:
+                header = read_csv_header(f)
+            for start, end in split_gtfs_file(path):
+                jobs.append((end - start, partial(self.copy_file_range, table, path, start, end, header)))
+        jobs = sorted(jobs, key = lambda job: job[0], reverse = True)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(lambda job: job[1](), jobs))
+        return len(jobs)
+
+    def create_indexes(self, index_file, workers = 4):
+        statements = read_sql_statements(index_file)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(self.execute, statements))
+        return len(statements)
+
+    def analyze(self):
+        self.execute("ANALYZE")
+
+    def replace_table(self, table, f):
+        ## Load a binary CSV stream into a staging copy of the table, then swap it in within one transaction
+        connection = self.connect()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}_staging")
+                    cursor.execute(f"CREATE TABLE {table}_staging (LIKE {table} INCLUDING ALL)")
+                    self._copy_csv(cursor, f"{table}_staging", f)
+                    cursor.execute(f"DROP TABLE {table}")
+                    cursor.execute(f"ALTER TABLE {table}_staging RENAME TO {table}")
+        finally:
+            connection.close()
+
+    def apply_group_changes(self, table, key, rows, keys):
+        ## Replace every row whose key is in `keys` with `rows`, atomically
+        buffer = io.BytesIO(rows.to_csv(index = False).encode())
+        connection = self.connect()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT format_type(atttypid, atttypmod)
+                        FROM pg_attribute
+                        WHERE attrelid = %s::regclass AND attname = %s
+                    """, (table, key))
+                    key_type = cursor.fetchone()[0]
+                    cursor.execute(f"CREATE TEMP TABLE {table}_staging (LIKE {table}) ON COMMIT DROP")
+                    self._copy_csv(cursor, f"{table}_staging", buffer)
+                    cursor.execute(f"DELETE FROM {table} WHERE {key} = ANY(%s::{key_type}[])", (keys,))
+                    cursor.execute(f"INSERT INTO {table} SELECT * FROM {table}_staging")
+        finally:
+            connection.close()
+
+    ## Queries
+
+    def get_route_ids(self):
+        return self.read_sql("SELECT DISTINCT route_id FROM routes")['route_id'].tolist()
+
+    def get_shape_points(self, route_ids = 'all', query = 'distinct_on'):
+        route_filter = "" if route_ids == 'all' else "WHERE route_id = ANY(%(route_ids)s)"
+        return self.read_sql(self.shape_point_queries[query].format(route_filter = route_filter),
+                             {'route_ids' : None if route_ids == 'all' else [str(id) for id in route_ids]})
+
+    def get_trips(self):
+        return self.read_sql("""
+            SELECT t.trip_id, t.route_id, t.direction_id, t.trip_headsign, r.route_long_name
+            FROM trips AS t
+            LEFT JOIN routes AS r ON r.route_id = t.route_id
+        """)
+
+    def get_stops(self):
+        return self.read_sql("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops")
+
+    def read_table(self, table, columns = '*'):
+        return self.read_sql(f"SELECT {columns if isinstance(columns, str) else ', '.join(columns)} FROM {table}")
+
+class SQLiteStorage:
+    name = 'sqlite'
+
+    ## MIN(route_id) per shape is what DISTINCT ON (shape_id) ... ORDER BY route_id picks in Postgres
+    shape_points_query = """
+        SELECT s.shape_id, s.shape_pt_lat, s.shape_pt_lon, s.shape_pt_sequence, sr.route_id, r.route_long_name
+        FROM shapes AS s
+        JOIN (
+            SELECT shape_id, MIN(route_id) AS route_id
+            FROM trips
+            GROUP BY shape_id
+        ) AS sr ON sr.shape_id = s.shape_id
+        LEFT JOIN routes AS r ON r.route_id = sr.route_id
+        {route_filter}
+    """
+
+    def __init__(self, path = './data/gtfs.sqlite'):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        ## WAL lets the app keep reading while a refresh writes
+        connection.execute("PRAGMA journal_mode = WAL")
+        return connection
+
+    def execute(self, statement, params = ()):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(statement, params)
+        finally:
+            connection.close()
+        return statement
+
+    def read_sql(self, sql, params = ()):
+        connection = self.connect()
+        try:
+            return pd.read_sql_query(sql, connection, params = params)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _insert_csv(connection, table, f):
+        ## Columns are matched by the file's header; empty fields are NULL
+        reader = csv.reader(f)
+        header = [column.strip() for column in next(reader)]
+        table_columns = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+        keep = [i for i, column in enumerate(header) if column in table_columns]
+        columns = ', '.join(header[i] for i in keep)
+        placeholders = ', '.join('?' for _ in keep)
+        rows = ([row[i] if row[i] != '' else None for i in keep] for row in reader if row)
+        connection.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", rows)
+
+    ## Loading
+
+    def create_tables(self, schema_file, tables, unlogged = False):
+        connection = self.connect()
+        try:
+            with open(schema_file, 'r') as f:
+                connection.executescript(f.read())
+        finally:
+            connection.close()
+
+    def load_files(self, gtfs_filepath, file_list, workers = 1):
+        ## SQLite has a single writer, so files are loaded one after another in one transaction
+        archive = gtfs_archive(gtfs_filepath)
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA synchronous = OFF")
+            with connection:
+                for file in file_list:
+                    with archive.open_text(file) as f:
+                        self._insert_csv(connection, file.replace(".txt",""), f)
+        finally:
+            connection.close()
+        return len(file_list)
+
+    def create_indexes(self, index_file, workers = 1):
+        statements = read_sql_statements(index_file)
+        connection = self.connect()
+        try:
+            with connection:
+                for statement in statements:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+        return len(statements)
+
+    def analyze(self):
+        self.execute("ANALYZE")
+
+    def replace_table(self, table, f):
+        ## Readers keep seeing the old rows until the transaction commits
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(f"DELETE FROM {table}")
+                self._insert_csv(connection, table, io.TextIOWrapper(f, encoding = 'utf-8-sig', newline = ''))
+        finally:
+            connection.close()
+
+    def apply_group_changes(self, table, key, rows, keys):
+        ## Replace every row whose key is in `keys` with `rows`, atomically
+        buffer = io.StringIO()
+        rows.to_csv(buffer, index = False)
+        buffer.seek(0)
+        connection = self.connect()
+        try:
+            with connection:
+                ## An untyped column compares with TEXT and INTEGER keys alike
+                connection.execute("CREATE TEMP TABLE change_keys (k)")
+                connection.executemany("INSERT INTO change_keys VALUES (?)", ((k,) for k in keys))
+                connection.execute(f"DELETE FROM {table} WHERE {key} IN (SELECT k FROM change_keys)")
+                connection.execute("DROP TABLE change_keys")
+                self._insert_csv(connection, table, buffer)
+        finally:
+            connection.close()
+
+    ## Queries
+
+    def get_route_ids(self):
+        return self.read_sql("SELECT DISTINCT route_id FROM routes")['route_id'].tolist()
+
+    def get_shape_points(self, route_ids = 'all', query = None):
+        if route_ids == 'all':
+            return self.read_sql(self.shape_points_query.format(route_filter = ""))
+        route_ids = [str(id) for id in route_ids]
+        route_filter = f"WHERE sr.route_id IN ({', '.join('?' for _ in route_ids)})"
+        return self.read_sql(self.shape_points_query.format(route_filter = route_filter), route_ids)
+
+    def get_trips(self):
+        return self.read_sql("""
+            SELECT t.trip_id, t.route_id, t.direction_id, t.trip_headsign, r.route_long_name
+            FROM trips AS t
+            LEFT JOIN routes AS r ON r.route_id = t.route_id
+        """)
+
+    def get_stops(self):
+        return self.read_sql("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops")
+
+    def read_table(self, table, columns = '*'):
+        return self.read_sql(f"SELECT {columns if isinstance(columns, str) else ', '.join(columns)} FROM {table}")
+
+@lru_cache(maxsize = None)
+def get_storage(backend = None, credentials_path = 'credentials.json', sqlite_path = None, feed = 'bus'):
+    backend = backend or os.environ.get('GTFS_STORAGE', 'postgres')
+    if backend == 'sqlite':
+        path = sqlite_path or os.environ.get('GTFS_SQLITE_PATH', './data/gtfs.sqlite')
+        if feed != 'bus':
+            path = f"_{feed}".join(os.path.splitext(path))
+        return SQLiteStorage(path)
+    elif backend == 'postgres':
+        return PostgresStorage(credentials_path, schema = None if feed == 'bus' else feed)
+    raise ValueError(f"Unknown GTFS storage backend: {backend}")
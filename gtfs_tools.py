@@ -1,9 +1,10 @@
 #!/usr/bin/env/ python
 import os
 # import sys
-import shutil
+import time
+import hashlib
+import resource
 from zipfile import ZipFile
-import requests
 import json
 
 import numpy as np
@@ -19,13 +20,13 @@ from matplotlib.colors import rgb2hex
 # from google.transit import gtfs_realtime_pb2
 # from google.protobuf.json_format import MessageToDict
 
-import psycopg2
+from shapely.geometry import Point
 
-from shapely.geometry import Point, LineString, MultiLineString
-from shapely import ops
-
-with open('credentials.json', 'r') as f:
-    creds = json.load(f)
+from gtfs_storage import get_storage
+from gtfs_archive import GTFSArchive, gtfs_archive
+from http_client import fetch, fetch_json, read_into_memory
+from metrics import span, DiskSampler
+from route_geometry import merge_route_lines, write_lines_geojson
 
 with open('./data/route_colors.json', 'r') as f:
     colors = json.load(f)
@@ -41,16 +42,8 @@ url_dict = dict(
     regional_rail_vehicle_position_updates = 'https://www3.septa.org/gtfsrt/septarail-pa-us/Vehicle/rtVehiclePosition.pb'
 )
 
-def create_route_color_json(color_map = "Spectral"):
-    with psycopg2.connect(**creds) as connection:
-            connection.autocommit = True
-            with connection.cursor() as cursor:
-                cursor.execute(f"""
-                        SELECT DISTINCT route_id
-                        FROM routes
-                    """)
-                column_names = [d[0] for d in cursor.description]
-                routes = gpd.GeoDataFrame(cursor.fetchall(), columns = column_names)
+def create_route_color_json(color_map = "Spectral", storage = None):
+    routes = pd.DataFrame({'route_id' : (storage or get_storage()).get_route_ids()})
     str_list = []
     num_list = []
     for id in routes['route_id']:
@@ -69,6 +62,10 @@ def create_route_color_json(color_map = "Spectral"):
     with open("./data/route_colors.json", 'w') as f:
         json.dump(color_dict, f)
 
+    ## Update in place so lines built later in this process pick up new routes
+    colors.clear()
+    colors.update(color_dict)
+
 # def feed_to_dict(endpoint = "bus_vehicle_position_updates"):
 #     url = url_dict[endpoint]
 #     feed = gtfs_realtime_pb2.FeedMessage()
@@ -103,92 +100,213 @@ def create_route_color_json(color_map = "Spectral"):
     
 #     return df.loc[df['route_id']!='']
 
-def create_gtfs_database(schema_file = 'create_gtfs_db.sql', credentials_path = 'credentials.json', gtfs_filepath = './google_bus/'):
-    ## Get database credentials
-    with open(credentials_path, 'r') as f:
-        creds = json.load(f)
+@span('create_gtfs_database')
+def create_gtfs_database(schema_file = 'create_gtfs_db.sql', credentials_path = 'credentials.json', gtfs_filepath = './google_bus/',
+                         index_file = 'create_gtfs_indexes.sql', workers = 4, unlogged = False, storage = None):
+    storage = storage or get_storage(credentials_path = credentials_path)
 
     ## Read list of gtfs static files and load into database tables
-    file_list = os.listdir(gtfs_filepath)
-    file_list.remove('fare_rules.txt')
-    file_list.remove('fare_attributes.txt')
+    file_list = list_gtfs_files(gtfs_filepath)
+    tables = [file.replace(".txt","") for file in file_list]
 
     ## Read schema file, and execute to create database tables
-    with psycopg2.connect(**creds) as connection:
-        connection.autocommit = True
-        with connection.cursor() as cursor:
-            with open(schema_file, 'r') as f:
-                schema = f.read()
-            cursor.execute(schema)
-            print("Created GTFS database tables.")
-
-            ## Load gtfs static files into database tables
-            for file in file_list:
-                with open(f"{gtfs_filepath}{file}", 'r') as f:
-                    next(f) ## skips header row
-                    cursor.copy_from(f, file.replace(".txt",""), sep = ',')
-            print("All files have been loaded in database.")
-
-def get_bus_lines(route_ids = 'all', filename = './data/all_bus_lines.geojson'):
+    storage.create_tables(schema_file, tables, unlogged = unlogged)
+    print("Created GTFS database tables.")
+
+    n_chunks = storage.load_files(gtfs_filepath, file_list, workers = workers)
+    print(f"All files have been loaded in {storage.name} database ({n_chunks} chunks).")
+
+    ## Indexes are cheaper to build once the data is in, then refresh planner statistics
+    if index_file is not None:
+        n_indexes = storage.create_indexes(index_file, workers = workers)
+        print(f"Built {n_indexes} indexes.")
+    storage.analyze()
+    print("Analyzed GTFS tables.")
+
+## Column each GTFS table is diffed by during an incremental refresh.
+## Tables not listed here are small and are swapped in whole when they change.
+gtfs_group_keys = dict(
+    calendar = 'service_id',
+    calendar_dates = 'service_id',
+    routes = 'route_id',
+    shapes = 'shape_id',
+    stop_times = 'trip_id',
+    stops = 'stop_id',
+    trips = 'route_id'
+)
+
+def list_gtfs_files(gtfs_filepath = './google_bus/'):
+    file_list = gtfs_archive(gtfs_filepath).files()
+    return [f for f in file_list if f not in ('fare_rules.txt', 'fare_attributes.txt')]
+
+def hash_gtfs_file(f, chunk_size = 1024 * 1024):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_gtfs_group_rows(df, key):
+    ## Order-independent hash of every key group: the wrapping sum of its row hashes
+    row_hashes = pd.Series(pd.util.hash_pandas_object(df, index = False).to_numpy(), index = df[key].to_numpy())
+    group_hashes = row_hashes.groupby(level = 0).sum()
+    return {str(k) : format(int(h), '016x') for k, h in group_hashes.items()}
+
+def hash_gtfs_files(gtfs_filepath = './google_bus/'):
+    archive = gtfs_archive(gtfs_filepath)
+    hashes = {'files' : {}, 'groups' : {}}
+    for file in list_gtfs_files(archive):
+        with archive.open(file) as f:
+            hashes['files'][file] = hash_gtfs_file(f)
+        table = file.replace(".txt","")
+        if table in gtfs_group_keys:
+            with archive.open(file) as f:
+                df = pd.read_csv(f, dtype = str, keep_default_na = False)
+            hashes['groups'][table] = hash_gtfs_group_rows(df, gtfs_group_keys[table])
+    return hashes
+
+def update_gtfs_database_incremental(credentials_path = 'credentials.json', gtfs_filepath = './google_bus/',
+                                     hash_path = './data/static_hashes.json', lines_filename = './data/all_bus_lines.geojson', storage = None,
+                                     geometry_workers = 1):
+    storage = storage or get_storage(credentials_path = credentials_path)
+    archive = gtfs_archive(gtfs_filepath)
+    with open(hash_path, 'r') as f:
+        previous = json.load(f)
+
+    current = {'files' : {}, 'groups' : {}}
+    ## table -> (changed keys, removed keys), or None when the whole table was replaced
+    changes = {}
+    for file in list_gtfs_files(archive):
+        table = file.replace(".txt","")
+        key = gtfs_group_keys.get(table)
+        with archive.open(file) as f:
+            current['files'][file] = hash_gtfs_file(f)
+
+        if current['files'][file] == previous['files'].get(file):
+            if key is not None:
+                current['groups'][table] = previous['groups'][table]
+            continue
+
+        if key is None or table not in previous['groups']:
+            with archive.open(file) as f:
+                storage.replace_table(table, f)
+            changes[table] = None
+            if key is not None:
+                with archive.open(file) as f:
+                    df = pd.read_csv(f, dtype = str, keep_default_na = False)
+                current['groups'][table] = hash_gtfs_group_rows(df, key)
+            print(f"Replaced table {table}.")
+            continue
+
+        with archive.open(file) as f:
+            df = pd.read_csv(f, dtype = str, keep_default_na = False)
+        groups = hash_gtfs_group_rows(df, key)
+        old_groups = previous['groups'][table]
+        changed = [k for k, h in groups.items() if old_groups.get(k) != h]
+        removed = [k for k in old_groups if k not in groups]
+        if changed or removed:
+            storage.apply_group_changes(table, key, df.loc[df[key].isin(changed)], changed + removed)
+        current['groups'][table] = groups
+        changes[table] = (changed, removed)
+        print(f"Updated table {table}: {len(changed)} changed and {len(removed)} removed {key}s.")
+
+    ## Work out which route geometries depend on what changed
+    if any(changes.get(t, ()) is None for t in ('routes', 'shapes', 'trips')):
+        affected_routes, removed_routes = 'all', []
+    else:
+        affected_routes = set()
+        removed_routes = set()
+        for table in ('routes', 'trips'):
+            changed, removed = changes.get(table, ([], []))
+            affected_routes.update(changed)
+            removed_routes.update(removed)
+        changed_shapes = set(sum(changes.get('shapes', ([], [])), []))
+        if changed_shapes:
+            with archive.open('trips.txt') as f:
+                trips = pd.read_csv(f, dtype = str, keep_default_na = False, usecols = ['route_id', 'shape_id'])
+            affected_routes.update(trips.loc[trips['shape_id'].isin(changed_shapes), 'route_id'])
+        affected_routes -= removed_routes
+
+    routes_changed = changes.get('routes', ([], [])) is None or any(
+        k not in previous['groups']['routes'] or k not in current['groups']['routes']
+        for k in sum(changes.get('routes', ([], [])), []))
+    if routes_changed:
+        create_route_color_json(storage = storage)
+
+    if affected_routes == 'all' or not os.path.exists(lines_filename):
+        get_bus_lines(filename = lines_filename, storage = storage, workers = geometry_workers)
+    elif affected_routes or removed_routes:
+        print(f"Rebuilding {len(affected_routes)} route lines, removing {len(removed_routes)}.")
+        lines = gpd.read_file(lines_filename)
+        lines = lines.loc[~lines['route_id'].isin(affected_routes | removed_routes)]
+        if affected_routes:
+            lines = pd.concat([lines, get_bus_lines(route_ids = sorted(affected_routes), filename = None, storage = storage, workers = geometry_workers)], ignore_index = True)
+        write_lines_geojson(lines, lines_filename, workers = geometry_workers)
+    else:
+        print("No route lines affected.")
+
+    with open(hash_path, 'w') as f:
+        json.dump(current, f)
+
+def build_bus_lines(shapes, workers = 1):
+    ## shapes has one row per shape point: shape_id, shape_pt_lat, shape_pt_lon,
+    ## shape_pt_sequence, route_id, route_long_name (as returned by the query in get_bus_lines).
+    ## workers: geometry processes (see route_geometry.py)
+
+    ## One sort, then group offsets, instead of a boolean-mask scan per shape_id
+    shapes = shapes.sort_values(['shape_id', 'shape_pt_sequence'], kind = 'stable')
+    shapes = shapes.drop_duplicates(['shape_id', 'shape_pt_sequence'])
+    shape_ids = shapes['shape_id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, shape_ids[1:] != shape_ids[:-1]])
+    counts = np.diff(np.r_[starts, len(shape_ids)])
+
+    ## A LineString needs at least two points
+    keep = counts >= 2
+    rows = np.repeat(keep, counts)
+    starts, counts = starts[keep], counts[keep]
+    coords = shapes[['shape_pt_lon', 'shape_pt_lat']].to_numpy(dtype = float)[rows]
+    print(f"Built {len(starts)} shape lines from {len(coords)} points.")
+
+    line_df = pd.DataFrame({
+        'shape_id' : shape_ids[starts],
+        'route_id' : shapes['route_id'].to_numpy()[starts],
+        'route_name' : shapes['route_long_name'].to_numpy()[starts]
+    })
+
+    ## Each route's shape lines merged, routes in order of first appearance. Shapes are
+    ## regrouped by route as flat arrays and merged in chunks of routes on a process pool
+    has_route = line_df['route_id'].notna().to_numpy()
+    route_codes, route_ids = pd.factorize(line_df.loc[has_route, 'route_id'])
+    order = np.argsort(route_codes, kind = 'stable')
+    first_shape = np.flatnonzero(np.r_[True, route_codes[order][1:] != route_codes[order][:-1]])
+    shapes_by_route = np.flatnonzero(has_route)[order]
+    shape_counts = counts[shapes_by_route]
+    shape_starts = np.r_[0, np.cumsum(counts)[:-1]][shapes_by_route]
+    vertex = np.repeat(shape_starts - np.r_[0, np.cumsum(shape_counts)[:-1]], shape_counts) + np.arange(shape_counts.sum())
+
+    line_df = gpd.GeoDataFrame({
+        'route_id' : np.asarray(route_ids),
+        'route_name' : line_df.loc[has_route, 'route_name'].to_numpy()[order][first_shape],
+        'geometry' : merge_route_lines(coords[vertex], shape_counts, route_codes[order], len(route_ids), workers = workers)
+    }, geometry = 'geometry', crs = 'epsg:4326')
+    line_df['color'] = line_df['route_id'].map(colors)
+    return line_df
+
+@span('get_bus_lines')
+def get_bus_lines(route_ids = 'all', filename = './data/all_bus_lines.geojson', query = 'distinct_on', storage = None, workers = 1):
     # if route_ids == 'all':
     #     route_ids = [i for i in feed_to_dict()['route_id'].unique()]
 
     print("Getting line information ...")
-    with psycopg2.connect(**creds) as connection:
-        connection.autocommit = True
-        with connection.cursor() as cursor:
-            cursor.execute(f"""
-                SELECT s.*, t.route_id, r.route_long_name
-                FROM shapes AS s
-                LEFT JOIN trips AS t ON t.shape_id = s.shape_id
-                LEFT JOIN routes AS r ON r.route_id = t.route_id
-                GROUP BY s.shape_id, shape_pt_lat, shape_pt_lon, 
-                shape_pt_sequence, t.route_id, r.route_long_name
-            """)
-            # WHERE r.route_id IN {(route_ids,'') if type(route_ids)==str else tuple(list(i for i in route_ids)+[''])}
-
-            column_names = [d[0] for d in cursor.description]
-            shapes = gpd.GeoDataFrame(cursor.fetchall(), columns = column_names)
-            shapes['geometry'] = shapes[["shape_pt_lon","shape_pt_lat"]].apply(Point, axis = 1)
+    shapes = (storage or get_storage()).get_shape_points(route_ids, query = query)
 
     print(f"Shapes acquired. Shapes shape: {shapes.shape}")
 
-    line_list = []
-    print(len(shapes['shape_id'].unique()))
-    for i,shape_id in enumerate(shapes['shape_id'].unique()):
-        line = shapes.loc[shapes['shape_id'] == shape_id,:].sort_values('shape_pt_sequence')
-
-        if i % 50 == 0:
-            print(f"Shape {i}")
-
-        line_dict = {
-            'shape_id' : shape_id,
-            'route_id' : line['route_id'].unique()[0],
-            'route_name' : line['route_long_name'].unique()[0],
-            'geometry' : LineString(line['geometry'])
-        }
-        line_list.append(line_dict)
-
-    line_df = gpd.GeoDataFrame(line_list)
-
-    route_list = []
-    for routeid in line_df['route_id'].dropna().unique():
-        route_dict = {
-            "route_id" : routeid,
-            "route_name" :  line_df.loc[line_df['route_id'] == routeid, 'route_name'].iloc[0],
-            "geometry" : ops.linemerge(MultiLineString(line_df.loc[line_df['route_id'] == routeid,"geometry"].values))
-        }
-        route_list.append(route_dict)
-
-    line_df = gpd.GeoDataFrame(route_list)
-    print('Making geometry column')
-    line_df['geometry'] = [g['geometry'] for g in route_list]
-    line_df = line_df.set_crs('epsg:4326')
-    line_df['color'] = line_df['route_id'].map(colors)
+    line_df = build_bus_lines(shapes, workers = workers)
     print(f"Line_df shape: {line_df.shape}")
-    print(f"Saving geojson to {filename}")
-    line_df.to_file(filename, driver = "GeoJSON")
-    print(f"{filename} has been saved.")
+    if filename is not None:
+        print(f"Saving geojson to {filename}")
+        write_lines_geojson(line_df, filename, workers = workers)
+        print(f"{filename} has been saved.")
     return line_df
 
 def get_lines_json(filename = './data/all_bus_lines.geojson', force_download = False):
@@ -231,9 +349,9 @@ def get_lines_json(filename = './data/all_bus_lines.geojson', force_download = F
 
 #     return json.loads(routes_df.to_json(drop_id = True))
 
+@span('transitview_to_df')
 def transitview_to_df(url = "https://www3.septa.org/api/TransitViewAll/index.php"):
-    response = requests.get(url)
-    res_dict = response.json()
+    res_dict = fetch_json(url)
 
     row_list = []
     for route in res_dict['routes'][0]:
@@ -247,25 +365,10 @@ def transitview_to_df(url = "https://www3.septa.org/api/TransitViewAll/index.php
     df['color'] = df['route_id'].map(colors)
     return df.loc[df['route_id']!='']
 
-def get_bus_positions_from_transitview(route_ids = 'all'):
-    print("Getting current bus locations ...")
-    feed_df = transitview_to_df()
-    if route_ids == 'all':
-        route_ids = feed_df['route_id'].unique()
-        df = feed_df
-    elif type(route_ids) in (str, int):
-        route_ids = str(route_ids)
-        df = feed_df.loc[feed_df['route_id'] == route_ids]
-    else:
-        route_ids = [str(id) for id in route_ids]
-        df = feed_df.loc[feed_df['route_id'].isin(route_ids)]
-
-    return json.loads(df.to_json(drop_id = True))
-
-def check_static_updates():
+def check_static_updates(incremental = False, hash_path = './data/static_hashes.json', feeds = ('bus', 'rail'), geometry_workers = 1):
+    ## geometry_workers: processes for the route line build (see route_geometry.py)
     url = "https://api.github.com/repos/septadev/GTFS/releases/latest"
-    res = requests.get("https://api.github.com/repos/septadev/GTFS/releases/latest")
-    res_json = res.json()
+    res_json = fetch_json(url)
     download_url = res_json['assets'][0]['browser_download_url']
 
     with open("./data/latest_static_update.json", 'r') as j:
@@ -273,35 +376,42 @@ def check_static_updates():
     
     if download_url != data['lastUpdateURL']:
         print("Static Data is out of date. Updating static data files now.")
-        response = requests.get(download_url, stream=True)
-        with open("gtfs_public.zip", 'wb') as file:
-            for chunk in response.iter_content(chunk_size=512):
-                file.write(chunk)
-
-        with ZipFile("./gtfs_public.zip", "r") as zip_folder:
-            zip_folder.extractall(path = './')
-
-        with ZipFile("./google_bus.zip", 'r') as bus_folder:
-            bus_folder.extractall(path = "./google_bus/")
-
-        with ZipFile("./google_rail.zip", 'r') as rail_folder:
-            rail_folder.extractall(path = "./google_rail/")
-
-        os.remove("./gtfs_public.zip")
-        os.remove("./google_bus.zip")
-        os.remove("./google_rail.zip")
-
-        with open("./data/latest_static_update.json", 'w') as j:
-            json.dump({
-                'lastUpdateURL':download_url
-            }, j)
-
-        create_gtfs_database()
-        get_bus_lines()
-        create_route_color_json()
-        
-        shutil.rmtree('./google_bus/')
-        shutil.rmtree('./google_rail/')
+        start = time.perf_counter()
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        ## The release and the feed zips inside it stay in memory, and their files are streamed
+        ## into the database: nothing is downloaded or extracted to disk. The disk sampler
+        ## watches the free space of ./data's filesystem, so what it reports is the database
+        ## and line file growth (and anything else written meanwhile)
+        with DiskSampler('./data', interval = 0.25, files = False) as disk:
+            release = ZipFile(read_into_memory(download_url))
+            bus = GTFSArchive.from_release(release, 'bus')
+
+            if incremental and os.path.exists(hash_path):
+                update_gtfs_database_incremental(gtfs_filepath = bus, hash_path = hash_path, geometry_workers = geometry_workers)
+            else:
+                create_gtfs_database(gtfs_filepath = bus)
+                get_bus_lines(workers = geometry_workers)
+                create_route_color_json()
+                ## Baseline for the next incremental refresh
+                with open(hash_path, 'w') as f:
+                    json.dump(hash_gtfs_files(bus), f)
+
+            ## Rail is small, and only stored, so it is always reloaded whole
+            if 'rail' in feeds:
+                create_gtfs_database(gtfs_filepath = GTFSArchive.from_release(release, 'rail'), storage = get_storage(feed = 'rail'))
+
+            with open("./data/latest_static_update.json", 'w') as j:
+                json.dump({
+                    'lastUpdateURL':download_url
+                }, j)
+
+        release_bytes = release.fp.getbuffer().nbytes
+        ## ru_maxrss is the peak of the whole process (a web worker, under STATIC_REFRESH=background),
+        ## so report how far this refresh raised it as well
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Loaded {' and '.join(feeds)} in {time.perf_counter() - start:.1f}s. Peak disk use {disk.peak / 1e6:.1f} MB above the start "
+              f"(release held in memory, {release_bytes / 1e6:.1f} MB); process peak RSS {peak_rss:.0f} MB, "
+              f"{peak_rss - start_rss:.0f} MB higher than before the refresh.")
     else:
         print("Static data is up-to-date.")
 
@@ -0,0 +1,16 @@
+import os
+
+## Gunicorn settings of the Docker image, also used by the benchmarks that start the app
+## (override bind and workers on the command line). Every open page holds a
+## /vehicles/stream connection, so workers are gevent: a stream waits in a greenlet, not a
+## thread, and one worker keeps serving callbacks, /lines.geojson and /tiles next to
+## thousands of them. gunicorn monkey-patches each worker before it imports the app, so
+## the app's threads (poller, listeners, artifact watcher) become greenlets too.
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8050')
+worker_class = 'gevent'
+## Open connections per worker, streams included
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 5000))
+## gevent workers heartbeat from their event loop, so this only catches a worker stuck in
+## CPU-bound work (a static refresh runs outside, in build_static.py)
+timeout = 120
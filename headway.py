@@ -0,0 +1,217 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+from spatial_index import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON
+
+## Bunching and gaps per route and direction, for every vehicle snapshot in one pass.
+## Each route's longest line part (from the line artifact, i.e. get_bus_lines) is its axis.
+## Vehicles are projected onto their route's axis for a distance along the route; sorted
+## by (route, direction, distance), consecutive vehicles of a group are neighbours, and
+## the spacing between them is compared with the even spacing the group would have if its
+## vehicles were spread over the whole axis:
+##   bunched   spacing below bunch_ratio * even spacing (or below bunch_distance meters)
+##   gap       spacing above gap_ratio * even spacing
+## Time headways are spacing / the group's speed (from vehicle history when available).
+
+DEFAULT_SPEED = 5.0
+LATE_MINUTES = 5
+
+class HeadwayAnalytics:
+    def __init__(self, route_ids, coords, part_offsets, route_parts, origin_lat = 39.95, max_offset = 150,
+                 bunch_ratio = 0.25, gap_ratio = 2.0, bunch_distance = 300, piece_size = 16):
+        self.kx = METERS_PER_DEGREE_LON * np.cos(np.radians(origin_lat))
+        self.ky = METERS_PER_DEGREE_LAT
+        self.max_offset = max_offset
+        self.bunch_ratio = bunch_ratio
+        self.gap_ratio = gap_ratio
+        self.bunch_distance = bunch_distance
+        self.version = None
+
+        ## Longest part of each route, in meters
+        self.route_lookup = pd.Index([str(r) for r in route_ids], dtype = object)
+        part_offsets = np.asarray(part_offsets, dtype = np.int64)
+        route_parts = np.asarray(route_parts, dtype = np.int64)
+        coords = np.asarray(coords, dtype = float) * [self.kx, self.ky]
+        parts = shapely.linestrings(coords, indices = np.repeat(np.arange(len(part_offsets) - 1), np.diff(part_offsets)))
+        lengths = shapely.length(parts)
+        part_route = np.repeat(np.arange(len(route_parts) - 1), np.diff(route_parts))
+        order = np.lexsort((-lengths, part_route))
+        first = order[np.r_[True, part_route[order][1:] != part_route[order][:-1]]] if len(order) else order
+        self.axes = np.full(len(self.route_lookup), None, dtype = object)
+        self.axis_length = np.full(len(self.route_lookup), np.nan)
+        self.axes[part_route[first]] = parts[first]
+        self.axis_length[part_route[first]] = lengths[first]
+
+        ## Axes cut into pieces of at most piece_size segments in an STRtree, as in
+        ## RouteSpatialIndex, so each vehicle is projected onto a few vertices near it rather
+        ## than its whole route; piece_along is the distance along the axis where a piece starts
+        axis_vertices = np.diff(part_offsets)[first]
+        vertex = np.repeat(part_offsets[first] - np.r_[0, np.cumsum(axis_vertices)[:-1]], axis_vertices) + np.arange(axis_vertices.sum())
+        axis_offsets = np.r_[0, np.cumsum(axis_vertices)]
+        axis_coords = coords[vertex]
+        step = np.r_[0, np.hypot(*np.diff(axis_coords, axis = 0).T)]
+        step[axis_offsets[:-1]] = 0
+        along = np.cumsum(step)
+        along -= np.repeat(along[axis_offsets[:-1]], axis_vertices)
+        n_segments = np.maximum(axis_vertices - 1, 0)
+        n_pieces = -(-n_segments // piece_size)
+        piece_axis = np.repeat(np.arange(len(first)), n_pieces)
+        piece_start = axis_offsets[piece_axis] + (np.arange(len(piece_axis)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)) * piece_size
+        piece_end = np.minimum(piece_start + piece_size, axis_offsets[piece_axis + 1] - 1)
+        piece_vertices = piece_end - piece_start + 1
+        piece_vertex = np.repeat(piece_start - np.r_[0, np.cumsum(piece_vertices)[:-1]], piece_vertices) + np.arange(piece_vertices.sum())
+        self.pieces = shapely.linestrings(axis_coords[piece_vertex], indices = np.repeat(np.arange(len(piece_axis)), piece_vertices))
+        self.piece_route = part_route[first][piece_axis]
+        self.piece_along = along[piece_start]
+        self.tree = shapely.STRtree(self.pieces)
+
+    @classmethod
+    def from_artifact(cls, artifact, **kwargs):
+        analytics = cls(artifact.routes['route_id'], artifact.coords, artifact.part_offsets, artifact.route_parts, **kwargs)
+        analytics.version = artifact.version
+        return analytics
+
+    def analyze(self, vehicles, route_ids, directions, lons, lats, late, route_speeds = None):
+        ## Returns (vehicle_df, route_df). vehicle_df has one row per vehicle, with distance_along
+        ## and offset in meters, and spacing_ahead/headway_ahead to the next vehicle further
+        ## along the axis in the same group; route_df one row per route and direction
+        route_ids = np.array([str(r) for r in route_ids], dtype = object)
+        directions = np.array(['' if d is None else str(d) for d in directions], dtype = object)
+        late = pd.to_numeric(pd.Series(late, dtype = object), errors = 'coerce').to_numpy(dtype = float)
+        route_index = self.route_lookup.get_indexer(pd.Index(route_ids, dtype = object))
+
+        ## Distance along and off the axis: the closest piece of the vehicle's own axis within
+        ## max_offset, from a box query as in RouteSpatialIndex.snap
+        x, y = np.asarray(lons, dtype = float) * self.kx, np.asarray(lats, dtype = float) * self.ky
+        points = shapely.points(x, y)
+        m = self.max_offset
+        point_index, piece_index = self.tree.query(shapely.box(x - m, y - m, x + m, y + m))
+        own = self.piece_route[piece_index] == route_index[point_index]
+        point_index, piece_index = point_index[own], piece_index[own]
+        distances = shapely.distance(points[point_index], self.pieces[piece_index])
+        near = distances <= m
+        point_index, piece_index, distances = point_index[near], piece_index[near], distances[near]
+        order = np.lexsort((distances, point_index))
+        first = order[np.r_[True, point_index[order][1:] != point_index[order][:-1]]] if len(order) else order
+        best_point, best_piece = point_index[first], piece_index[first]
+        distance_along = np.full(len(route_ids), np.nan)
+        offset = np.full(len(route_ids), np.nan)
+        distance_along[best_point] = self.piece_along[best_piece] + shapely.line_locate_point(self.pieces[best_piece], points[best_point])
+        offset[best_point] = distances[first]
+        on_axis = ~np.isnan(offset)
+
+        ## Groups of (route, direction), and every vehicle sorted by group then distance
+        group_codes, groups = pd.factorize(pd.MultiIndex.from_arrays([route_ids, directions]))
+        order = np.lexsort((distance_along, ~on_axis, group_codes))
+        sorted_group = group_codes[order]
+        sorted_on_axis = on_axis[order]
+        n_groups = len(groups)
+        on_axis_count = np.bincount(group_codes[on_axis], minlength = n_groups)
+        group_length = np.full(n_groups, np.nan)
+        group_route = self.route_lookup.get_indexer(pd.Index(groups.get_level_values(0), dtype = object))
+        group_length[group_route >= 0] = self.axis_length[group_route[group_route >= 0]]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            even_spacing = np.where(on_axis_count > 1, group_length / on_axis_count, np.nan)
+
+        ## Spacing to the next vehicle of the same group, both on the axis
+        pair = (sorted_group[1:] == sorted_group[:-1]) & sorted_on_axis[1:] & sorted_on_axis[:-1]
+        spacing = np.where(pair, np.diff(distance_along[order]), np.nan)
+        spacing_ahead = np.full(len(order), np.nan)
+        spacing_behind = np.full(len(order), np.nan)
+        spacing_ahead[order[:-1]] = spacing
+        spacing_behind[order[1:]] = spacing
+
+        speeds = np.full(n_groups, DEFAULT_SPEED)
+        if route_speeds:
+            group_speed = pd.Series(groups.get_level_values(0)).map(route_speeds).to_numpy(dtype = float)
+            speeds = np.where(np.isfinite(group_speed) & (group_speed > 1), group_speed, DEFAULT_SPEED)
+        vehicle_even = even_spacing[group_codes]
+        bunch_threshold = np.fmax(self.bunch_ratio * vehicle_even, np.where(np.isfinite(vehicle_even), self.bunch_distance, np.nan))
+        with np.errstate(invalid = 'ignore'):
+            bunched = (spacing_ahead < bunch_threshold) | (spacing_behind < bunch_threshold)
+            gap = spacing_ahead > self.gap_ratio * vehicle_even
+
+        vehicle_df = pd.DataFrame({
+            'vehicle' : np.asarray(vehicles, dtype = object),
+            'route_id' : route_ids,
+            'direction' : directions,
+            'late' : late,
+            'distance_along' : distance_along,
+            'offset' : offset,
+            'on_route' : on_axis,
+            'spacing_ahead' : spacing_ahead,
+            'headway_ahead' : spacing_ahead / speeds[group_codes],
+            'bunched' : bunched,
+            'gap' : gap
+        })
+
+        ## Per group: spacing spread, reduced over the runs of sorted pairs
+        pair_group = sorted_group[1:][pair]
+        pair_spacing = spacing[pair]
+        n_pairs = np.bincount(pair_group, minlength = n_groups)
+        spacing_sum = np.bincount(pair_group, weights = pair_spacing, minlength = n_groups)
+        spacing_squares = np.bincount(pair_group, weights = pair_spacing ** 2, minlength = n_groups)
+        min_spacing = np.full(n_groups, np.nan)
+        max_spacing = np.full(n_groups, np.nan)
+        if len(pair_group):
+            pair_starts = np.flatnonzero(np.r_[True, pair_group[1:] != pair_group[:-1]])
+            min_spacing[pair_group[pair_starts]] = np.minimum.reduceat(pair_spacing, pair_starts)
+            max_spacing[pair_group[pair_starts]] = np.maximum.reduceat(pair_spacing, pair_starts)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            mean_spacing = spacing_sum / n_pairs
+            ## Coefficient of variation of spacing: 0 for perfectly even service
+            spacing_cv = np.sqrt(np.maximum(spacing_squares / n_pairs - mean_spacing ** 2, 0)) / mean_spacing
+
+        ## Lateness: sorted by group then minutes late, so medians are positional
+        has_late = np.isfinite(late)
+        late_order = np.lexsort((late, ~has_late, group_codes))
+        late_count = np.bincount(group_codes[has_late], minlength = n_groups)
+        late_sum = np.bincount(group_codes[has_late], weights = late[has_late], minlength = n_groups)
+        late_over = np.bincount(group_codes[has_late & (late >= LATE_MINUTES)], minlength = n_groups)
+        first_of_group = np.r_[0, np.cumsum(np.bincount(group_codes, minlength = n_groups))[:-1]]
+        sorted_late = late[late_order]
+        late_median = np.full(n_groups, np.nan)
+        late_max = np.full(n_groups, np.nan)
+        counted = late_count > 0
+        low = first_of_group[counted] + (late_count[counted] - 1) // 2
+        high = first_of_group[counted] + late_count[counted] // 2
+        late_median[counted] = (sorted_late[low] + sorted_late[high]) / 2
+        late_max[counted] = sorted_late[first_of_group[counted] + late_count[counted] - 1]
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            route_df = pd.DataFrame({
+                'route_id' : np.asarray(groups.get_level_values(0), dtype = object),
+                'direction' : np.asarray(groups.get_level_values(1), dtype = object),
+                'vehicles' : np.bincount(group_codes, minlength = n_groups),
+                'on_route' : on_axis_count,
+                'route_length' : group_length,
+                'even_spacing' : even_spacing,
+                'mean_spacing' : mean_spacing,
+                'min_spacing' : min_spacing,
+                'max_spacing' : max_spacing,
+                'spacing_cv' : spacing_cv,
+                'mean_headway' : mean_spacing / speeds,
+                'bunched' : np.bincount(group_codes[bunched], minlength = n_groups),
+                'gaps' : np.bincount(group_codes[gap], minlength = n_groups),
+                'late_mean' : late_sum / late_count,
+                'late_median' : late_median,
+                'late_max' : late_max,
+                'late_share' : late_over / late_count
+            })
+        return vehicle_df, route_df
+
+    def analyze_features(self, collection, route_speeds = None):
+        ## Vehicle FeatureCollection (TransitView or GTFS-realtime) to analyze()
+        from vehicle_cache import vehicle_key
+        features = collection['features']
+        coordinates = np.array([f['geometry']['coordinates'] for f in features], dtype = float).reshape(-1, 2)
+        properties = [f['properties'] for f in features]
+        return self.analyze(
+            [vehicle_key(f) for f in features],
+            [p.get('route_id') for p in properties],
+            [p.get('Direction', p.get('direction_id')) for p in properties],
+            coordinates[:, 0], coordinates[:, 1],
+            [p.get('late') for p in properties],
+            route_speeds = route_speeds
+        )
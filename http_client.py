@@ -0,0 +1,132 @@
+import io
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import counter, histogram
+
+## One pooled HTTP session for every upstream fetch (TransitView, GTFS-realtime, GitHub).
+## Connections are kept alive between polls, every request has a timeout, and failed
+## requests are retried with jittered exponential backoff. Settings come from the environment:
+##   HTTP_CONNECT_TIMEOUT (default 5s), HTTP_READ_TIMEOUT (default 20s), HTTP_RETRIES (default 3),
+##   HTTP_MAX_DOWNLOAD_BYTES (default 1 GB, the largest body read_into_memory accepts)
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 20))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+MAX_DOWNLOAD_BYTES = int(os.environ.get('HTTP_MAX_DOWNLOAD_BYTES', 1024 ** 3))
+BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+Fetched = namedtuple('Fetched', ['content', 'headers', 'not_modified'])
+
+UPSTREAM_SECONDS = histogram('upstream_request_duration_seconds', "Upstream GET time, retries and backoff included.", labels = ('host',))
+UPSTREAM_BYTES = counter('upstream_bytes_total', "Response bytes read from upstream.", labels = ('host',))
+UPSTREAM_NOT_MODIFIED = counter('upstream_not_modified_total', "Conditional fetches answered with 304 Not Modified.", labels = ('host',))
+
+_session = None
+_session_lock = threading.Lock()
+
+## url -> (ETag, Last-Modified, content) of the last full response, for conditional requests
+_validators = {}
+_validators_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = 8, pool_maxsize = 16)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+def request(method, url, timeout = None, retries = RETRIES, **kwargs):
+    ## Retries connection errors, timeouts and 429/5xx responses; other errors raise at once
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    for attempt in range(retries + 1):
+        try:
+            response = get_session().request(method, url, timeout = timeout, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                response.raise_for_status()
+                return response
+            response.close()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        ## Full jitter, so workers that failed together do not retry together
+        time.sleep(random.uniform(0, BACKOFF * 2 ** attempt))
+
+def fetch(url, conditional = True, **kwargs):
+    ## GET the whole body. With conditional, the last ETag/Last-Modified of this url is sent
+    ## and a 304 hands back the content from last time, with not_modified = True
+    headers = dict(kwargs.pop('headers', None) or {})
+    with _validators_lock:
+        cached = _validators.get(url) if conditional else None
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    host = urlsplit(url).netloc
+    start = time.perf_counter()
+    response = request('GET', url, headers = headers, **kwargs)
+    if response.status_code == 304 and cached is not None:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, host)
+        UPSTREAM_NOT_MODIFIED.inc(host)
+        return Fetched(cached[2], response.headers, True)
+
+    content = response.content
+    UPSTREAM_SECONDS.observe(time.perf_counter() - start, host)
+    UPSTREAM_BYTES.inc(host, amount = len(content))
+    if conditional and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+        with _validators_lock:
+            _validators[url] = (response.headers.get('ETag'), response.headers.get('Last-Modified'), content)
+    return Fetched(content, response.headers, False)
+
+def read_into_memory(url, max_bytes = None, chunk_size = 8 * 1024 * 1024, **kwargs):
+    ## GET a large body (the static release zip) into a BytesIO, streamed in big chunks, so
+    ## the body is held once rather than as a list of chunks plus their joined copy, and
+    ## refused past max_bytes, before the download when the server sends Content-Length
+    max_bytes = max_bytes or MAX_DOWNLOAD_BYTES
+    host = urlsplit(url).netloc
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    with request('GET', url, stream = True, **kwargs) as response:
+        length = int(response.headers.get('Content-Length') or 0)
+        if length > max_bytes:
+            raise ValueError(f"{url} is {length} bytes, over the {max_bytes} byte limit")
+        for chunk in response.iter_content(chunk_size = chunk_size):
+            buffer.write(chunk)
+            UPSTREAM_BYTES.inc(host, amount = len(chunk))
+            if buffer.tell() > max_bytes:
+                raise ValueError(f"{url} is over the {max_bytes} byte limit")
+    UPSTREAM_SECONDS.observe(time.perf_counter() - start, host)
+    buffer.seek(0)
+    return buffer
+
+def fetch_json(url, **kwargs):
+    return json.loads(fetch(url, **kwargs).content)
+
+## asyncio variants. The pooled session does the I/O on worker threads, so several feeds
+## are fetched concurrently over kept-alive connections
+
+async def fetch_async(url, **kwargs):
+    return await asyncio.to_thread(fetch, url, **kwargs)
+
+async def fetch_all_async(urls, **kwargs):
+    return await asyncio.gather(*[fetch_async(url, **kwargs) for url in urls])
+
+def fetch_all(urls, **kwargs):
+    ## Fetch several urls concurrently from synchronous code (not from inside a running event loop)
+    return asyncio.run(fetch_all_async(urls, **kwargs))
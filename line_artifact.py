@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import shutil
+from functools import lru_cache
+
+import numpy as np
+import shapely
+
+## Prebuilt route-line geometry that workers can memory-map at startup instead of
+## parsing the geojson. Layout of an artifact directory:
+##   coords.npy        float64 (n_points, 2) lon/lat of every line part, back to back
+##   part_offsets.npy  int64 (n_parts + 1) start of each part in coords
+##   route_parts.npy   int64 (n_routes + 1) start of each route's parts in part_offsets
+##   routes.json       route_id, route_name and color of each route, in artifact order
+##   fragments.bin     each route's GeoJSON Feature, compactly encoded, back to back
+##   fragment_offsets.npy  int64 (n_routes + 1) start of each route's feature in fragments.bin
+##   fragments.{t}.bin, fragment_offsets.{t}.npy  the same, simplified for LOD tier t
+##   stop_coords.npy   float64 (n_stops, 2) lon/lat of every stop, and stops.json their
+##                     stop_id and stop_name (when the database was reachable at build time)
+## `path` is a symlink to the current version, so a rebuild is swapped in atomically.
+
+## Level-of-detail tiers: (highest map zoom the tier is served at, Douglas-Peucker tolerance
+## in degrees). Each tolerance is about half a screen pixel at that zoom, so a zoomed-out
+## city view gets a fraction of the coordinates with no visible difference. Above the
+## last tier, full geometry is served.
+LOD_TIERS = [(11, 0.0003), (13, 0.00008), (15, 0.00002)]
+
+def lod_tier(zoom):
+    for tier, (max_zoom, _) in enumerate(LOD_TIERS):
+        if zoom is not None and zoom <= max_zoom:
+            return tier
+    return len(LOD_TIERS)
+
+def line_arrays(geometries):
+    part_geoms, part_route = shapely.get_parts(geometries, return_index = True)
+    coords, part_index = shapely.get_coordinates(part_geoms, return_index = True)
+    part_offsets = np.r_[0, np.cumsum(np.bincount(part_index, minlength = len(part_geoms)))]
+    route_parts = np.r_[0, np.cumsum(np.bincount(part_route, minlength = len(geometries)))]
+    return coords, part_offsets, route_parts
+
+def arrays_to_lines(coords, part_offsets, route_parts):
+    ## line_arrays back to one geometry per route: a LineString for routes of one part, else a MultiLineString
+    parts = shapely.linestrings(coords, indices = np.repeat(np.arange(len(part_offsets) - 1), np.diff(part_offsets)))
+    geometries = shapely.multilinestrings(parts, indices = np.repeat(np.arange(len(route_parts) - 1), np.diff(route_parts)))
+    single = np.diff(route_parts) == 1
+    geometries[single] = parts[route_parts[:-1][single]]
+    return geometries
+
+def route_feature(routes, i, parts):
+    ## parts: list of parts, each a list of [lon, lat]
+    if len(parts) == 1:
+        geometry = {'type' : 'LineString', 'coordinates' : parts[0]}
+    else:
+        geometry = {'type' : 'MultiLineString', 'coordinates' : parts}
+    return {
+        'type' : 'Feature',
+        'properties' : {
+            'route_id' : routes['route_id'][i],
+            'route_name' : routes['route_name'][i],
+            'color' : routes['color'][i]
+        },
+        'geometry' : geometry
+    }
+
+def encode_fragments(routes, coords, part_offsets, route_parts, precision = 5):
+    ## precision is the number of decimals kept per coordinate (5 is about a meter); None keeps all
+    coords = coords if precision is None else np.round(coords, precision)
+    fragments = []
+    for i in range(len(routes['route_id'])):
+        parts = part_offsets[route_parts[i]:route_parts[i + 1] + 1]
+        parts = [coords[start:end].tolist() for start, end in zip(parts[:-1], parts[1:])]
+        fragments.append(json.dumps(route_feature(routes, i, parts), separators = (',', ':')).encode())
+    return fragments
+
+def tier_fragments(routes, coords, part_offsets, route_parts, tolerance = None, precision = 5):
+    ## Fragments of one LOD tier (simplified with tolerance), or of the full geometry
+    if tolerance is not None:
+        simplified = shapely.simplify(arrays_to_lines(coords, part_offsets, route_parts), tolerance, preserve_topology = False)
+        coords, part_offsets, route_parts = line_arrays(simplified)
+    return encode_fragments(routes, coords, part_offsets, route_parts, precision)
+
+def write_fragments(version_path, fragments, suffix = ''):
+    with open(os.path.join(version_path, f"fragments{suffix}.bin"), 'wb') as f:
+        f.write(b''.join(fragments))
+    np.save(os.path.join(version_path, f"fragment_offsets{suffix}.npy"), np.r_[0, np.cumsum([len(b) for b in fragments])].astype(np.int64))
+
+def write_line_artifact(lines_df, path = './data/line_artifact', precision = 5, workers = 1, stops = None):
+    ## stops: DataFrame of stop_id, stop_name, stop_lat, stop_lon (storage.get_stops()), stored for the spatial index
+    coords, part_offsets, route_parts = line_arrays(lines_df.geometry.to_numpy())
+    routes = {
+        'route_id' : [str(r) for r in lines_df['route_id']],
+        'route_name' : [None if n is None else str(n) for n in lines_df['route_name']],
+        'color' : [c if isinstance(c, str) else None for c in lines_df['color']]
+    }
+
+    version_path = f"{path}.{time.time_ns()}"
+    os.makedirs(version_path)
+    np.save(os.path.join(version_path, 'coords.npy'), coords.astype(np.float64))
+    np.save(os.path.join(version_path, 'part_offsets.npy'), part_offsets.astype(np.int64))
+    np.save(os.path.join(version_path, 'route_parts.npy'), route_parts.astype(np.int64))
+    with open(os.path.join(version_path, 'routes.json'), 'w') as f:
+        json.dump(routes, f)
+    if stops is not None and len(stops) > 0:
+        np.save(os.path.join(version_path, 'stop_coords.npy'), stops[['stop_lon', 'stop_lat']].astype(float).to_numpy())
+        with open(os.path.join(version_path, 'stops.json'), 'w') as f:
+            json.dump({'stop_id' : [str(s) for s in stops['stop_id']], 'stop_name' : [None if n is None else str(n) for n in stops['stop_name']]}, f)
+
+    ## Encode every route's feature once per tier; any selection is then a concatenation of these.
+    ## Tiers are simplified and encoded on the geometry process pool (see route_geometry.py)
+    from route_geometry import map_chunks
+    tolerances = [None] + [tolerance for _, tolerance in LOD_TIERS]
+    tiers = map_chunks(tier_fragments, [(routes, coords, part_offsets, route_parts, t, precision) for t in tolerances], workers)
+    write_fragments(version_path, tiers[0])
+    for tier, fragments in enumerate(tiers[1:]):
+        write_fragments(version_path, fragments, f".{tier}")
+
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    link_tmp = f"{path}.link"
+    if os.path.lexists(link_tmp):
+        os.remove(link_tmp)
+    os.symlink(os.path.basename(version_path), link_tmp)
+    os.replace(link_tmp, path)
+    ## Workers still mapping the previous version keep their open inodes
+    if previous is not None and previous != os.path.realpath(path):
+        shutil.rmtree(previous, ignore_errors = True)
+    print(f"Line artifact written to {version_path}: {len(routes['route_id'])} routes, {len(coords)} points.")
+    return path
+
+class LineArtifact:
+    def __init__(self, path = './data/line_artifact', selection_cache_size = 256):
+        self.path = path
+        self.version = os.path.realpath(path)
+        self.coords = np.load(os.path.join(self.version, 'coords.npy'), mmap_mode = 'r')
+        self.part_offsets = np.load(os.path.join(self.version, 'part_offsets.npy'), mmap_mode = 'r')
+        self.route_parts = np.load(os.path.join(self.version, 'route_parts.npy'), mmap_mode = 'r')
+        with open(os.path.join(self.version, 'routes.json'), 'r') as f:
+            self.routes = json.load(f)
+        self.route_index = {r : i for i, r in enumerate(self.routes['route_id'])}
+        ## Columns of stop_id, stop_name, stop_lon, stop_lat, or None when the artifact has no stops
+        self.stops = None
+        if os.path.exists(os.path.join(self.version, 'stops.json')):
+            with open(os.path.join(self.version, 'stops.json'), 'r') as f:
+                self.stops = json.load(f)
+            stop_coords = np.load(os.path.join(self.version, 'stop_coords.npy'))
+            self.stops.update(stop_lon = stop_coords[:, 0], stop_lat = stop_coords[:, 1])
+
+        if os.path.exists(os.path.join(self.version, 'fragments.bin')):
+            self.fragments, self.fragment_offsets = self._load_fragments('')
+        else:
+            fragments = self.encode_fragments()
+            self.fragments = np.frombuffer(b''.join(fragments), dtype = np.uint8)
+            self.fragment_offsets = np.r_[0, np.cumsum([len(b) for b in fragments])]
+        ## (fragments, offsets) per LOD tier, the last one being full geometry; artifacts
+        ## written before tiers existed serve full geometry at every zoom
+        self.tiers = [self._load_fragments(f".{tier}") if os.path.exists(os.path.join(self.version, f"fragments.{tier}.bin"))
+                      else (self.fragments, self.fragment_offsets) for tier in range(len(LOD_TIERS))]
+        self.tiers.append((self.fragments, self.fragment_offsets))
+        self.selection_bytes = lru_cache(maxsize = selection_cache_size)(self._selection_bytes)
+
+    def _load_fragments(self, suffix):
+        return (np.memmap(os.path.join(self.version, f"fragments{suffix}.bin"), dtype = np.uint8, mode = 'r'),
+                np.load(os.path.join(self.version, f"fragment_offsets{suffix}.npy")))
+
+    def is_current(self):
+        return os.path.realpath(self.path) == self.version
+
+    def route_coordinates(self, i, coords = None):
+        ## List of parts, each a list of [lon, lat]
+        coords = self.coords if coords is None else coords
+        parts = self.part_offsets[self.route_parts[i]:self.route_parts[i + 1] + 1]
+        return [coords[start:end].tolist() for start, end in zip(parts[:-1], parts[1:])]
+
+    def route_feature(self, i, coords = None):
+        return route_feature(self.routes, i, self.route_coordinates(i, coords))
+
+    def route_indices(self, route_ids = 'all'):
+        if route_ids == 'all':
+            return range(len(self.routes['route_id']))
+        if type(route_ids) in (str, int):
+            route_ids = [route_ids]
+        return [self.route_index[str(r)] for r in route_ids if str(r) in self.route_index]
+
+    def to_geojson(self, route_ids = 'all'):
+        return {
+            'type' : 'FeatureCollection',
+            'features' : [self.route_feature(i) for i in self.route_indices(route_ids)]
+        }
+
+    def encode_fragments(self, precision = 5):
+        return encode_fragments(self.routes, self.coords, self.part_offsets, self.route_parts, precision)
+
+    def _selection_bytes(self, route_ids = 'all', tier = None):
+        ## route_ids must be hashable: 'all' or a sorted tuple. tier None is full geometry
+        fragments, offsets = self.tiers[-1 if tier is None else tier]
+        fragments = [fragments[offsets[i]:offsets[i + 1]].tobytes() for i in sorted(self.route_indices(route_ids))]
+        return b'{"type":"FeatureCollection","features":[' + b','.join(fragments) + b']}'
+
+def load_line_artifact(path = './data/line_artifact', geojson_filename = './data/all_bus_lines.geojson'):
+    if not os.path.exists(path):
+        ## First start without a prebuilt artifact: build it from the geojson (or the database)
+        from gtfs_tools import get_lines_json
+        from gtfs_storage import get_storage
+        from spatial_index import read_stops
+        write_line_artifact(get_lines_json(geojson_filename), path, stops = read_stops(get_storage()))
+    return LineArtifact(path)
@@ -0,0 +1,275 @@
+import os
+import sys
+import math
+import shutil
+import time
+import bisect
+import threading
+from functools import wraps
+from collections import Counter as StackCounter
+
+## Process-local timing spans, counters and gauges, rendered in the Prometheus text format
+## at /metrics. Recording a sample is a dict lookup, a bisect and two adds under a lock,
+## about a microsecond, so the instrumentation stays on in production. Every gunicorn
+## worker keeps its own numbers; scrape each worker, or sum them in Prometheus.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels = (), function = None):
+        ## function: called at scrape time, returning {label values tuple : value}, for
+        ## numbers that are already counted elsewhere (cache_info, subscriber counts, ...)
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def values(self):
+        if self.function is not None:
+            return dict(self.function())
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for labels, value in sorted(self.values().items()):
+            yield self.name, _format_labels(self.label_names, labels), value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        ## Per label set: a count for each bucket and one for +Inf, then the running sum
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def values(self):
+        with self._lock:
+            return {labels : list(counts) for labels, counts in self._values.items()}
+
+    def samples(self):
+        names = self.label_names + ('le',)
+        for labels, counts in sorted(self.values().items()):
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+                total += count
+                yield f"{self.name}_bucket", _format_labels(names, labels + (_format_value(bound),)), total
+            yield f"{self.name}_sum", _format_labels(self.label_names, labels), counts[-1]
+            yield f"{self.name}_count", _format_labels(self.label_names, labels), total
+
+def _register(cls, name, *args, **kwargs):
+    ## Get or create, so modules can declare the metrics they record at import
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, *args, **kwargs)
+        return _metrics[name]
+
+def counter(name, help, labels = (), function = None):
+    return _register(Counter, name, help, labels, function = function)
+
+def gauge(name, help, labels = (), function = None):
+    return _register(Gauge, name, help, labels, function = function)
+
+def histogram(name, help, labels = (), buckets = LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets = buckets)
+
+def render():
+    ## Every metric in the Prometheus text exposition format (version 0.0.4)
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print(f"Metric {metric.name} failed: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+SPANS = histogram('span_duration_seconds', "Wall time of instrumented code paths.", labels = ('span',))
+SPAN_ERRORS = counter('span_errors_total', "Instrumented code paths that raised.", labels = ('span',))
+
+class span:
+    """
+    Times a block into span_duration_seconds{span=name}, as a context manager
+    (`with span('encode'):`) or a decorator (`@span('get_bus_lines')`).
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        SPANS.observe(time.perf_counter() - self.start, self.name)
+        if exc_type is not None:
+            SPAN_ERRORS.inc(self.name)
+
+    def __call__(self, function):
+        name = self.name
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                SPAN_ERRORS.inc(name)
+                raise
+            finally:
+                SPANS.observe(time.perf_counter() - start, name)
+        return timed
+
+class SamplingProfiler:
+    """
+    Samples the stack of every other thread every `interval` seconds and counts them,
+    for flame graphs in the collapsed format ("frame;frame;frame count" per line)
+    that flamegraph.pl and speedscope read. Only runs when started.
+    """
+
+    def __init__(self, interval = 0.01, max_depth = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = 'sampling-profiler', daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _frame_name(self, frame):
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+    def sample(self):
+        own = threading.get_ident()
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            names = []
+            while frame is not None and len(names) < self.max_depth:
+                names.append(self._frame_name(frame))
+                frame = frame.f_back
+            stacks.append(';'.join(reversed(names)))
+        with self._lock:
+            self.stacks.update(stacks)
+            self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def collapsed(self):
+        with self._lock:
+            return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+class DiskSampler:
+    """
+    Peak disk use while running, sampled every `interval` seconds: the total size of the
+    files under `directory`, or with files = False how far the free space of its filesystem
+    fell below where it started (which also counts files written and removed elsewhere,
+    without walking the directory). Use as a context manager; `peak` is in bytes.
+    """
+
+    def __init__(self, directory, interval = 0.02, files = True):
+        self.directory = directory
+        self.interval = interval
+        self.files = files
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def size(self):
+        if not self.files:
+            return self._start_free - shutil.disk_usage(self.directory).free
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, file))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.size())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._start_free = shutil.disk_usage(self.directory).free
+        self._thread = threading.Thread(target = self._run, name = 'disk-sampler', daemon = True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.size())
@@ -0,0 +1,92 @@
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+
+from line_artifact import line_arrays, arrays_to_lines, route_feature
+
+## Per-route geometry work of get_bus_lines (merging each route's shapes, then encoding the
+## routes as GeoJSON) and of write_line_artifact (simplifying and encoding each LOD tier),
+## split into chunks of routes that can run on a process pool. Chunks are sent as flat
+## coordinate arrays, not GeoDataFrames, and results are put back together in route order,
+## so the output is the same with any number of workers.
+## Every function runs in this process unless given workers > 1. Pool workers are spawned,
+## and spawned processes re-import the __main__ script, so only `python build_static.py`
+## asks for a pool (GEOMETRY_WORKERS, default every core): refreshes in a web worker and
+## the artifact build on a first start run while application.py is being imported.
+
+def geometry_workers(workers = None):
+    if workers is None:
+        workers = int(os.environ.get('GEOMETRY_WORKERS', 0)) or os.cpu_count() or 1
+    return max(1, workers)
+
+def chunk_bounds(n_routes, chunk_size):
+    return [(start, min(start + chunk_size, n_routes)) for start in range(0, n_routes, chunk_size)]
+
+def map_chunks(function, tasks, workers):
+    ## function over tasks, in order; in this process when one worker (or one task) is enough
+    workers = min(max(1, workers), len(tasks))
+    if workers <= 1:
+        return [function(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(function, *zip(*tasks)))
+
+def merge_chunk(coords, shape_counts, shape_route):
+    ## Shapes of a chunk of routes (shape_route: each shape's route within the chunk) to one
+    ## merged line per route, returned in the line artifact layout
+    lines = shapely.linestrings(coords, indices = np.repeat(np.arange(len(shape_counts)), shape_counts))
+    merged = shapely.line_merge(shapely.multilinestrings(lines, indices = shape_route))
+    return line_arrays(merged)
+
+def merge_route_lines(coords, shape_counts, shape_route, n_routes, workers = 1, chunk_size = 8):
+    ## coords: every shape's points back to back, shapes sorted by route; shape_counts: points
+    ## per shape; shape_route: route index of each shape (0 .. n_routes - 1, ascending).
+    ## Returns one (Multi)LineString per route
+    shape_offsets = np.r_[0, np.cumsum(shape_counts)]
+    route_shapes = np.searchsorted(shape_route, np.arange(n_routes + 1))
+    tasks = []
+    for start, end in chunk_bounds(n_routes, chunk_size):
+        first, last = route_shapes[start], route_shapes[end]
+        tasks.append((coords[shape_offsets[first]:shape_offsets[last]], shape_counts[first:last], shape_route[first:last] - start))
+    results = map_chunks(merge_chunk, tasks, workers)
+
+    ## Chunk arrays back into one layout, offsets shifted past the chunks before
+    merged_coords = np.concatenate([r[0] for r in results]) if results else np.empty((0, 2))
+    point_shift = np.r_[0, np.cumsum([len(r[0]) for r in results])]
+    part_shift = np.r_[0, np.cumsum([len(r[1]) - 1 for r in results])]
+    part_offsets = np.concatenate([[0]] + [r[1][1:] + point_shift[i] for i, r in enumerate(results)])
+    route_parts = np.concatenate([[0]] + [r[2][1:] + part_shift[i] for i, r in enumerate(results)])
+    return arrays_to_lines(merged_coords, part_offsets, route_parts)
+
+def encode_chunk(routes, coords, part_offsets, route_parts):
+    ## One GeoJSON Feature per route, as text
+    features = []
+    for i in range(len(routes['route_id'])):
+        parts = part_offsets[route_parts[i]:route_parts[i + 1] + 1]
+        parts = [coords[start:end].tolist() for start, end in zip(parts[:-1], parts[1:])]
+        features.append(json.dumps(route_feature(routes, i, parts)))
+    return features
+
+def write_lines_geojson(lines_df, filename, workers = 1, chunk_size = 8):
+    ## The route lines as a GeoJSON FeatureCollection (route_id, route_name, color), one
+    ## feature per line, encoded in chunks of routes on the pool
+    coords, part_offsets, route_parts = line_arrays(lines_df.geometry.to_numpy())
+    routes = {
+        'route_id' : [str(r) for r in lines_df['route_id']],
+        'route_name' : [None if n is None else str(n) for n in lines_df['route_name']],
+        'color' : [c if isinstance(c, str) else None for c in lines_df['color']]
+    }
+    tasks = []
+    for start, end in chunk_bounds(len(routes['route_id']), chunk_size):
+        first, last = route_parts[start], route_parts[end]
+        tasks.append(({k : v[start:end] for k, v in routes.items()}, coords[part_offsets[first]:part_offsets[last]],
+                      part_offsets[first:last + 1] - part_offsets[first], route_parts[start:end + 1] - first))
+    features = [f for chunk in map_chunks(encode_chunk, tasks, workers) for f in chunk]
+    with open(filename, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        f.write(',\n'.join(features))
+        f.write('\n]}\n')
+    return filename
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+## STRtree over route line parts and stops, for "which routes/stops are here" and
+## "is this bus on its route" questions without scanning every line.
+## Geometries are kept in a local equirectangular frame (meters east/north), so
+## distances and nearest queries are in meters; results are returned in lon/lat.
+
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LON = 111320.0
+
+class RouteSpatialIndex:
+    def __init__(self, route_ids, coords, part_offsets, part_route, stops = None, origin_lat = 39.95, piece_size = 16):
+        ## coords: lon/lat of every line part back to back, part_offsets: start of each part
+        ## in coords (n_parts + 1), part_route: route index of each part (the line artifact layout)
+        self.route_ids = np.array([str(r) for r in route_ids], dtype = object)
+        self.route_lookup = pd.Index(self.route_ids)
+        self.kx = METERS_PER_DEGREE_LON * np.cos(np.radians(origin_lat))
+        self.ky = METERS_PER_DEGREE_LAT
+
+        ## Lines are cut into pieces of at most piece_size segments, so tree hits are
+        ## tight and each distance is computed against a handful of vertices, not a whole route
+        coords = np.asarray(coords, dtype = float) * [self.kx, self.ky]
+        part_offsets = np.asarray(part_offsets, dtype = np.int64)
+        part_route = np.asarray(part_route, dtype = np.int64)
+        n_segments = np.maximum(np.diff(part_offsets) - 1, 0)
+        n_pieces = -(-n_segments // piece_size)
+        piece_part = np.repeat(np.arange(len(n_segments)), n_pieces)
+        piece_start = part_offsets[piece_part] + (np.arange(len(piece_part)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)) * piece_size
+        piece_end = np.minimum(piece_start + piece_size, part_offsets[piece_part + 1] - 1)
+        piece_length = piece_end - piece_start + 1
+        vertex = np.repeat(piece_start - np.r_[0, np.cumsum(piece_length)[:-1]], piece_length) + np.arange(piece_length.sum())
+        self.pieces = shapely.linestrings(coords[vertex], indices = np.repeat(np.arange(len(piece_part)), piece_length))
+        self.piece_route = part_route[piece_part]
+        self.line_tree = shapely.STRtree(self.pieces)
+
+        self.stops = None
+        self.stop_tree = None
+        if stops is not None and len(stops) > 0:
+            self.stops = stops.reset_index(drop = True)
+            x, y = self._xy(self.stops['stop_lon'].astype(float).to_numpy(), self.stops['stop_lat'].astype(float).to_numpy())
+            self.stop_tree = shapely.STRtree(shapely.points(x, y))
+
+    @classmethod
+    def from_lines(cls, lines_df, stops = None, **kwargs):
+        parts, part_route = shapely.get_parts(lines_df.geometry.to_numpy(), return_index = True)
+        coords, part_index = shapely.get_coordinates(parts, return_index = True)
+        part_offsets = np.r_[0, np.cumsum(np.bincount(part_index, minlength = len(parts)))]
+        return cls(lines_df['route_id'].tolist(), coords, part_offsets, part_route, stops, **kwargs)
+
+    @classmethod
+    def from_artifact(cls, artifact, stops = None, **kwargs):
+        route_parts = np.asarray(artifact.route_parts)
+        part_route = np.repeat(np.arange(len(route_parts) - 1), np.diff(route_parts))
+        return cls(artifact.routes['route_id'], artifact.coords, artifact.part_offsets, part_route, stops, **kwargs)
+
+    def _xy(self, lons, lats):
+        return np.asarray(lons, dtype = float) * self.kx, np.asarray(lats, dtype = float) * self.ky
+
+    def _to_lonlat(self, x, y):
+        return x / self.kx, y / self.ky
+
+    def _bbox(self, min_lon, min_lat, max_lon, max_lat):
+        (x0, x1), (y0, y1) = self._xy([min_lon, max_lon], [min_lat, max_lat])
+        return shapely.box(x0, y0, x1, y1)
+
+    def routes_in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        ## Routes with any part crossing the box, in index order
+        hits = self.line_tree.query(self._bbox(min_lon, min_lat, max_lon, max_lat), predicate = 'intersects')
+        return self.route_ids[np.unique(self.piece_route[hits])].tolist()
+
+    def stops_in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        if self.stop_tree is None:
+            return pd.DataFrame(columns = ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+        hits = self.stop_tree.query(self._bbox(min_lon, min_lat, max_lon, max_lat), predicate = 'intersects')
+        return self.stops.iloc[np.sort(hits)]
+
+    def nearest_routes(self, lons, lats, max_distance = None):
+        ## Nearest route (any route) to each point: route_id and distance in meters
+        lons = np.atleast_1d(lons)
+        x, y = self._xy(lons, np.atleast_1d(lats))
+        (points, pieces), distances = self.line_tree.query_nearest(shapely.points(x, y), max_distance = max_distance,
+                                                                  return_distance = True, all_matches = False)
+        route_id = np.full(len(lons), None, dtype = object)
+        distance = np.full(len(lons), np.nan)
+        route_id[points] = self.route_ids[self.piece_route[pieces]]
+        distance[points] = distances
+        return pd.DataFrame({'route_id' : route_id, 'distance' : distance})
+
+    def snap(self, route_ids, lons, lats, max_distance = 50):
+        ## Snap each point onto its own route, in one batch. on_route is whether the point is
+        ## within max_distance meters of its route; points further away (or on an unknown
+        ## route) are not snapped and get NaN
+        x, y = self._xy(lons, lats)
+        route_positions = self.route_lookup.get_indexer(pd.Index([str(r) for r in route_ids], dtype = object))
+        points = shapely.points(x, y)
+
+        ## Candidate pieces near each point, kept only when they belong to the point's own route
+        ## (a box query only compares envelopes; exact distances are computed after the route filter)
+        point_index, piece_index = self.line_tree.query(shapely.box(x - max_distance, y - max_distance, x + max_distance, y + max_distance))
+        own = self.piece_route[piece_index] == route_positions[point_index]
+        point_index, piece_index = point_index[own], piece_index[own]
+        distances = shapely.distance(points[point_index], self.pieces[piece_index])
+        near = distances <= max_distance
+        point_index, piece_index, distances = point_index[near], piece_index[near], distances[near]
+        ## Closest candidate per point
+        order = np.lexsort((distances, point_index))
+        first = order[np.r_[True, point_index[order][1:] != point_index[order][:-1]]] if len(order) else order
+        best_point, best_piece = point_index[first], piece_index[first]
+
+        snapped = shapely.get_point(shapely.shortest_line(points[best_point], self.pieces[best_piece]), 1)
+        distance = np.full(len(x), np.nan)
+        snapped_x = np.full(len(x), np.nan)
+        snapped_y = np.full(len(x), np.nan)
+        distance[best_point] = distances[first]
+        snapped_x[best_point] = shapely.get_x(snapped)
+        snapped_y[best_point] = shapely.get_y(snapped)
+        snapped_lon, snapped_lat = self._to_lonlat(snapped_x, snapped_y)
+        return pd.DataFrame({
+            'snapped_lon' : snapped_lon,
+            'snapped_lat' : snapped_lat,
+            'snap_distance' : distance,
+            'on_route' : ~np.isnan(distance)
+        })
+
+    def snap_vehicles(self, vehicles_df, max_distance = 50):
+        ## vehicles_df as returned by transitview_to_df: route_id and Point geometry
+        geometry = vehicles_df.geometry.to_numpy()
+        snapped = self.snap(vehicles_df['route_id'].to_numpy(), shapely.get_x(geometry), shapely.get_y(geometry), max_distance)
+        snapped.index = vehicles_df.index
+        return vehicles_df.join(snapped)
+
+def read_stops(storage = None):
+    ## Stops are optional: without a reachable database only route queries are available
+    try:
+        return storage.get_stops() if storage is not None else None
+    except Exception as e:
+        print(f"Stops not loaded into the spatial index: {e}")
+        return None
+
+def load_route_index(artifact, storage = None):
+    ## Stops come from the artifact; only artifacts built without them query storage
+    stops = pd.DataFrame(artifact.stops) if artifact.stops is not None else read_stops(storage)
+    return RouteSpatialIndex.from_artifact(artifact, stops)
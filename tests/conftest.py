@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+
+## gtfs_tools reads ./data/route_colors.json at import, so run from the repo root
+os.chdir(REPO)
+
+@pytest.fixture(scope = 'session')
+def stub():
+    ## The realtime stub server, with the TransitView vehicles moving on every request
+    from stub_server import start_stub_server
+    server, base_url = start_stub_server(move = True)
+    yield server, base_url
+    server.shutdown()
@@ -0,0 +1,18 @@
+import pytest
+
+from http_client import read_into_memory
+
+VEHICLE_PATH = '/gtfsrt/septa-pa-us/Vehicle/rtVehiclePosition.pb'
+
+def test_read_into_memory(stub):
+    server, base_url = stub
+    body = read_into_memory(f"{base_url}{VEHICLE_PATH}", chunk_size = 1024)
+    assert body.tell() == 0
+    assert body.getvalue() == server.feeds[VEHICLE_PATH]
+
+def test_read_into_memory_refuses_large_bodies(stub):
+    server, base_url = stub
+    size = len(server.feeds[VEHICLE_PATH])
+    with pytest.raises(ValueError):
+        read_into_memory(f"{base_url}{VEHICLE_PATH}", max_bytes = size - 1)
+    assert read_into_memory(f"{base_url}{VEHICLE_PATH}", max_bytes = size).getbuffer().nbytes == size
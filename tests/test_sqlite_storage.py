@@ -0,0 +1,102 @@
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import REPO
+from synthetic_gtfs import make_feed, write_feed
+from gtfs_storage import SQLiteStorage
+from gtfs_tools import create_gtfs_database, gtfs_group_keys, hash_gtfs_group_rows
+
+def load(directory, feed):
+    ## A SQLite database of feed, loaded the way build_static.py loads a new release
+    feed_dir = os.path.join(directory, 'google_bus', '')
+    write_feed(feed, feed_dir)
+    storage = SQLiteStorage(os.path.join(directory, 'gtfs.sqlite'))
+    create_gtfs_database(os.path.join(REPO, 'create_gtfs_db.sql'), gtfs_filepath = feed_dir,
+                         index_file = os.path.join(REPO, 'create_gtfs_indexes.sql'), workers = 1, storage = storage)
+    return storage, feed_dir
+
+def read_csv(feed_dir, file):
+    ## As update_gtfs_database_incremental reads a changed file
+    return pd.read_csv(os.path.join(feed_dir, file), dtype = str, keep_default_na = False)
+
+def table(storage, name):
+    df = storage.read_table(name)
+    return df.sort_values(list(df.columns)).reset_index(drop = True)
+
+@pytest.fixture(scope = 'module')
+def feed():
+    return make_feed(n_routes = 8, shapes_per_route = 2, points_per_shape = 20, trips_per_shape = 3, stops_per_trip = 5, n_stops = 250)
+
+@pytest.fixture
+def loaded(tmp_path, feed):
+    return load(str(tmp_path / 'old'), feed)
+
+def changed_feed(feed):
+    ## A later release: a renamed stop with a quoted comma, one stop dropped and one added,
+    ## a route renamed and the trips of another given a new headsign
+    feed = {file : df.copy() for file, df in feed.items()}
+    stops = feed['stops.txt']
+    stops.loc[0, 'stop_name'] = 'Broad St, Olney "Loop"'
+    added = stops.iloc[[1]].assign(stop_id = 1000, stop_name = 'New Stop, Southbound')
+    feed['stops.txt'] = pd.concat([stops.iloc[[0]], stops.iloc[2:], added], ignore_index = True)
+    routes = feed['routes.txt']
+    routes.loc[0, 'route_long_name'] = 'Route 1, Express'
+    trips = feed['trips.txt']
+    trips.loc[trips['route_id'] == trips.loc[0, 'route_id'], 'trip_headsign'] = 'Frankford, via Broad'
+    return feed
+
+def test_queries_match_the_csvs(loaded, feed):
+    storage, _ = loaded
+    stops = storage.get_stops().sort_values('stop_id').reset_index(drop = True)
+    expected = feed['stops.txt'][['stop_id', 'stop_name', 'stop_lat', 'stop_lon']].sort_values('stop_id').reset_index(drop = True)
+    pd.testing.assert_frame_equal(stops, expected, check_dtype = False)
+
+    assert sorted(storage.get_route_ids()) == sorted(feed['routes.txt']['route_id'])
+
+    points = storage.get_shape_points()
+    shapes = feed['shapes.txt']
+    assert len(points) == len(shapes)
+    ## Each shape is labelled with the route of its trips, and its points are unchanged
+    shape_route = feed['trips.txt'].groupby('shape_id')['route_id'].min()
+    assert (points['route_id'].to_numpy() == shape_route.loc[points['shape_id']].to_numpy()).all()
+    merged = points.merge(shapes, on = ['shape_id', 'shape_pt_sequence'], suffixes = ('', '_csv'))
+    assert len(merged) == len(shapes)
+    assert (merged['shape_pt_lat'] == merged['shape_pt_lat_csv']).all()
+    assert (merged['shape_pt_lon'] == merged['shape_pt_lon_csv']).all()
+    route_names = feed['routes.txt'].set_index('route_id')['route_long_name']
+    assert (points['route_long_name'].to_numpy() == route_names.loc[points['route_id']].to_numpy()).all()
+
+    one_route = storage.get_shape_points(['2'])
+    assert set(one_route['route_id']) == {'2'}
+    assert len(one_route) == (shape_route == '2').sum() * 20
+
+def test_group_changes_match_a_full_reload(loaded, feed, tmp_path):
+    storage, old_dir = loaded
+    new = changed_feed(feed)
+    reloaded, new_dir = load(str(tmp_path / 'new'), new)
+
+    for file in ('stops.txt', 'routes.txt', 'trips.txt'):
+        name = file.replace('.txt', '')
+        key = gtfs_group_keys[name]
+        old_groups = hash_gtfs_group_rows(read_csv(old_dir, file), key)
+        df = read_csv(new_dir, file)
+        groups = hash_gtfs_group_rows(df, key)
+        changed = [k for k, h in groups.items() if old_groups.get(k) != h]
+        removed = [k for k in old_groups if k not in groups]
+        assert changed
+        storage.apply_group_changes(name, key, df.loc[df[key].isin(changed)], changed + removed)
+        pd.testing.assert_frame_equal(table(storage, name), table(reloaded, name))
+
+    assert 'Broad St, Olney "Loop"' in set(storage.get_stops()['stop_name'])
+
+def test_replace_table_matches_a_full_reload(loaded, feed, tmp_path):
+    storage, _ = loaded
+    new = changed_feed(feed)
+    reloaded, new_dir = load(str(tmp_path / 'new'), new)
+
+    for file in ('stops.txt', 'routes.txt'):
+        with open(os.path.join(new_dir, file), 'rb') as f:
+            storage.replace_table(file.replace('.txt', ''), f)
+        pd.testing.assert_frame_equal(table(storage, file.replace('.txt', '')), table(reloaded, file.replace('.txt', '')))
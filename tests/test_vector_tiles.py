@@ -0,0 +1,186 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from line_artifact import LineArtifact, write_line_artifact
+from vector_tiles import LineTiles, EXTENT, BUFFER, LAYER_NAME, lonlat_to_world
+
+## A minimal Mapbox Vector Tile reader (mapbox-vector-tile is not a dependency): protobuf
+## varint and length-delimited fields, and the geometry command stream of spec 2.1
+
+def read_varint(data, i):
+    value, shift = 0, 0
+    while True:
+        byte = data[i]
+        value |= (byte & 0x7f) << shift
+        i += 1
+        if not byte & 0x80:
+            return value, i
+        shift += 7
+
+def read_fields(data):
+    ## [(field number, value)]: ints for varints, bytes for length-delimited fields
+    fields, i = [], 0
+    while i < len(data):
+        key, i = read_varint(data, i)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, i = read_varint(data, i)
+        elif wire_type == 2:
+            length, i = read_varint(data, i)
+            value, i = bytes(data[i:i + length]), i + length
+        else:
+            raise ValueError(f"unexpected wire type {wire_type}")
+        fields.append((number, value))
+    return fields
+
+def read_packed(data):
+    values, i = [], 0
+    while i < len(data):
+        value, i = read_varint(data, i)
+        values.append(value)
+    return values
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def decode_geometry(commands):
+    ## Line parts in tile coordinates, from MoveTo (1) / LineTo (2) commands with zigzag deltas
+    parts, x, y, i = [], 0, 0, 0
+    while i < len(commands):
+        command, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        assert command in (1, 2)
+        if command == 1:
+            assert count == 1
+            parts.append([])
+        for _ in range(count):
+            x, y = x + unzigzag(commands[i]), y + unzigzag(commands[i + 1])
+            i += 2
+            parts[-1].append((x, y))
+    return parts
+
+def decode_tile(data):
+    layers = []
+    for number, layer_bytes in read_fields(data):
+        assert number == 3
+        layer = {'features' : [], 'keys' : [], 'values' : []}
+        for field, value in read_fields(layer_bytes):
+            if field == 1:
+                layer['name'] = value.decode()
+            elif field == 2:
+                feature = dict(read_fields(value))
+                layer['features'].append({'id' : feature[1], 'tags' : read_packed(feature[2]), 'type' : feature[3],
+                                          'geometry' : decode_geometry(read_packed(feature[4]))})
+            elif field == 3:
+                layer['keys'].append(value.decode())
+            elif field == 4:
+                (string_field, string), = read_fields(value)
+                assert string_field == 1
+                layer['values'].append(string.decode())
+            elif field == 5:
+                layer['extent'] = value
+            elif field == 15:
+                layer['version'] = value
+        layers.append(layer)
+    return layers
+
+## Zoom of the test tile, and three routes around City Hall: a zigzag, a route of two parts
+## (the cursor carries over between them) and one without a name
+Z = 12
+CENTER = (-75.1636, 39.9526)
+
+def zigzag(lon, lat, n, step = 0.0008):
+    return [(lon + i * step, lat + (i % 2) * step) for i in range(n)]
+
+@pytest.fixture(scope = 'module')
+def tiles(tmp_path_factory):
+    lon, lat = CENTER
+    lines = pd.DataFrame({
+        'route_id' : ['23', '47', 'L1'],
+        'route_name' : ['Route 23, Germantown', 'Route 47', None],
+        'color' : ['#ff0000', '#00ff00', '#0000ff'],
+        'geometry' : [
+            shapely.LineString(zigzag(lon, lat, 8)),
+            shapely.MultiLineString([zigzag(lon, lat - 0.004, 5), zigzag(lon + 0.002, lat + 0.004, 4)]),
+            shapely.LineString(zigzag(lon - 0.005, lat - 0.002, 3)),
+        ]
+    })
+    path = str(tmp_path_factory.mktemp('artifact') / 'line_artifact')
+    write_line_artifact(lines, path)
+    artifact = LineArtifact(path)
+    return LineTiles(artifact, cache_dir = str(tmp_path_factory.mktemp('tiles')))
+
+def tile_of(lon, lat, z):
+    world = lonlat_to_world(np.array([[lon, lat]]))[0]
+    return int(world[0] * 2 ** z), int(world[1] * 2 ** z)
+
+def expected_parts(artifact, route, x, y, z):
+    ## The route's parts from the artifact, in the tile's integer coordinates
+    parts = []
+    for part in artifact.route_coordinates(route):
+        world = lonlat_to_world(np.array(part))
+        parts.append([tuple(p) for p in np.round((world * 2 ** z - [x, y]) * EXTENT).astype(int).tolist()])
+    return parts
+
+def test_layer_header_and_tags(tiles):
+    x, y = tile_of(*CENTER, Z)
+    layers = decode_tile(tiles.encode_tile(Z, x, y))
+    assert len(layers) == 1
+    layer = layers[0]
+    assert layer['name'] == LAYER_NAME
+    assert layer['extent'] == EXTENT
+    assert layer['version'] == 2
+    assert layer['keys'] == ['route_id', 'route_name', 'color']
+
+    routes = tiles.artifact.routes
+    assert sorted(f['id'] for f in layer['features']) == [1, 2, 3]
+    for feature in layer['features']:
+        assert feature['type'] == 2
+        route = feature['id'] - 1
+        tags = dict(zip(feature['tags'][::2], feature['tags'][1::2]))
+        decoded = {layer['keys'][k] : layer['values'][v] for k, v in tags.items()}
+        assert decoded == {key : routes[key][route] for key in layer['keys'] if routes[key][route] is not None}
+    ## Values are shared between features, not repeated
+    assert len(layer['values']) == len(set(layer['values']))
+
+def test_geometry_round_trips_to_the_artifact(tiles):
+    x, y = tile_of(*CENTER, Z)
+    layer = decode_tile(tiles.encode_tile(Z, x, y))[0]
+    for feature in layer['features']:
+        assert feature['geometry'] == expected_parts(tiles.artifact, feature['id'] - 1, x, y, Z)
+    assert [len(f['geometry']) for f in sorted(layer['features'], key = lambda f: f['id'])] == [1, 2, 1]
+
+    ## Back to lon/lat, within the tile's resolution
+    n = 2 ** Z
+    for feature in layer['features']:
+        for part, original in zip(feature['geometry'], tiles.artifact.route_coordinates(feature['id'] - 1)):
+            wx = (x + np.array(part)[:, 0] / EXTENT) / n
+            wy = (y + np.array(part)[:, 1] / EXTENT) / n
+            lon = wx * 360 - 180
+            lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * wy))))
+            resolution = 360 / n / EXTENT
+            assert np.allclose(np.column_stack([lon, lat]), original, atol = resolution)
+
+def test_lines_crossing_the_edge_are_clipped_to_the_buffer(tiles):
+    ## A zoom deep enough that the zigzag runs through several tiles
+    z = 16
+    xs, ys = tiles.tile_range(z)
+    decoded = 0
+    for x in xs:
+        for y in ys:
+            data = tiles.encode_tile(z, x, y)
+            if not data:
+                continue
+            for feature in decode_tile(data)[0]['features']:
+                points = np.array([p for part in feature['geometry'] for p in part])
+                assert points.min() >= -BUFFER and points.max() <= EXTENT + BUFFER
+                decoded += 1
+    assert decoded > 3
+
+def test_empty_tile(tiles):
+    x, y = tile_of(*CENTER, Z)
+    assert tiles.encode_tile(Z, x + 5, y) == b''
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+
+import pytest
+
+from vehicle_cache import VehicleSnapshotCache
+
+TRANSITVIEW_PATH = '/api/TransitViewAll/index.php'
+
+def write_snapshot(path, generation, age):
+    with open(path, 'w') as f:
+        json.dump({'generation' : generation, 'fetched_at' : time.time() - age, 'data' : {'type' : 'FeatureCollection', 'features' : []}}, f)
+
+def wait_for(condition, timeout = 10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.05)
+
+@pytest.fixture
+def caches(tmp_path, stub):
+    ## Two caches on the same snapshot file, as in two gunicorn workers
+    _, base_url = stub
+    path = str(tmp_path / 'vehicle_snapshot.json')
+    made = []
+    def make(**kwargs):
+        cache = VehicleSnapshotCache(url = f"{base_url}{TRANSITVIEW_PATH}", path = path, source = 'transitview', **kwargs)
+        made.append(cache)
+        return cache
+    yield make
+    for cache in made:
+        cache.stop()
+
+def test_one_leader_refreshes(caches, stub):
+    server, _ = stub
+    requests_before = server.requests.get(TRANSITVIEW_PATH, 0)
+    first, second = caches(interval = 60), caches(interval = 60)
+    first.start()
+    second.start()
+    wait_for(lambda: first.snapshot() is not None)
+    time.sleep(0.5)
+
+    assert [first.is_leader, second.is_leader].count(True) == 1
+    ## One poll between them, and both read its snapshot
+    assert server.requests[TRANSITVIEW_PATH] - requests_before == 1
+    assert first.snapshot()['generation'] == second.snapshot()['generation'] == 1
+    assert len(second.get_features()['features']) > 0
+
+def test_follower_picks_up_replaced_file(caches, tmp_path):
+    leader, follower = caches(interval = 60), caches(interval = 60, watch_interval = 0.1)
+    seen = []
+    follower.add_listener(lambda snapshot: seen.append(snapshot['generation']))
+    assert leader._try_acquire_leader()
+    leader.refresh()
+    follower.start()
+    wait_for(lambda: seen == [1])
+    assert not follower.is_leader
+
+    inode = os.stat(leader.path).st_ino
+    leader.refresh()
+    ## Replaced by a rename, not rewritten in place, and no temp file left behind
+    assert os.stat(leader.path).st_ino != inode
+    assert sorted(os.listdir(tmp_path)) == ['vehicle_snapshot.json', 'vehicle_snapshot.json.lock']
+    assert follower.snapshot()['generation'] == 2
+    wait_for(lambda: seen == [1, 2])
+
+def test_age_and_staleness_around_ttl(caches):
+    cache = caches(ttl = 90)
+    assert cache.age() is None and cache.is_stale()
+
+    write_snapshot(cache.path, 1, age = 80)
+    assert cache.age() == pytest.approx(80, abs = 1)
+    assert not cache.is_stale()
+
+    ## A new file is picked up by its mtime
+    time.sleep(0.01)
+    write_snapshot(cache.path, 2, age = 100)
+    assert cache.age() == pytest.approx(100, abs = 1)
+    assert cache.is_stale()
+
+def test_stale_snapshot_is_served_and_wakes_the_poller(caches):
+    cache = caches(ttl = 90)
+    write_snapshot(cache.path, 1, age = 80)
+    assert cache.snapshot()['generation'] == 1
+    assert not cache._wake.is_set()
+
+    time.sleep(0.01)
+    write_snapshot(cache.path, 2, age = 100)
+    assert cache.snapshot()['generation'] == 2
+    assert cache._wake.is_set()
+
+def test_failed_fetch_keeps_the_previous_snapshot(caches, stub):
+    _, base_url = stub
+    cache = caches(interval = 0.2)
+    assert cache._try_acquire_leader()
+    previous = cache.refresh()
+
+    cache.url = f"{base_url}/missing"
+    with pytest.raises(Exception):
+        cache.refresh()
+    assert cache.snapshot() == previous
+
+    ## The poller keeps retrying, and serving the old snapshot meanwhile
+    cache.start()
+    time.sleep(0.5)
+    assert cache.snapshot()['generation'] == previous['generation']
+    assert cache.get_features() == previous['data']
@@ -0,0 +1,120 @@
+import copy
+import random
+
+import pytest
+
+from vehicle_cache import VehicleStore
+
+ROUTES = ['1', '2', '3', '4']
+
+def feature(vehicle, route, lon, lat, late = 0):
+    return {
+        'type' : 'Feature',
+        'geometry' : {'type' : 'Point', 'coordinates' : [lon, lat]},
+        'properties' : {'VehicleID' : vehicle, 'route_id' : route, 'trip' : f"{route}-{vehicle}", 'late' : late}
+    }
+
+def snapshots(n, seed = 0):
+    ## Generations where vehicles move, run late, switch routes, leave and come back
+    rng = random.Random(seed)
+    vehicles = {str(v) : feature(str(v), rng.choice(ROUTES), -75.1 + v / 1000, 40.0) for v in range(30)}
+    for generation in range(1, n + 1):
+        yield {'generation' : generation, 'fetched_at' : generation * 30.0,
+               'data' : {'type' : 'FeatureCollection', 'features' : copy.deepcopy(list(vehicles.values()))}}
+        vehicles = copy.deepcopy(vehicles)
+        for key in list(vehicles):
+            roll = rng.random()
+            if roll < 0.5:
+                vehicles[key]['geometry']['coordinates'][0] += 0.001
+            elif roll < 0.6:
+                vehicles[key]['properties']['late'] += 1
+            elif roll < 0.65:
+                vehicles[key]['properties']['route_id'] = rng.choice(ROUTES)
+            elif roll < 0.7:
+                del vehicles[key]
+        for _ in range(2):
+            key = str(rng.randrange(40))
+            vehicles.setdefault(key, feature(key, rng.choice(ROUTES), -75.2, 40.1))
+
+def apply(vehicles, delta):
+    ## What the browser does with a delta (application.py), on {id: feature}
+    if 'full' in delta:
+        return {f['id'] : f for f in delta['full']['features']}
+    vehicles = copy.deepcopy(vehicles)
+    for key in delta['removed']:
+        vehicles.pop(key, None)
+    for change in delta['changed']:
+        if change['id'] in vehicles:
+            feature = vehicles[change['id']]
+            feature['geometry'] = {'type' : 'Point', 'coordinates' : change['coordinates']}
+            feature['properties'] = {**feature['properties'], **change['properties']}
+    for f in delta['added']:
+        vehicles[f['id']] = f
+    return vehicles
+
+def by_id(collection, route_ids = 'all'):
+    return {f['id'] : f for f in collection['features']
+            if route_ids == 'all' or f['properties']['route_id'] in route_ids}
+
+@pytest.fixture(scope = 'module')
+def history():
+    ## The store after 12 generations, and every client state it passed through
+    store = VehicleStore(max_history = 5)
+    states = {}
+    for snapshot in snapshots(12):
+        store.update(snapshot)
+        states[store.version] = by_id(copy.deepcopy(store.full()['full']))
+    return store, states
+
+@pytest.mark.parametrize('route_ids', ['all', ['2'], ['1', '3']])
+def test_composed_changes_reach_the_current_state(history, route_ids):
+    store, states = history
+    current = by_id(store.full(route_ids)['full'])
+    ## Every version still covered by the history, up to the current one (an empty delta)
+    for version in range(store.version - store.max_history, store.version + 1):
+        delta = store.changes_since(version, route_ids)
+        assert 'full' not in delta
+        assert delta['version'] == store.version
+        client = {k : f for k, f in states[version].items() if route_ids == 'all' or f['properties']['route_id'] in route_ids}
+        assert apply(client, delta) == current
+        ## Nothing the client never had is sent as removed
+        assert set(delta['removed']) <= set(client)
+
+def test_deltas_only_carry_what_changed(history):
+    store, _ = history
+    delta = store.changes_since(store.version)
+    assert delta['added'] == delta['changed'] == delta['removed'] == []
+
+    ## A filtered client only hears of its routes
+    delta = store.changes_since(store.version - 3, ['2'])
+    assert all(f['properties']['route_id'] == '2' for f in delta['added'])
+    assert all(c['route_id'] == '2' for c in delta['changed'])
+
+def test_route_switch_moves_a_vehicle_between_filters():
+    store = VehicleStore()
+    store.update({'generation' : 1, 'fetched_at' : 0, 'data' : {'type' : 'FeatureCollection', 'features' : [feature('7', '1', -75.1, 40.0)]}})
+    store.update({'generation' : 2, 'fetched_at' : 30, 'data' : {'type' : 'FeatureCollection', 'features' : [feature('7', '2', -75.1, 40.0)]}})
+
+    old_route = store.changes_since(1, ['1'])
+    assert old_route['removed'] == ['7'] and old_route['added'] == []
+    new_route = store.changes_since(1, ['2'])
+    assert new_route['removed'] == [] and [f['id'] for f in new_route['added']] == ['7']
+
+def test_full_snapshot_when_history_is_gone(history):
+    store, states = history
+    ## Evicted past max_history, unknown, or from before a reset
+    for version in (store.version - store.max_history - 1, 1, None, store.version + 3):
+        delta = store.changes_since(version, ['2'])
+        assert delta['version'] == store.version
+        assert delta['full'] == store.full(['2'])['full']
+        assert apply(states.get(version, {}), delta) == by_id(store.full(['2'])['full'])
+
+def test_skipped_generation_resets_history():
+    store = VehicleStore()
+    generations = list(snapshots(4))
+    store.update(generations[0])
+    store.update(generations[1])
+    assert 'full' not in store.changes_since(1)
+    store.update(generations[3])
+    assert store.history == []
+    assert 'full' in store.changes_since(2)
@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from gtfs_tools import colors
+from http_client import fetch
+from metrics import span
+
+## TransitView ingestion straight into columns, like gtfs_realtime.py does for
+## GTFS-realtime. The response already groups vehicles by route, so the columns keep
+## that order and a route's vehicles are one slice of them (route_offsets): filtering by
+## route is slicing, and features are written from the column lists with no GeoDataFrame,
+## no Point objects and no to_json/loads round trip.
+
+TRANSITVIEW_URL = "https://www3.septa.org/api/TransitViewAll/index.php"
+
+## Position fields of the response, not passed on as feature properties
+POSITION_FIELDS = ('lat', 'lng', 'label')
+
+@span('parse_transitview')
+def parse_transitview(content):
+    routes = json.loads(content)['routes'][0]
+    route_names = [r for r in routes if r != '']
+    vehicles = [v for r in route_names for v in routes[r]]
+    counts = [len(routes[r]) for r in route_names]
+
+    ## Properties in the order they first appear, as the GeoDataFrame columns were
+    fields = [k for k in dict.fromkeys(k for v in vehicles for k in v) if k not in POSITION_FIELDS]
+    columns = dict(
+        route_names = np.array(route_names, dtype = object),
+        route_offsets = np.r_[0, np.cumsum(counts)].astype(np.int64),
+        longitude = pd.to_numeric(pd.Series([v.get('lng') for v in vehicles], dtype = object), errors = 'coerce').to_numpy(dtype = float),
+        latitude = pd.to_numeric(pd.Series([v.get('lat') for v in vehicles], dtype = object), errors = 'coerce').to_numpy(dtype = float),
+        properties = {k : [v.get(k) for v in vehicles] for k in fields}
+    )
+    columns['route_index'] = {r : i for i, r in enumerate(route_names)}
+    return columns
+
+def transitview_to_columns(url = TRANSITVIEW_URL):
+    return parse_transitview(fetch(url).content)
+
+def route_rows(columns, route_ids = 'all'):
+    ## Row numbers of the vehicles on route_ids, from the per-route slices
+    offsets = columns['route_offsets']
+    if route_ids == 'all':
+        return np.arange(offsets[-1])
+    if type(route_ids) in (str, int):
+        route_ids = [route_ids]
+    routes = sorted(set(columns['route_index'][str(r)] for r in route_ids if str(r) in columns['route_index']))
+    if not routes:
+        return np.empty(0, dtype = np.int64)
+    return np.concatenate([np.arange(offsets[r], offsets[r + 1]) for r in routes])
+
+@span('transitview_features')
+def columns_to_features(columns, route_ids = 'all'):
+    rows = route_rows(columns, route_ids)
+    rows = rows[np.isfinite(columns['longitude'][rows]) & np.isfinite(columns['latitude'][rows])]
+
+    ## Route of every row, and its color looked up once per route
+    route_of_row = np.repeat(np.arange(len(columns['route_names'])), np.diff(columns['route_offsets']))[rows]
+    route_colors = np.array([colors.get(r) for r in columns['route_names']], dtype = object)
+    keys = list(columns['properties']) + ['route_id', 'color']
+    values = [[column[i] for i in rows.tolist()] for column in columns['properties'].values()]
+    values.append(columns['route_names'][route_of_row].tolist())
+    values.append(route_colors[route_of_row].tolist())
+
+    features = [
+        {
+            'type' : 'Feature',
+            'properties' : dict(zip(keys, properties)),
+            'geometry' : {'type' : 'Point', 'coordinates' : [lon, lat]}
+        }
+        for properties, lon, lat in zip(zip(*values), columns['longitude'][rows].tolist(), columns['latitude'][rows].tolist())
+    ]
+    return {'type' : 'FeatureCollection', 'features' : features}
+
+@span('get_bus_positions_from_transitview')
+def get_bus_positions_from_transitview(route_ids = 'all', url = TRANSITVIEW_URL):
+    print("Getting current bus locations ...")
+    return columns_to_features(transitview_to_columns(url), route_ids)
@@ -0,0 +1,207 @@
+import os
+import sys
+import math
+import shutil
+import tempfile
+
+import numpy as np
+import shapely
+
+from metrics import counter, span
+
+## Mapbox Vector Tiles (spec 2.1) of the route lines, cut from the line artifact so they
+## work offline. Tiles up to MAX_CACHED_ZOOM are encoded on first request and kept on disk
+## under cache_dir/<artifact version>/z/x/y.pbf; a new artifact version starts a fresh cache.
+## Deeper tiles are encoded on every request and never written, since a crawler walking
+## z16-z22 along the lines could otherwise create millions of files.
+## The protobuf messages are small enough to write by hand, so no extra dependency.
+
+EXTENT = 4096
+BUFFER = 64
+LAYER_NAME = 'bus_lines'
+## Deepest zoom kept on disk (one more than build_static.py pre-generates)
+MAX_CACHED_ZOOM = 14
+
+TILE_CACHE = counter('tile_cache_total', "Vector tile requests served from the disk cache (hit), encoded and cached (miss), "
+                     "or encoded above the cached zooms (uncached).", labels = ('result',))
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _field(number, payload):
+    ## Length-delimited field (wire type 2)
+    return _varint((number << 3) | 2) + _varint(len(payload)) + payload
+
+def _uint_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+def encode_line_geometry(parts):
+    ## parts: list of int64 (n, 2) arrays in tile coordinates. MoveTo/LineTo commands with
+    ## zigzag-encoded deltas, the cursor carrying over from one part to the next
+    commands = []
+    cursor = np.zeros(2, dtype = np.int64)
+    for part in parts:
+        deltas = np.diff(np.vstack([cursor, part]), axis = 0)
+        cursor = part[-1]
+        zigzag = _zigzag(deltas).ravel().tolist()
+        commands.append(1 | (1 << 3))
+        commands.extend(zigzag[:2])
+        commands.append(2 | ((len(part) - 1) << 3))
+        commands.extend(zigzag[2:])
+    return b''.join(_varint(c) for c in commands)
+
+def encode_layer(features, keys, values, name = LAYER_NAME):
+    ## features: list of (id, tags, geometry bytes); values are strings
+    layer = _field(1, name.encode())
+    for feature_id, tags, geometry in features:
+        feature = _uint_field(1, feature_id)
+        feature += _field(2, b''.join(_varint(t) for t in tags))
+        feature += _uint_field(3, 2)
+        feature += _field(4, geometry)
+        layer += _field(2, feature)
+    for key in keys:
+        layer += _field(3, key.encode())
+    for value in values:
+        layer += _field(4, _field(1, value.encode()))
+    layer += _uint_field(5, EXTENT)
+    layer += _uint_field(15, 2)
+    return _field(3, layer)
+
+def lonlat_to_world(coords):
+    ## Web Mercator in [0, 1) world units, y growing southwards like tile rows
+    lon, lat = coords[:, 0], np.clip(coords[:, 1], -85.0511, 85.0511)
+    return np.column_stack([(lon + 180) / 360, (1 - np.arcsinh(np.tan(np.radians(lat))) / math.pi) / 2])
+
+class LineTiles:
+    def __init__(self, artifact, cache_dir = './data/tiles', max_cached_zoom = MAX_CACHED_ZOOM):
+        self.artifact = artifact
+        self.cache_dir = os.path.join(cache_dir, os.path.basename(artifact.version))
+        self.max_cached_zoom = max_cached_zoom
+
+        ## One world-unit LineString per line part, and an STRtree to find the parts in a tile
+        offsets = np.asarray(artifact.part_offsets)
+        part_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        keep = np.repeat(np.diff(offsets) >= 2, np.diff(offsets))
+        kept_parts, part_index = np.unique(part_index[keep], return_inverse = True)
+        self.parts = shapely.linestrings(lonlat_to_world(np.asarray(artifact.coords))[keep], indices = part_index)
+        route_parts = np.asarray(artifact.route_parts)
+        self.part_route = np.repeat(np.arange(len(route_parts) - 1), np.diff(route_parts))[kept_parts]
+        self.tree = shapely.STRtree(self.parts)
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), f"{y}.pbf")
+
+    def encode_tile(self, z, x, y):
+        n = 2 ** z
+        pad = BUFFER / EXTENT
+        ## In artifact order, so each route's parts keep their order in the tile
+        hits = np.sort(self.tree.query(shapely.box((x - pad) / n, (y - pad) / n, (x + 1 + pad) / n, (y + 1 + pad) / n)))
+        if len(hits) == 0:
+            return b''
+
+        ## Clip to the buffered tile, move to tile coordinates, drop detail under a unit
+        clipped = shapely.clip_by_rect(self.parts[hits], (x - pad) / n, (y - pad) / n, (x + 1 + pad) / n, (y + 1 + pad) / n)
+        clipped = shapely.transform(clipped, lambda c: (c * n - [x, y]) * EXTENT)
+        clipped = shapely.simplify(clipped, 0.5, preserve_topology = False)
+        pieces, piece_hit = shapely.get_parts(clipped, return_index = True)
+        coords, piece_index = shapely.get_coordinates(pieces, return_index = True)
+        coords = np.round(coords).astype(np.int64)
+
+        ## Group the pieces by route, dropping repeated points left by rounding
+        by_route = {}
+        bounds = np.r_[0, np.cumsum(np.bincount(piece_index, minlength = len(pieces)))]
+        for p in range(len(pieces)):
+            part = coords[bounds[p]:bounds[p + 1]]
+            part = part[np.r_[True, np.any(np.diff(part, axis = 0) != 0, axis = 1)]]
+            if len(part) >= 2:
+                by_route.setdefault(int(self.part_route[hits[piece_hit[p]]]), []).append(part)
+        if not by_route:
+            return b''
+
+        keys = ['route_id', 'route_name', 'color']
+        values = []
+        value_index = {}
+        features = []
+        for route, parts in sorted(by_route.items()):
+            tags = []
+            for k, key in enumerate(keys):
+                value = self.artifact.routes[key][route]
+                if value is None:
+                    continue
+                if value not in value_index:
+                    value_index[value] = len(values)
+                    values.append(value)
+                tags.extend([k, value_index[value]])
+            features.append((route + 1, tags, encode_line_geometry(parts)))
+        return encode_layer(features, keys, values)
+
+    def tile(self, z, x, y):
+        ## Encoded tile bytes, from the disk cache when already built
+        if z > self.max_cached_zoom:
+            TILE_CACHE.inc('uncached')
+            with span('encode_tile'):
+                return self.encode_tile(z, x, y)
+        path = self.tile_path(z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            TILE_CACHE.inc('hit')
+            return data
+        except FileNotFoundError:
+            pass
+        TILE_CACHE.inc('miss')
+        with span('encode_tile'):
+            data = self.encode_tile(z, x, y)
+        if not data:
+            ## Empty tiles are cheap to rebuild, and not caching them keeps requests
+            ## for arbitrary tiles from filling the disk
+            return data
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with tempfile.NamedTemporaryFile('wb', dir = os.path.dirname(path), delete = False, suffix = '.tmp') as f:
+            f.write(data)
+        os.replace(f.name, path)
+        return data
+
+    def tile_range(self, z):
+        ## x and y ranges of the tiles covering the lines at zoom z
+        n = 2 ** z
+        min_x, min_y, max_x, max_y = shapely.total_bounds(self.parts)
+        return (range(int(min_x * n), min(int(max_x * n), n - 1) + 1),
+                range(int(min_y * n), min(int(max_y * n), n - 1) + 1))
+
+    def remove_stale(self):
+        ## Drop tile caches of earlier artifact versions
+        parent = os.path.dirname(self.cache_dir)
+        if not os.path.isdir(parent):
+            return
+        for name in os.listdir(parent):
+            if name != os.path.basename(self.cache_dir):
+                shutil.rmtree(os.path.join(parent, name), ignore_errors = True)
+
+    def pregenerate(self, zooms = range(8, MAX_CACHED_ZOOM + 1)):
+        count = 0
+        for z in [z for z in zooms if z <= self.max_cached_zoom]:
+            xs, ys = self.tile_range(z)
+            for x in xs:
+                for y in ys:
+                    self.tile(z, x, y)
+                    count += 1
+        print(f"{count} vector tiles written to {self.cache_dir}.")
+        return count
+
+if __name__ == '__main__':
+    ## python vector_tiles.py [min_zoom max_zoom]: pre-generate tiles for the current artifact
+    from line_artifact import load_line_artifact
+    min_zoom, max_zoom = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) == 3 else (8, 14)
+    LineTiles(load_line_artifact()).pregenerate(range(min_zoom, max_zoom + 1))
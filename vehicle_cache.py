@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+
+from gtfs_tools import url_dict
+from transitview import get_bus_positions_from_transitview
+from gtfs_realtime import get_bus_positions_from_gtfsrt
+from metrics import counter, gauge, span
+
+## VEHICLE_SOURCE=transitview (default) or gtfsrt
+VEHICLE_SOURCE = os.environ.get('VEHICLE_SOURCE', 'transitview')
+TRANSITVIEW_URL = os.environ.get('TRANSITVIEW_URL', "https://www3.septa.org/api/TransitViewAll/index.php")
+GTFSRT_VEHICLE_URL = os.environ.get('GTFSRT_VEHICLE_URL', url_dict['bus_vehicle_position_updates'])
+GTFSRT_TRIP_UPDATES_URL = os.environ.get('GTFSRT_TRIP_UPDATES_URL', url_dict['bus_trip_updates'])
+
+EMPTY_COLLECTION = {'type': 'FeatureCollection', 'features': []}
+
+VEHICLES = gauge('vehicles', "Vehicles in the latest snapshot this process polled.", labels = ('source',))
+SNAPSHOT_BYTES = gauge('vehicle_snapshot_bytes', "Size of the latest snapshot file this process wrote.")
+SNAPSHOT_READS = counter('vehicle_snapshot_reads_total', "Snapshot reads, from memory (hit) or re-parsed from the file (load).", labels = ('result',))
+
+def filter_route_features(collection, route_ids = 'all'):
+    if route_ids == 'all':
+        return collection
+    if type(route_ids) in (str, int):
+        route_ids = [route_ids]
+    route_ids = set(str(id) for id in route_ids)
+    return {
+        'type': 'FeatureCollection',
+        'features': [f for f in collection['features'] if f['properties'].get('route_id') in route_ids]
+    }
+
+class VehicleSnapshotCache:
+    """
+    Latest TransitView vehicle snapshot, shared by every session and gunicorn worker.
+
+    One process (whichever holds the lock file) polls TransitView every `interval`
+    seconds and atomically replaces the snapshot file. All processes read that file,
+    re-parsing it only when its mtime changes, so callbacks never wait on the network.
+    A snapshot older than `ttl` is still served, but wakes the poller to revalidate.
+    Processes with listeners check the file every `watch_interval` seconds, so they hear
+    of a new generation soon after the polling process writes it.
+    """
+
+    def __init__(self, url = None, path = './data/vehicle_snapshot.json', interval = 30, ttl = 90, source = VEHICLE_SOURCE, watch_interval = 1):
+        self.source = source
+        self.url = url or (GTFSRT_VEHICLE_URL if source == 'gtfsrt' else TRANSITVIEW_URL)
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.interval = interval
+        self.ttl = ttl
+        self.watch_interval = watch_interval
+
+        self._snapshot = None
+        self._snapshot_mtime = None
+        self._read_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock_file = None
+        self._thread = None
+        ## Called with every new snapshot generation this process sees, from the poller thread
+        self._listeners = []
+        self._notified_generation = None
+
+    @property
+    def is_leader(self):
+        return self._lock_file is not None
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+        return self
+
+    def _notify(self):
+        snapshot = self._load()
+        if snapshot is None or snapshot['generation'] == self._notified_generation:
+            return
+        self._notified_generation = snapshot['generation']
+        for listener in self._listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                print(f"Vehicle snapshot listener failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, name = 'vehicle-snapshot-poller', daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _try_acquire_leader(self):
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.interval
+            if self._try_acquire_leader():
+                age = self.age()
+                if age is None or age >= self.interval:
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        print(f"Vehicle snapshot refresh failed: {e}")
+                        ## Retry sooner than a full interval, still serving the stale snapshot
+                        wait = min(self.interval, 5)
+                else:
+                    wait = self.interval - age
+            elif self._listeners:
+                wait = min(wait, self.watch_interval)
+            self._notify()
+            self._wake.wait(timeout = wait)
+            self._wake.clear()
+
+    def refresh(self):
+        if self.source == 'gtfsrt':
+            data = get_bus_positions_from_gtfsrt(url = self.url, trip_updates_url = GTFSRT_TRIP_UPDATES_URL)
+        else:
+            data = get_bus_positions_from_transitview(url = self.url)
+        previous = self._load()
+        snapshot = {
+            'generation': (previous['generation'] + 1) if previous else 1,
+            'fetched_at': time.time(),
+            'data': data
+        }
+        ## Write to a temp file in the same directory and rename, so readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with span('vehicle_snapshot_write'), tempfile.NamedTemporaryFile('w', dir = directory, delete = False, suffix = '.tmp') as f:
+            json.dump(snapshot, f)
+            SNAPSHOT_BYTES.set(f.tell())
+        os.replace(f.name, self.path)
+        VEHICLES.set(len(data['features']), self.source)
+        return snapshot
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._read_lock:
+            if mtime != self._snapshot_mtime:
+                with span('vehicle_snapshot_load'), open(self.path, 'r') as f:
+                    self._snapshot = json.load(f)
+                self._snapshot_mtime = mtime
+                SNAPSHOT_READS.inc('load')
+            else:
+                SNAPSHOT_READS.inc('hit')
+            return self._snapshot
+
+    def snapshot(self):
+        snapshot = self._load()
+        if snapshot is None or time.time() - snapshot['fetched_at'] > self.ttl:
+            ## Stale-while-revalidate: hand back what we have and poke the poller
+            self._wake.set()
+        return snapshot
+
+    def age(self):
+        snapshot = self._load()
+        if snapshot is None:
+            return None
+        return time.time() - snapshot['fetched_at']
+
+    def is_stale(self):
+        age = self.age()
+        return age is None or age > self.ttl
+
+    def get_features(self, route_ids = 'all'):
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return EMPTY_COLLECTION
+        return filter_route_features(snapshot['data'], route_ids)
+
+def vehicle_key(feature):
+    properties = feature['properties']
+    return str(properties.get('VehicleID') or f"{properties.get('route_id')}-{properties.get('trip')}")
+
+class VehicleStore:
+    """
+    Vehicles from the shared snapshot keyed by vehicle id, plus the changes between
+    the last `max_history` snapshot generations, so a client that already has
+    generation N only needs what was added, changed or removed since N.
+    """
+
+    def __init__(self, max_history = 10):
+        self.max_history = max_history
+        self.version = None
+        self.vehicles = {}
+        ## (version, diff from version - 1) for the most recent versions
+        self.history = []
+        self._lock = threading.Lock()
+
+    def update(self, snapshot):
+        if snapshot is None or snapshot['generation'] == self.version:
+            return self.version
+        with self._lock:
+            if snapshot['generation'] == self.version:
+                return self.version
+            with span('vehicle_store_update'):
+                ## Features carry their key as the GeoJSON id so clients can patch them in place
+                vehicles = {}
+                for f in snapshot['data']['features']:
+                    key = vehicle_key(f)
+                    vehicles[key] = {**f, 'id' : key}
+                if self.version is not None and snapshot['generation'] == self.version + 1:
+                    self.history.append((snapshot['generation'], self._diff(self.vehicles, vehicles)))
+                    self.history = self.history[-self.max_history:]
+                else:
+                    ## First snapshot seen, or generations were skipped: no usable history
+                    self.history = []
+            self.vehicles = vehicles
+            self.version = snapshot['generation']
+        return self.version
+
+    @staticmethod
+    def _diff(old, new):
+        added = {}
+        changed = {}
+        for key, feature in new.items():
+            previous = old.get(key)
+            ## A vehicle that switched routes is sent as removed and re-added, so route filters stay right
+            if previous is None or previous['properties'].get('route_id') != feature['properties'].get('route_id'):
+                added[key] = feature
+                continue
+            properties = {k : v for k, v in feature['properties'].items() if previous['properties'].get(k) != v}
+            coordinates = feature['geometry']['coordinates']
+            if properties or coordinates != previous['geometry']['coordinates']:
+                changed[key] = {
+                    'id' : key,
+                    'route_id' : feature['properties'].get('route_id'),
+                    'coordinates' : coordinates,
+                    'properties' : properties
+                }
+        removed = {key : f['properties'].get('route_id') for key, f in old.items()
+                   if key not in new or key in added}
+        return {'added' : added, 'changed' : changed, 'removed' : removed}
+
+    def full(self, route_ids = 'all'):
+        collection = {'type' : 'FeatureCollection', 'features' : list(self.vehicles.values())}
+        return {'version' : self.version, 'full' : filter_route_features(collection, route_ids)}
+
+    def changes_since(self, version, route_ids = 'all'):
+        ## Fall back to a full snapshot when the client is too far behind (or ahead, after a reset)
+        with self._lock:
+            versions = [v for v, _ in self.history]
+            if version is None or self.version is None:
+                return self.full(route_ids)
+            if version != self.version and (version + 1) not in versions:
+                return self.full(route_ids)
+
+            ## Compose the diffs after the client's version into one
+            added, changed, removed = {}, {}, {}
+            for v, diff in self.history:
+                if v <= version:
+                    continue
+                ## Same order clients apply them in: removals, then additions, then changes
+                for key, route_id in diff['removed'].items():
+                    changed.pop(key, None)
+                    if added.pop(key, None) is None:
+                        removed[key] = route_id
+                for key, feature in diff['added'].items():
+                    changed.pop(key, None)
+                    added[key] = feature
+                for key, change in diff['changed'].items():
+                    if key in added:
+                        added[key] = self.vehicles.get(key, added[key])
+                    elif key in changed:
+                        changed[key] = {**change, 'properties' : {**changed[key]['properties'], **change['properties']}}
+                    else:
+                        changed[key] = change
+            current_version = self.version
+
+        if route_ids != 'all':
+            if type(route_ids) in (str, int):
+                route_ids = [route_ids]
+            route_ids = set(str(id) for id in route_ids)
+            added = {k : f for k, f in added.items() if f['properties'].get('route_id') in route_ids}
+            changed = {k : c for k, c in changed.items() if c['route_id'] in route_ids}
+            removed = {k : r for k, r in removed.items() if r in route_ids}
+        return {
+            'version' : current_version,
+            'added' : list(added.values()),
+            'changed' : list(changed.values()),
+            'removed' : list(removed)
+        }
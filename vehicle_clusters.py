@@ -0,0 +1,164 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from metrics import span
+
+## Server-side clustering of the vehicle layer, so browsers get only what is in view at
+## their zoom instead of every vehicle to cluster themselves. Clusters are cells of a grid
+## in Web Mercator pixels, `radius` pixels wide at every zoom: with a power-of-two radius
+## each cell splits into four at the next zoom, so the levels nest like a quadtree. All
+## levels are built once per snapshot (a few array passes each). A cell holding at least
+## min_points vehicles is one cluster feature at its vehicles' centroid, with a count, the
+## most common routes and the color of the first; vehicles in sparser cells are sent as
+## themselves. A view of W x H pixels therefore never holds more than
+## (W / radius + 1) * (H / radius + 1) * (min_points - 1) features, whatever the fleet size.
+
+TOP_ROUTES = 3
+
+def mercator(lons, lats):
+    ## lon/lat to Web Mercator in [0, 1) of the world at zoom 0
+    lats = np.clip(np.asarray(lats, dtype = float), -85.05112878, 85.05112878)
+    x = (np.asarray(lons, dtype = float) + 180) / 360
+    y = 0.5 - np.log(np.tan(np.pi / 4 + np.radians(lats) / 2)) / (2 * np.pi)
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+class VehicleClusters:
+    def __init__(self, features, radius = 64, min_points = 5, min_zoom = 8, max_zoom = 20, tile_size = 256):
+        ## features: vehicle GeoJSON Features (with ids, as in VehicleStore.vehicles)
+        self.features = list(features)
+        self.min_points = min_points
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        coordinates = np.array([f['geometry']['coordinates'] for f in self.features], dtype = float).reshape(-1, 2)
+        self.lons, self.lats = coordinates[:, 0], coordinates[:, 1]
+        route_codes, self.route_ids = pd.factorize(pd.Series([f['properties'].get('route_id') for f in self.features], dtype = object))
+        route_colors = {}
+        for f in self.features:
+            route_colors.setdefault(str(f['properties'].get('route_id')), f['properties'].get('color'))
+        x, y = mercator(self.lons, self.lats)
+
+        ## cells_per_world at zoom z: tile_size * 2 ** z / radius
+        scale = tile_size / radius
+        self.levels = {}
+        child = None
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            cells = scale * 2.0 ** zoom
+            cx, cy = np.floor(x * cells).astype(np.int64), np.floor(y * cells).astype(np.int64)
+            keys, cell_of, counts = np.unique(cx << 32 | cy, return_inverse = True, return_counts = True)
+            clustered = counts >= min_points
+            sums_lon = np.bincount(cell_of, weights = self.lons, minlength = len(keys))
+            sums_lat = np.bincount(cell_of, weights = self.lats, minlength = len(keys))
+
+            ## Zoom at which a cluster first splits (into several cells, or into points):
+            ## a cell whose vehicles all stay in one clustered cell at zoom + 1 splits when that one does
+            expansion = np.full(len(keys), zoom + 1)
+            if child is not None:
+                parent_keys = (child['keys'] >> 32) >> 1 << 32 | (child['keys'] & 0xffffffff) >> 1
+                parent = np.searchsorted(keys, parent_keys)
+                n_children = np.bincount(parent, minlength = len(keys))
+                only = np.flatnonzero(n_children[parent] == 1)
+                only = only[child['clustered'][only]]
+                expansion[parent[only]] = child['expansion'][only]
+            expansion = np.minimum(expansion, max_zoom)
+
+            ## Most common routes of every cluster: (cell, route) pair counts, largest first
+            member = clustered[cell_of]
+            summarized = member & (route_codes >= 0)
+            pairs, pair_counts = np.unique(cell_of[summarized] * len(self.route_ids) + route_codes[summarized], return_counts = True)
+            pair_cell, pair_route = pairs // max(len(self.route_ids), 1), pairs % max(len(self.route_ids), 1)
+            order = np.lexsort((-pair_counts, pair_cell))
+            pair_cell, pair_route, pair_counts = pair_cell[order], pair_route[order], pair_counts[order]
+            rank = np.arange(len(pair_cell)) - np.searchsorted(pair_cell, pair_cell)
+            top = rank < TOP_ROUTES
+
+            routes = {}
+            for cell, route, count in zip(pair_cell[top].tolist(), pair_route[top].tolist(), pair_counts[top].tolist()):
+                routes.setdefault(cell, []).append([str(self.route_ids[route]), count])
+            cluster_cells = np.flatnonzero(clustered)
+            cluster_lon = sums_lon[cluster_cells] / counts[cluster_cells]
+            cluster_lat = sums_lat[cluster_cells] / counts[cluster_cells]
+            cluster_features = [{
+                'type' : 'Feature',
+                'id' : f"cluster-{zoom}-{int(keys[cell])}",
+                'geometry' : {'type' : 'Point', 'coordinates' : [round(lon, 6), round(lat, 6)]},
+                'properties' : {
+                    'cluster' : True,
+                    'point_count' : int(counts[cell]),
+                    'routes' : routes.get(cell, []),
+                    'other_routes' : int(counts[cell]) - sum(c for _, c in routes.get(cell, [])),
+                    'color' : route_colors.get(routes[cell][0][0]) if cell in routes else None,
+                    'expansion_zoom' : int(expansion[cell])
+                }
+            } for cell, lon, lat in zip(cluster_cells.tolist(), cluster_lon.tolist(), cluster_lat.tolist())]
+
+            points = np.flatnonzero(~member)
+            self.levels[zoom] = {
+                'cluster_lon' : cluster_lon, 'cluster_lat' : cluster_lat, 'cluster_features' : cluster_features,
+                'points' : points
+            }
+            child = {'keys' : keys, 'clustered' : clustered, 'expansion' : expansion}
+
+    def query(self, zoom, bbox = None):
+        ## Clusters and single vehicles at zoom (clamped to the built levels) inside bbox
+        ## (min_lon, min_lat, max_lon, max_lat), as a FeatureCollection
+        zoom = int(min(max(self.min_zoom if zoom is None else zoom, self.min_zoom), self.max_zoom))
+        level = self.levels[zoom]
+        clusters, points = np.arange(len(level['cluster_features'])), level['points']
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            clusters = clusters[(level['cluster_lon'] >= min_lon) & (level['cluster_lon'] <= max_lon) &
+                                (level['cluster_lat'] >= min_lat) & (level['cluster_lat'] <= max_lat)]
+            points = points[(self.lons[points] >= min_lon) & (self.lons[points] <= max_lon) &
+                            (self.lats[points] >= min_lat) & (self.lats[points] <= max_lat)]
+        features = [level['cluster_features'][i] for i in clusters.tolist()] + [self.features[i] for i in points.tolist()]
+        return {'type' : 'FeatureCollection', 'features' : features}
+
+class ClusterCache:
+    ## Clusters of the current snapshot per route filter: all routes built with each
+    ## snapshot, route selections on first request, for the most recent max_groups selections
+    def __init__(self, max_groups = 64, **options):
+        self.options = options
+        self.max_groups = max_groups
+        self.generation = None
+        self.vehicles = []
+        self.groups = {}
+        self._lock = threading.Lock()
+
+    def update(self, generation, vehicles):
+        ## vehicles: features with ids, e.g. VehicleStore.vehicles.values()
+        if generation == self.generation:
+            return
+        with span('vehicle_clusters_build'):
+            vehicles = list(vehicles)
+            clusters = VehicleClusters(vehicles, **self.options)
+        with self._lock:
+            self.generation = generation
+            self.vehicles = vehicles
+            self.groups = {'all' : clusters}
+
+    def clusters(self, route_ids = 'all'):
+        key = 'all' if route_ids == 'all' or not route_ids else ','.join(sorted(set(str(r) for r in route_ids)))
+        with self._lock:
+            clusters = self.groups.get(key)
+            if clusters is not None:
+                ## Most recently used last
+                self.groups[key] = self.groups.pop(key)
+                return clusters
+            generation, vehicles = self.generation, self.vehicles
+        selected = set(key.split(','))
+        with span('vehicle_clusters_build'):
+            clusters = VehicleClusters([f for f in vehicles if str(f['properties'].get('route_id')) in selected], **self.options)
+        with self._lock:
+            if generation == self.generation:
+                self.groups[key] = clusters
+                while len(self.groups) > self.max_groups + 1:
+                    oldest = next(k for k in self.groups if k != 'all')
+                    del self.groups[oldest]
+        return clusters
+
+    def query(self, zoom, bbox = None, route_ids = 'all'):
+        collection = self.clusters(route_ids).query(zoom, bbox)
+        collection['generation'] = self.generation
+        return collection
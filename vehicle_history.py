@@ -0,0 +1,217 @@
+import os
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+
+from vehicle_cache import vehicle_key
+
+## Short-horizon vehicle position history, for trails, speeds and replay.
+## Each vehicle gets a slot in fixed-size arrays holding a ring buffer of its last
+## `capacity` reports (structure of arrays: timestamp, lon, lat, route), so memory is
+## fixed at max_vehicles * capacity * 20 bytes whatever the uptime. When every slot is
+## taken, the vehicle seen longest ago gives up its slot.
+## With a spill directory, every report is also appended to one file per UTC day of
+## fixed-size records (spill_dtype) that can be memory-mapped back with read_spill.
+
+spill_dtype = np.dtype([('timestamp', '<i8'), ('lon', '<f4'), ('lat', '<f4'), ('vehicle', 'S16'), ('route_id', 'S8')])
+
+EARTH_RADIUS = 6371008.8
+
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype = float)) for a in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+class VehicleHistory:
+    def __init__(self, capacity = 120, max_vehicles = 4096, spill_dir = None):
+        ## capacity 120 is an hour of 30 second snapshots
+        self.capacity = capacity
+        self.max_vehicles = max_vehicles
+        self.spill_dir = spill_dir
+
+        self.timestamp = np.zeros((max_vehicles, capacity), dtype = np.int64)
+        self.lon = np.zeros((max_vehicles, capacity), dtype = np.float32)
+        self.lat = np.zeros((max_vehicles, capacity), dtype = np.float32)
+        self.route = np.full((max_vehicles, capacity), -1, dtype = np.int32)
+        ## Next write position and number of reports held, per slot
+        self.head = np.zeros(max_vehicles, dtype = np.int64)
+        self.count = np.zeros(max_vehicles, dtype = np.int64)
+        self.last_seen = np.zeros(max_vehicles, dtype = np.int64)
+
+        self.slot_of = {}
+        self.vehicle_of = np.full(max_vehicles, None, dtype = object)
+        self.route_codes = {}
+        self.route_names = []
+        self.generation = None
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.timestamp, self.lon, self.lat, self.route, self.head, self.count, self.last_seen))
+
+    def _route_code(self, route_id):
+        code = self.route_codes.get(route_id)
+        if code is None:
+            code = self.route_codes[route_id] = len(self.route_names)
+            self.route_names.append(route_id)
+        return code
+
+    def _slots(self, keys):
+        ## Slot of every key, taking free or least recently seen slots for new vehicles.
+        ## -1 when a batch has more new vehicles than there are slots to give
+        slots = np.array([self.slot_of.get(key, -1) for key in keys], dtype = np.int64)
+        new = np.flatnonzero(slots < 0)
+        if len(new) == 0:
+            return slots
+        free = np.flatnonzero(self.vehicle_of == None)
+        if len(free) < len(new):
+            in_use = np.setdiff1d(np.flatnonzero(self.vehicle_of != None), slots)
+            evict = in_use[np.argsort(self.last_seen[in_use], kind = 'stable')[:len(new) - len(free)]]
+            for slot in evict:
+                del self.slot_of[self.vehicle_of[slot]]
+                self.vehicle_of[slot] = None
+            self.count[evict] = 0
+            self.head[evict] = 0
+            free = np.r_[free, evict]
+        for i, slot in zip(new, free):
+            self.slot_of[keys[i]] = slot
+            self.vehicle_of[slot] = keys[i]
+            slots[i] = slot
+        return slots
+
+    def append(self, keys, route_ids, lons, lats, timestamps, spill = True):
+        ## One report per vehicle; reports no newer than the vehicle's last one are skipped
+        keys = np.asarray(keys, dtype = object)
+        timestamps = np.asarray(timestamps, dtype = np.int64)
+        _, last = np.unique(keys[::-1], return_index = True)
+        keep = np.sort(len(keys) - 1 - last)
+        with self._lock:
+            slots = self._slots(keys[keep].tolist())
+            keep, slots = keep[slots >= 0], slots[slots >= 0]
+            newer = (self.count[slots] == 0) | (timestamps[keep] > self.last_seen[slots])
+            keep, slots = keep[newer], slots[newer]
+            if len(keep) == 0:
+                return 0
+            routes = np.array([self._route_code(str(r)) for r in np.asarray(route_ids, dtype = object)[keep]], dtype = np.int32)
+
+            position = self.head[slots]
+            self.timestamp[slots, position] = timestamps[keep]
+            self.lon[slots, position] = np.asarray(lons, dtype = np.float32)[keep]
+            self.lat[slots, position] = np.asarray(lats, dtype = np.float32)[keep]
+            self.route[slots, position] = routes
+            self.head[slots] = (position + 1) % self.capacity
+            self.count[slots] = np.minimum(self.count[slots] + 1, self.capacity)
+            self.last_seen[slots] = timestamps[keep]
+
+        if spill and self.spill_dir is not None:
+            self._spill(keys[keep], np.asarray(route_ids, dtype = object)[keep], np.asarray(lons)[keep], np.asarray(lats)[keep], timestamps[keep])
+        return len(keep)
+
+    def append_features(self, collection, fetched_at = None, spill = True):
+        ## A vehicle FeatureCollection (TransitView or GTFS-realtime features), using each
+        ## feature's own timestamp when it has one
+        features = collection['features']
+        fetched_at = int(fetched_at or time.time())
+        keys = [vehicle_key(f) for f in features]
+        route_ids = [f['properties'].get('route_id') for f in features]
+        coordinates = np.array([f['geometry']['coordinates'] for f in features], dtype = float).reshape(-1, 2)
+        timestamps = [f['properties'].get('timestamp') or fetched_at for f in features]
+        return self.append(keys, route_ids, coordinates[:, 0], coordinates[:, 1], timestamps, spill = spill)
+
+    def append_snapshot(self, snapshot, spill = True):
+        ## A snapshot from VehicleSnapshotCache; each generation is only taken once
+        if snapshot is None or snapshot['generation'] == self.generation:
+            return 0
+        self.generation = snapshot['generation']
+        return self.append_features(snapshot['data'], snapshot['fetched_at'], spill = spill)
+
+    def _spill(self, keys, route_ids, lons, lats, timestamps):
+        records = np.empty(len(keys), dtype = spill_dtype)
+        records['timestamp'] = timestamps
+        records['lon'] = lons
+        records['lat'] = lats
+        records['vehicle'] = [str(k).encode()[:16] for k in keys]
+        records['route_id'] = [str(r).encode()[:8] for r in route_ids]
+        os.makedirs(self.spill_dir, exist_ok = True)
+        for day in np.unique(timestamps // 86400):
+            path = os.path.join(self.spill_dir, f"{time.strftime('%Y%m%d', time.gmtime(int(day) * 86400))}.bin")
+            with open(path, 'ab') as f:
+                f.write(records[timestamps // 86400 == day].tobytes())
+
+    def _window(self, slots, start, end, routes = None):
+        ## (slot, position) of the reports in [start, end] (and on routes), ordered by slot then time
+        timestamps = self.timestamp[slots]
+        filled = np.arange(self.capacity)[None, :] < self.count[slots][:, None]
+        mask = filled & (timestamps >= start) & (timestamps <= end)
+        if routes is not None:
+            mask &= np.isin(self.route[slots], routes)
+        rows, positions = np.nonzero(mask)
+        order = np.lexsort((timestamps[rows, positions], rows))
+        return slots[rows[order]], positions[order]
+
+    def trails(self, vehicles = None, route_ids = None, start = None, end = None):
+        ## Reports of the given vehicles (or all vehicles, or those on route_ids) between
+        ## start and end, one row per report with the speed since the vehicle's previous one
+        end = time.time() if end is None else end
+        start = end - 3600 if start is None else start
+        with self._lock:
+            if vehicles is not None:
+                slots = np.array([self.slot_of[str(v)] for v in vehicles if str(v) in self.slot_of], dtype = np.int64)
+            else:
+                slots = np.flatnonzero(self.vehicle_of != None)
+            routes = None if route_ids is None else [self.route_codes[str(r)] for r in route_ids if str(r) in self.route_codes]
+            slots, positions = self._window(slots, start, end, routes)
+            df = pd.DataFrame({
+                'vehicle' : self.vehicle_of[slots],
+                'route_id' : np.array(self.route_names + [None], dtype = object)[self.route[slots, positions]],
+                'timestamp' : self.timestamp[slots, positions],
+                'lon' : self.lon[slots, positions].astype(float),
+                'lat' : self.lat[slots, positions].astype(float)
+            })
+        same = np.r_[False, df['vehicle'].to_numpy()[1:] == df['vehicle'].to_numpy()[:-1]]
+        distance = haversine(df['lon'].shift(), df['lat'].shift(), df['lon'], df['lat'])
+        elapsed = df['timestamp'].diff().to_numpy(dtype = float)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            df['speed'] = np.where(same & (elapsed > 0), distance / elapsed, np.nan)
+        return df
+
+    def trail(self, vehicle, start = None, end = None):
+        return self.trails(vehicles = [vehicle], start = start, end = end)
+
+    def snapshot_at(self, t, max_age = 120):
+        ## Replay: every vehicle's latest report at or before t, if no older than max_age seconds
+        with self._lock:
+            slots = np.flatnonzero(self.vehicle_of != None)
+            timestamps = self.timestamp[slots]
+            filled = np.arange(self.capacity)[None, :] < self.count[slots][:, None]
+            valid = filled & (timestamps <= t) & (timestamps >= t - max_age)
+            positions = np.argmax(np.where(valid, timestamps, np.iinfo(np.int64).min), axis = 1)
+            found = valid[np.arange(len(slots)), positions]
+            slots, positions = slots[found], positions[found]
+            return pd.DataFrame({
+                'vehicle' : self.vehicle_of[slots],
+                'route_id' : np.array(self.route_names + [None], dtype = object)[self.route[slots, positions]],
+                'timestamp' : self.timestamp[slots, positions],
+                'lon' : self.lon[slots, positions].astype(float),
+                'lat' : self.lat[slots, positions].astype(float)
+            })
+
+def read_spill(spill_dir, start, end):
+    ## Spilled reports between start and end, memory-mapped from the daily files
+    frames = []
+    for day in range(int(start) // 86400, int(end) // 86400 + 1):
+        path = os.path.join(spill_dir, f"{time.strftime('%Y%m%d', time.gmtime(day * 86400))}.bin")
+        if not os.path.exists(path) or os.path.getsize(path) < spill_dtype.itemsize:
+            continue
+        records = np.memmap(path, dtype = spill_dtype, mode = 'r', shape = (os.path.getsize(path) // spill_dtype.itemsize,))
+        frames.append(records[(records['timestamp'] >= start) & (records['timestamp'] <= end)])
+    records = np.concatenate(frames) if frames else np.empty(0, dtype = spill_dtype)
+    return pd.DataFrame({
+        'vehicle' : records['vehicle'].astype(str),
+        'route_id' : records['route_id'].astype(str),
+        'timestamp' : records['timestamp'],
+        'lon' : records['lon'].astype(float),
+        'lat' : records['lat'].astype(float)
+    })
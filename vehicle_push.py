@@ -0,0 +1,124 @@
+import json
+import threading
+
+from metrics import span
+
+## Server-Sent Events push of vehicle snapshots, instead of every client polling a Dash
+## callback. Subscribers with the same route filter form a group; each new snapshot
+## generation is diffed and encoded once per group that has subscribers, and every
+## subscriber of the group is handed the same bytes. A subscriber that just connected, or
+## fell behind, gets the group's full snapshot, which is also encoded once per generation.
+
+KEEPALIVE = 15
+
+def group_key(route_ids = 'all'):
+    if route_ids == 'all' or not route_ids:
+        return 'all'
+    if type(route_ids) in (str, int):
+        route_ids = [route_ids]
+    return ','.join(sorted(set(str(id) for id in route_ids)))
+
+def encode_event(version, data):
+    return f"id: {version}\ndata: {json.dumps(data, separators = (',', ':'))}\n\n".encode()
+
+class VehicleBroadcaster:
+    def __init__(self, store, keepalive = KEEPALIVE):
+        ## store: a VehicleStore, updated here from each snapshot
+        self.store = store
+        self.keepalive = keepalive
+        self.version = None
+        ## group key -> {'subscribers', 'delta' : (from version, version, bytes), 'full' : (version, bytes)}
+        self.groups = {}
+        self.encodes = 0
+        ## Subscribers of notifications(), which get the version only
+        self.notified = 0
+        self._condition = threading.Condition()
+
+    def _routes(self, key):
+        return 'all' if key == 'all' else key.split(',')
+
+    def _full_event(self, key, group, version):
+        if group.get('full', (None,))[0] != version:
+            full = self.store.full(self._routes(key))
+            full['routes'] = [] if key == 'all' else self._routes(key)
+            group['full'] = (version, encode_event(version, full))
+            self.encodes += 1
+        return group['full'][1]
+
+    def publish(self, snapshot):
+        ## vehicle_cache listener: one diff and one encode per group with subscribers. The delta
+        ## starts from the last version published here, not the store's, since other listeners
+        ## (the clusters) may update the shared store first
+        previous = self.version
+        version = self.store.update(snapshot)
+        if version is None or version == self.version:
+            return 0
+        with self._condition, span('vehicle_push_encode'):
+            encoded = 0
+            for key, group in self.groups.items():
+                if group['subscribers'] == 0:
+                    continue
+                if previous is not None:
+                    delta = self.store.changes_since(previous, self._routes(key))
+                    delta['routes'] = [] if key == 'all' else self._routes(key)
+                    group['delta'] = (previous, version, encode_event(version, delta))
+                    self.encodes += 1
+                    encoded += 1
+            self.version = version
+            self._condition.notify_all()
+        return encoded
+
+    def subscribers(self):
+        with self._condition:
+            return sum(group['subscribers'] for group in self.groups.values()) + self.notified
+
+    def stream(self, route_ids = 'all'):
+        ## Generator of SSE bytes for one subscriber, for a streaming Flask response
+        key = group_key(route_ids)
+        with self._condition:
+            group = self.groups.setdefault(key, {'subscribers' : 0})
+            group['subscribers'] += 1
+        try:
+            sent = None
+            ## Tell EventSource to wait 5 seconds before reconnecting
+            yield b"retry: 5000\n\n"
+            while True:
+                with self._condition:
+                    if self.version is None or self.version == sent:
+                        self._condition.wait(timeout = self.keepalive)
+                    version = self.version
+                    if version is None or version == sent:
+                        event = b": keepalive\n\n"
+                    elif sent is not None and group.get('delta', (None, None))[:2] == (sent, version):
+                        event = group['delta'][2]
+                    else:
+                        event = self._full_event(key, group, version)
+                yield event
+                sent = version
+        finally:
+            with self._condition:
+                group['subscribers'] -= 1
+                if group['subscribers'] == 0:
+                    del self.groups[key]
+
+    def notifications(self):
+        ## Generator of SSE bytes carrying only each new version, for subscribers that fetch
+        ## what they need themselves (e.g. the clusters in their view)
+        with self._condition:
+            self.notified += 1
+        try:
+            sent = None
+            yield b"retry: 5000\n\n"
+            while True:
+                with self._condition:
+                    if self.version is None or self.version == sent:
+                        self._condition.wait(timeout = self.keepalive)
+                    version = self.version
+                if version is None or version == sent:
+                    yield b": keepalive\n\n"
+                else:
+                    yield encode_event(version, {'version' : version})
+                sent = version
+        finally:
+            with self._condition:
+                self.notified -= 1